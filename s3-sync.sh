@@ -65,6 +65,10 @@ cat $TW_BASE/sync/readydir-list.txt | while read readydir ; do
         for f in $TW_BASE/$readydir/*.json.gz ; do 
             sync_s3 "$f"  DEEP_ARCHIVE
         done
+
+        for f in $TW_BASE/$readydir/*.pkt ; do 
+            sync_s3 "$f"  DEEP_ARCHIVE
+        done
     else
         echo no mkv files found
     fi
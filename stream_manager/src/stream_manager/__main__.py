@@ -1,9 +1,12 @@
 import logging
 import asyncio
 import argparse
-import sys
+import signal
+
+import yaml
 
 from stream_manager import manager
+from stream_manager.logs import log_pipeline
 
 async def main():
 
@@ -21,30 +24,30 @@ async def main():
     args=vars(prs.parse_args())
 
 
-    fmt=logging.Formatter(
-        # TODO having issues with taskName
-        #fmt='[%(taskName)s][%(asctime)s] %(message)s',
-        fmt='[%(asctime)s] %(message)s',
-        datefmt='%Y-%m-%d_%H-%M-%S.%f',
-        #defaults={
-        #    'taskName': 'main'
-        #}
-    ) 
-    logger=logging.getLogger('stream_manager')
-    logger.setLevel(logging.DEBUG)
-    h=logging.StreamHandler(stream=sys.stdout)
-    h.setFormatter(fmt)
-    logger.addHandler(h)
+    # the logging section is needed before the manager (which loads the rest) starts
+    with open(args['config'], 'rb') as f:
+        log_config=(yaml.safe_load(f) or {}).get('logging') or {}
 
-    h=logging.StreamHandler(stream=sys.stderr)
-    h.setLevel(logging.ERROR)
-    logger.addHandler(h)
+    # records are written by a background thread (see logs.py)
+    logger=logging.getLogger('stream_manager')
+    log=log_pipeline(logger, log_config)
+    log.start()
 
-    i = manager.manager(args['config'], logger)
-    #await i.start(args['no_resume'])
-    await i.start()
+    try:
+        i = manager.manager(args['config'], logger, log_pipeline=log)
+        #await i.start(args['no_resume'])
+        await i.start()
+    finally:
+        log.stop()
 
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    task = loop.create_task(main())
+
+    # on SIGTERM, cancel main() so that pending state is flushed before exiting
+    loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,225 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+"""
+admission control for new downloads, by free disk space
+
+every download writes to download_dir and is then moved to completed_dir (or the session
+assembly directory, see manager.completed_dir), where it waits for conversion. when conversion
+falls behind, these fill up, and once a filesystem is full every active recording is corrupted
+at once. so before a new session starts (see manager.try_stream; retries of a session which is
+already recording, and resumed sessions, are not affected), the free space of these filesystems
+decides whether it may start:
+
+- free space and inflow rate (how fast free space goes down, as a moving average) are sampled
+  every check_interval_sec for each filesystem. decisions use the free space projected
+  horizon_sec ahead at the current inflow rate, on the filesystem with the least of it
+- below downgrade_below_gb, a session of a video stream is recorded as audio_only instead
+  (streamlink is given audio_only as the quality, and the file is named and converted as
+  audio_only); below refuse_below_gb, the session is not started at all
+- streams are prioritized by tier: their quality group in the streams section (e.g. 720p), with
+  the ext_streamlist streams (audio_only) last. the watermarks of the lowest tier are raised by
+  tier_margin (0.5: 50%), and those of the tiers in between proportionally, so lower tiers are
+  downgraded and refused first as space runs out. the order of the tiers is that of the streams
+  section, or `tiers`
+
+a poll attempt is speculative (most find the stream offline), so its decision is only counted
+and recorded once the attempt turns out to be live (see manager.try_stream); poll attempts
+skipped for lack of space are only counted, as poll_refused.
+
+the filesystems, what each tier gets now, and the latest downgrades and refusals are shown at
+GET /admission.
+"""
+
+GB=1 << 30
+
+class _filesystem():
+
+    # weight of the newest sample in the inflow moving average
+    ALPHA=0.3
+
+    def __init__(self, path) -> None:
+        self.path=path
+        self.free=None
+        self.total=None
+        # bytes per second by which free space goes down (negative when it goes up)
+        self.inflow=0.0
+        self.sampled=None
+        self.error=None
+
+    def sample(self, now):
+        try:
+            st=os.statvfs(self.path)
+        except OSError as e:
+            self.error=str(e)
+            return
+        self.error=None
+        free=st.f_bavail * st.f_frsize
+        if self.free is not None and now > self.sampled:
+            rate=(self.free - free) / (now - self.sampled)
+            self.inflow=self.ALPHA * rate + (1 - self.ALPHA) * self.inflow
+        self.free=free
+        self.total=st.f_blocks * st.f_frsize
+        self.sampled=now
+
+    def projected(self, horizon):
+        return self.free - max(0.0, self.inflow) * horizon
+
+    def stats(self, horizon):
+        return {
+            'path': self.path,
+            'free_bytes': self.free,
+            'total_bytes': self.total,
+            'inflow_bytes_per_sec': round(self.inflow, 1),
+            'projected_free_bytes': None if self.free is None else int(self.projected(horizon)),
+            'error': self.error,
+        }
+
+
+class admission():
+
+    ADMIT='admit'
+    DOWNGRADE='downgrade'
+    REFUSE='refuse'
+
+    """
+    get_paths() returns the directories whose filesystems are checked; get_groups() returns the
+    stream groups of the streams section, in order
+    """
+    def __init__(self, config, get_paths, get_groups) -> None:
+        self.get_paths=get_paths
+        self.get_groups=get_groups
+        self.downgrade_below=config.get('downgrade_below_gb', 50) * GB
+        self.refuse_below=config.get('refuse_below_gb', 10) * GB
+        self.tier_margin=config.get('tier_margin', 0.5)
+        self.tiers=config.get('tiers')
+        self.horizon=config.get('horizon_sec', 1800)
+        self.check_interval=config.get('check_interval_sec', 30)
+        self.logger=logging.getLogger('stream_manager')
+
+        # path -> _filesystem
+        self._filesystems={}
+        self.decisions=collections.deque(maxlen=config.get('keep_decisions', 100))
+        self.counters={
+            self.ADMIT: 0,
+            self.DOWNGRADE: 0,
+            self.REFUSE: 0,
+            'poll_refused': 0,
+        }
+        self._task=None
+
+    def sample(self):
+        now=time.monotonic()
+        paths=self.get_paths()
+        for path in paths:
+            fs=self._filesystems.get(path)
+            if fs is None:
+                fs=self._filesystems[path]=_filesystem(path)
+            fs.sample(now)
+        for path in list(self._filesystems):
+            if path not in paths:
+                del self._filesystems[path]
+
+    def start(self):
+        self.sample()
+        self._task=asyncio.create_task(self._run())
+        return self._task
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f'admission: exception: {e}')
+
+    def tier_order(self):
+        if self.tiers is not None:
+            return list(self.tiers)
+        order=list(self.get_groups())
+        if 'audio_only' not in order:
+            order.append('audio_only')
+        return order
+
+    # watermark multiplier for tier: 1 for the first tier, 1 + tier_margin for the last
+    def factor(self, tier):
+        order=self.tier_order()
+        rank=order.index(tier) if tier in order else len(order) - 1
+        return 1 + self.tier_margin * rank / max(1, len(order) - 1)
+
+    # the filesystem with the least projected free space, or None if none could be sampled
+    def tightest(self):
+        sampled=[fs for fs in self._filesystems.values() if fs.free is not None]
+        if len(sampled) == 0:
+            return None
+        return min(sampled, key=lambda fs: fs.projected(self.horizon))
+
+    # what a new session of tier gets with projected free space
+    def level(self, tier, projected):
+        factor=self.factor(tier)
+        if projected < self.refuse_below * factor:
+            return self.REFUSE
+        elif projected < self.downgrade_below * factor and tier != 'audio_only':
+            return self.DOWNGRADE
+        return self.ADMIT
+
+    """
+    whether a new session of s_config may start, without counting it: a dict whose 'action' is
+    ADMIT, DOWNGRADE (record audio_only instead) or REFUSE, to be passed to record() once it is
+    known to count (see above). signal is what started the session ('online' or 'poll')
+    """
+    def check(self, s_config, signal=None):
+        decision={
+            'time': round(time.time(), 3),
+            'stream': s_config.stream_id,
+            'tier': s_config.qid,
+            'signal': signal,
+            'action': self.ADMIT,
+        }
+        fs=self.tightest()
+        if fs is None:
+            return decision
+
+        projected=fs.projected(self.horizon)
+        decision.update({
+            'action': self.level(s_config.qid, projected),
+            'path': fs.path,
+            'free_bytes': fs.free,
+            'projected_free_bytes': int(projected),
+        })
+        return decision
+
+    def record(self, decision):
+        action=decision['action']
+        if action == self.REFUSE and decision['signal'] == 'poll':
+            self.counters['poll_refused'] += 1
+            return
+        self.counters[action] += 1
+        if action != self.ADMIT:
+            self.decisions.append(decision)
+
+    def stats(self):
+        fs=self.tightest()
+        projected=None if fs is None else fs.projected(self.horizon)
+        levels={
+            tier: self.ADMIT if projected is None else self.level(tier, projected)
+            for tier in self.tier_order()
+        }
+
+        return {
+            'downgrade_below_bytes': self.downgrade_below,
+            'refuse_below_bytes': self.refuse_below,
+            'horizon_sec': self.horizon,
+            'filesystems': [fs.stats(self.horizon) for fs in self._filesystems.values()],
+            # what a new session of each tier would get now
+            'tiers': levels,
+            'decisions': list(self.decisions),
+            **self.counters,
+        }
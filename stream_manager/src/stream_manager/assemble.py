@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import yaml
+
+from stream_manager.common import parse_video_filename, atomic_write
+from stream_manager.jobqueue import job_queue
+from stream_manager.mediainfo import probe_cache, ProbeError
+
+"""
+session assembly: merge the recordings of all retries of a session into one file before
+conversion, so a session is converted and uploaded once instead of once per retry
+
+a session is every recording with the same {stream}_{qid}_{datestr} (see manager.video_path):
+try_stream keeps datestr across retries, and across restarts (it is part of stream_state). the
+recordings ("fragments") of a finished session are moved to in_dir (see manager.completed_dir),
+and the session is queued for assembly (see pipeline.downloaded; without the pipeline, it is
+found by the scan of in_dir):
+
+- empty fragments are deleted; fragments which ffprobe can't read, or which are shorter than
+  min_duration_sec (truncated), are moved to dropped_dir
+- the rest are stream-copied (no re-encoding) into one file with ffmpeg's concat demuxer, in
+  retry order. fragments whose streams differ (codec, resolution, sample rate) can't be
+  concatenated without re-encoding, so each run of compatible fragments becomes its own output
+- each output is named after its first fragment and moved to the conversion input directory,
+  and its fragments are deleted
+
+every output gets a {output}_session.json sidecar (uploaded with the conversion's output) with
+the merged timing: for each fragment, its offset in the output and its original timing
+(start_time relative to the start of the stream, as in the fragment's ffprobe metadata, and file
+modification time), and for each gap between fragments (the stream was offline, or streamlink
+restarted) its offset in the output and its length. gaps are measured by start_time where the
+stream provides it, otherwise by modification time.
+"""
+
+class AssembleError(Exception):
+    pass
+
+
+# streams' parameters which have to match for fragments to be concatenated by stream copy
+def _layout(info):
+    return tuple(
+        (s.get('codec_type'), s.get('codec_name'), s.get('width'), s.get('height'),
+            s.get('sample_rate'), s.get('channels'))
+        for s in info.streams if s.get('codec_type') in ('video', 'audio')
+    )
+
+# file operations, run in the default executor: a move between filesystems is a full copy
+
+def _move_into(path, directory):
+    os.makedirs(directory, exist_ok=True)
+    shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+# move the merged file tmp to output, then delete the fragments it was merged from
+def _replace(tmp, output, fragments):
+    shutil.move(tmp, output)
+    for path in fragments:
+        os.unlink(path)
+
+def _concat_quote(path):
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+class assembler():
+
+    def __init__(self, config, out_dir, sidecar_dir, probes, ffmpeg='ffmpeg') -> None:
+        self.in_dir=config['in_dir']
+        self.dropped_dir=config.get('dropped_dir', os.path.join(self.in_dir, 'dropped'))
+        # the conversion input directory, and its output directory (where the conversion's own
+        # sidecars go, and from where everything is uploaded)
+        self.out_dir=out_dir
+        self.sidecar_dir=sidecar_dir
+        self.min_duration=config.get('min_duration_sec', 1.0)
+        # sessions found by scan() are only assembled once their newest fragment is this old
+        self.settle_sec=config.get('settle_sec', 3600)
+        self.workers=config.get('workers', 1)
+        self.probes=probes
+        self.ffmpeg=ffmpeg
+        self.logger=logging.getLogger('stream_manager')
+
+        self.queue=job_queue(config.get('queue_path', os.path.join(self.in_dir, 'queue.json')))
+        self.errors=0
+
+    # queue key for the session of a fragment
+    def session_key(self, path):
+        f=parse_video_filename(path)
+        if f is None:
+            return None
+        return os.path.join(self.in_dir, f'{f["stream"]}_{f["qid"]}_{f["datestr"]}')
+
+    def fragments(self, key):
+        prefix=os.path.basename(key)
+        paths=[]
+        for path in glob.glob(glob.escape(key) + '_*.mkv'):
+            f=parse_video_filename(path)
+            if f is not None and f'{f["stream"]}_{f["qid"]}_{f["datestr"]}' == prefix:
+                paths.append((f['retry_id'], path))
+        return [path for retry_id, path in sorted(paths)]
+
+    """
+    queue the sessions in in_dir which aren't queued yet and have had no new fragment for
+    settle_sec (so a session which is still being recorded isn't split)
+    """
+    def scan(self):
+        newest={}
+        for path in glob.glob(os.path.join(self.in_dir, '*.mkv')):
+            key=self.session_key(path)
+            if key is None:
+                continue
+            try:
+                mtime=os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            newest[key]=max(newest.get(key, 0), mtime)
+
+        added=0
+        now=time.time()
+        for key, mtime in sorted(newest.items()):
+            if now - mtime >= self.settle_sec and self.queue.add(key):
+                added += 1
+        if added > 0:
+            self.logger.info(f'assembler: queued {added} sessions from {self.in_dir}')
+        return added
+
+    async def _drop(self, path, reason, dropped):
+        dropped.append({'file': os.path.basename(path), 'reason': reason})
+        loop=asyncio.get_running_loop()
+        if reason == 'empty':
+            await loop.run_in_executor(None, os.unlink, path)
+            return
+        await loop.run_in_executor(None, _move_into, path, self.dropped_dir)
+
+    """
+    assemble the session key (see session_key); returns the outputs (paths in out_dir), their
+    timing sidecars (in sidecar_dir), and what was dropped
+    """
+    async def assemble(self, key):
+        paths=self.fragments(key)
+        if len(paths) == 0:
+            return {'outputs': [], 'sidecars': [], 'dropped': []}
+
+        # probe everything before touching anything, so a broken ffprobe can't drop a session
+        fragments=[]
+        errors={}
+        for path in paths:
+            st=os.stat(path)
+            if st.st_size == 0:
+                fragments.append((path, st, None))
+                continue
+            try:
+                info=await self.probes.probe(path)
+            except ProbeError as e:
+                errors[path]=str(e)
+                info=None
+            fragments.append((path, st, info))
+        if len(errors) > 0 and len(errors) == sum(1 for path, st, info in fragments if st.st_size > 0):
+            raise AssembleError(f'could not probe any fragment of {key}: {next(iter(errors.values()))}')
+
+        dropped=[]
+        runs=[]
+        for path, st, info in fragments:
+            if st.st_size == 0:
+                await self._drop(path, 'empty', dropped)
+            elif info is None:
+                await self._drop(path, f'unreadable: {errors[path]}', dropped)
+            elif len(_layout(info)) == 0:
+                await self._drop(path, 'no audio or video streams', dropped)
+            elif info.duration is None or info.duration < self.min_duration:
+                await self._drop(path, f'truncated (duration {info.duration})', dropped)
+            elif len(runs) > 0 and _layout(runs[-1][-1][2]) == _layout(info):
+                runs[-1].append((path, st, info))
+            else:
+                runs.append([(path, st, info)])
+
+        if len(dropped) > 0:
+            self.logger.info(f'assembler: {os.path.basename(key)}: dropped {len(dropped)} fragments: {dropped}')
+
+        outputs=[]
+        sidecars=[]
+        for run in runs:
+            output, sidecar=await self._assemble_run(run, dropped if len(outputs) == 0 else [])
+            outputs.append(output)
+            sidecars.append(sidecar)
+        return {'outputs': outputs, 'sidecars': sidecars, 'dropped': dropped}
+
+    async def _assemble_run(self, run, dropped):
+        first=run[0][0]
+        name=os.path.basename(first)
+        output=os.path.join(self.out_dir, name)
+        sidecar=os.path.join(self.sidecar_dir, f'{name}_session.json')
+        timing=self.timing(run, dropped)
+        loop=asyncio.get_running_loop()
+
+        if len(run) == 1:
+            await loop.run_in_executor(None, shutil.move, first, output)
+            self.probes.rename(first, output)
+        else:
+            tmp=os.path.join(self.in_dir, f'.{name}')
+            concat=os.path.join(self.in_dir, f'.{name}.ffconcat')
+            with open(concat, 'w', encoding='utf-8') as f:
+                f.write('ffconcat version 1.0\n')
+                for path, st, info in run:
+                    f.write(f'file {_concat_quote(os.path.abspath(path))}\n')
+
+            t=time.monotonic()
+            try:
+                await self._run(
+                    self.ffmpeg, '-y', '-hide_banner', '-loglevel', 'error',
+                    '-f', 'concat', '-safe', '0', '-i', concat,
+                    '-map', '0', '-c', 'copy', '-f', 'matroska', tmp,
+                )
+            except BaseException:
+                try:
+                    os.unlink(tmp)
+                except FileNotFoundError:
+                    pass
+                raise
+            finally:
+                os.unlink(concat)
+
+            await loop.run_in_executor(None, _replace, tmp, output, [path for path, st, info in run])
+            self.logger.info(
+                f'assembler: merged {len(run)} fragments into {output} ({os.stat(output).st_size} bytes) '
+                f'in {time.monotonic() - t:.1f}s'
+            )
+
+        await loop.run_in_executor(None, atomic_write, sidecar, json.dumps(timing, indent=4))
+        return output, sidecar
+
+    """
+    merged timing for a run of fragments: each fragment's offset in the output, and the gaps
+    between fragments
+    """
+    def timing(self, run, dropped):
+        f=parse_video_filename(run[0][0])
+        fragments=[]
+        gaps=[]
+        offset=0.0
+        prev=None
+        for path, st, info in run:
+            start=info.start_time
+            # the file is written until the download ends
+            wallclock_start=st.st_mtime - info.duration
+            if prev is not None:
+                if start is not None and prev['start_time'] is not None and start >= prev['start_time']:
+                    gap=start - (prev['start_time'] + prev['duration'])
+                    source='start_time'
+                else:
+                    gap=wallclock_start - prev['wallclock_end']
+                    source='mtime'
+                gaps.append({
+                    'offset': round(offset, 3),
+                    'after_retry_id': prev['retry_id'],
+                    'seconds': round(max(0.0, gap), 3),
+                    'source': source,
+                })
+
+            prev={
+                'file': os.path.basename(path),
+                'retry_id': parse_video_filename(path)['retry_id'],
+                'size': st.st_size,
+                'offset': round(offset, 3),
+                'duration': info.duration,
+                'start_time': start,
+                'wallclock_start': round(wallclock_start, 3),
+                'wallclock_end': round(st.st_mtime, 3),
+            }
+            fragments.append(prev)
+            offset += info.duration
+
+        return {
+            'version': 1,
+            'stream': f['stream'],
+            'qid': f['qid'],
+            'datestr': f['datestr'],
+            'output': os.path.basename(run[0][0]),
+            'duration': round(offset, 3),
+            'fragments': fragments,
+            'gaps': gaps,
+            'dropped': dropped,
+        }
+
+    async def _run(self, *args):
+        proc=await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            out, err=await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        if proc.returncode != 0:
+            raise AssembleError(f'{os.path.basename(args[0])} exited with {proc.returncode}: {err.decode(errors="replace").strip()}')
+
+    async def run(self):
+        self.probes.prune()
+        self.scan()
+        while True:
+            job=self.queue.claim()
+            if job is None:
+                break
+            key, data=job
+            try:
+                self.queue.complete(key, await self.assemble(key))
+            except (AssembleError, ProbeError, OSError) as e:
+                self.logger.error(f'assembler: error for {key}: {e}')
+                self.errors += 1
+                self.queue.fail(key, e)
+        self.queue.close()
+        self.probes.close()
+
+
+async def main():
+    prs=argparse.ArgumentParser(
+        prog='stream_manager.assemble',
+        description='merge the recordings of each session (see the assemble section of the config)',
+    )
+    prs.add_argument('--config', required=True)
+    prs.add_argument('--settle-sec', type=float,
+        help='only assemble sessions with no new recording for this long (default: assemble.settle_sec)')
+    args=vars(prs.parse_args())
+
+    logger=logging.getLogger('stream_manager')
+    logger.setLevel(logging.INFO)
+    h=logging.StreamHandler(stream=sys.stdout)
+    h.setFormatter(logging.Formatter(fmt='[%(asctime)s] %(message)s'))
+    logger.addHandler(h)
+
+    with open(args['config'], 'rb') as f:
+        config=yaml.safe_load(f)
+
+    convert_config=config['convert']
+    try:
+        a=assembler(
+            config['assemble'],
+            convert_config['in_dir'],
+            convert_config['out_dir'],
+            probe_cache(convert_config.get('probe_cache_path'), ffprobe=convert_config.get('ffprobe', 'ffprobe')),
+            ffmpeg=convert_config.get('ffmpeg', 'ffmpeg'),
+        )
+    except RuntimeError as e:
+        # another instance (or the pipeline) is running
+        logger.info(str(e))
+        return 0
+    if args['settle_sec'] is not None:
+        a.settle_sec=args['settle_sec']
+
+    await a.run()
+    return 1 if a.errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
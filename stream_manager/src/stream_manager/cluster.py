@@ -0,0 +1,308 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import time
+
+import httpx
+
+from stream_manager.codec import state_codec
+
+"""
+split the configured streams across several manager instances ("nodes")
+
+every node runs with the same streams config, its own state_url, and the same cluster.lease_url:
+a document on the state server which maps each node ID to its lease:
+
+    {"node1": {"url": ..., "state_url": ..., "seq": 42, "ttl": 30, "active": ["s1", ...]}, ...}
+
+each node renews its own lease every renew_interval_sec by patching in its entry with seq
+incremented (a JSON patch "add" only touches that node's key, so nodes never overwrite each
+other's leases). a node whose seq has not changed for ttl seconds, as observed by the reader's
+own clock, is considered dead - so the nodes' clocks don't need to agree.
+
+ownership of a stream:
+- a live node which lists the stream as active (it is downloading or attempting it) keeps it
+  until it is done, so a membership change never moves a download in progress
+- otherwise, the stream's owner on a consistent hash ring of the live nodes (vnodes points per
+  node), so a node joining or leaving only moves its share of the streams
+
+a node only polls the streams it owns (checked before every attempt, so ownership changes take
+effect without restarting poll tasks), and forwards /online (and /offline, /kill) signals for
+streams owned by another node to that node (see manager.forward_signal). a forwarded signal
+carries FORWARDED_HEADER and is never forwarded again, so nodes whose views of the cluster
+briefly disagree can't forward a signal back and forth.
+
+failover: when a node dies, the survivors read its state document from its state_url, and
+each one takes over the streams it now owns, resuming them from their stream_state (retry_id,
+datestr, so the download continues as the same session). taken-over streams are removed from
+the dead node's state document, so they are not resumed a second time when it comes back.
+
+a node which can't reach lease_url keeps its last view of the cluster; if a node is cut off for
+longer than ttl, its streams are taken over while it may still be downloading them, so a
+partition can produce duplicate downloads (but not missed ones).
+"""
+
+# JSON pointer (RFC 6901) for a top-level key
+def _pointer(k):
+    return '/' + k.replace('~', '~0').replace('/', '~1')
+
+FORWARDED_HEADER='X-Stream-Manager-Forwarded-By'
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class hash_ring():
+
+    def __init__(self, nodes, vnodes=64) -> None:
+        points=sorted((_hash(f'{n}#{i}'), n) for n in nodes for i in range(vnodes))
+        self._keys=[p[0] for p in points]
+        self._nodes=[p[1] for p in points]
+
+    def owner(self, key):
+        if len(self._keys) == 0:
+            return None
+        i=bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+
+class cluster():
+
+    """
+    get_active() returns the stream IDs this node has state for (anything supporting 'in' and
+    iteration, e.g. the manager's stream_state); adopt(states) is called with the stream_state of
+    streams taken over from a dead node (a dict of stream ID -> stream_state), and returns the
+    stream IDs it took over
+    """
+    def __init__(self, config, state_url, get_active, adopt, http_timeout=5) -> None:
+        self.node_id=config['node_id']
+        self.url=config['url']
+        self.lease_url=config['lease_url']
+        self.state_url=state_url
+        self.ttl=config.get('lease_ttl_sec', 30)
+        self.renew_interval=config.get('renew_interval_sec', self.ttl / 3)
+        self.vnodes=config.get('vnodes', 64)
+        self.http_timeout=http_timeout
+
+        self.get_active=get_active
+        self.adopt=adopt
+        self.logger=logging.getLogger('stream_manager')
+
+        self._client=None
+        self._task=None
+        # starts from the time so it also changes when the node restarts
+        self._seq=int(time.time())
+        self._renewed=None
+        # node ID -> lease, as last read from lease_url
+        self.leases={}
+        # node ID -> (seq, monotonic time it was first seen with that seq)
+        self._seen={}
+        self.live={self.node_id}
+        self._ring=hash_ring(self.live, self.vnodes)
+        # stream ID -> live node which has it active
+        self._active={}
+        # dead node ID -> seq of the lease its state document was last checked under
+        self._checked={}
+
+        self.counters={
+            'renewals': 0,
+            'renew_failures': 0,
+            'membership_changes': 0,
+            'adopted': 0,
+            'forwarded': 0,
+        }
+
+    def owner(self, s_id):
+        s_id=s_id.lower()
+        if s_id in self.get_active():
+            return self.node_id
+        node=self._active.get(s_id)
+        if node is not None:
+            return node
+        return self._ring.owner(s_id)
+
+    def owns(self, s_id):
+        return self.owner(s_id) == self.node_id
+
+    # URL of a live node, for forwarding
+    def node_url(self, node_id):
+        if node_id == self.node_id:
+            return self.url
+        lease=self.leases.get(node_id)
+        return None if lease is None else lease.get('url')
+
+    """
+    POST path (e.g. /online/s1) to node_id; returns the response's JSON, or None if the node
+    could not be reached
+    """
+    async def forward(self, node_id, path):
+        url=self.node_url(node_id)
+        if url is None:
+            return None
+        try:
+            r=await self._client.post(url.rstrip('/') + path, headers={FORWARDED_HEADER: self.node_id})
+            r.raise_for_status()
+            result=r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.warning(f'cluster: could not forward {path} to {node_id}: {e}')
+            return None
+        self.counters['forwarded'] += 1
+        return result
+
+    async def start(self):
+        self._client=httpx.AsyncClient(timeout=self.http_timeout)
+        # join before anything is polled, so this node doesn't start on streams owned by others
+        try:
+            await self._update()
+        except Exception as e:
+            self.logger.warning(f'cluster: could not join via {self.lease_url} ({e}), assuming this node is alone')
+        self._task=asyncio.create_task(self._run())
+        return self._task
+
+    async def close(self):
+        # the lease is left to expire: this node's downloads outlive it, and are resumed from
+        # its state by the next instance, unless it is gone for longer than ttl
+        if self._task is not None:
+            self._task.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client=None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                await self._update()
+            except Exception as e:
+                self.logger.error(f'cluster: update failed: {e}')
+
+    async def _update(self):
+        try:
+            await self._renew()
+        except httpx.HTTPError as e:
+            self.counters['renew_failures'] += 1
+            self.logger.warning(f'cluster: could not renew lease: {e}')
+
+        r=await self._client.get(self.lease_url)
+        r.raise_for_status()
+        leases=r.json()
+        if not isinstance(leases, dict):
+            raise ValueError(f'{self.lease_url} is not a JSON object')
+        self.leases=leases
+        self._refresh()
+        await self._take_over()
+
+    async def _renew(self):
+        self._seq += 1
+        lease={
+            'url': self.url,
+            'state_url': self.state_url,
+            'seq': self._seq,
+            'ttl': self.ttl,
+            'active': sorted(self.get_active()),
+        }
+        r=await self._client.patch(self.lease_url, content=json.dumps([
+            {'op': 'add', 'path': _pointer(self.node_id), 'value': lease}
+        ]), headers={'content-type': 'application/json-patch+json'})
+
+        if r.status_code == 404:
+            # first node: create the document, unless another node just did
+            r=await self._client.put(self.lease_url, content=json.dumps({self.node_id: lease}),
+                headers={'content-type': 'application/json', 'if-none-match': '*'})
+            if r.status_code == 412:
+                self._seq -= 1
+                return await self._renew()
+        r.raise_for_status()
+
+        self._renewed=time.monotonic()
+        self.counters['renewals'] += 1
+
+    def _refresh(self):
+        now=time.monotonic()
+        live={self.node_id}
+        for node_id, lease in self.leases.items():
+            if node_id == self.node_id or not isinstance(lease, dict):
+                continue
+            seq=lease.get('seq')
+            seen=self._seen.get(node_id)
+            if seen is None or seen[0] != seq:
+                self._seen[node_id]=(seq, now)
+                seen=self._seen[node_id]
+            if now - seen[1] < lease.get('ttl', self.ttl):
+                live.add(node_id)
+        for node_id in list(self._seen.keys()):
+            if node_id not in self.leases:
+                del self._seen[node_id]
+
+        self._active={
+            s_id: node_id for node_id in live if node_id != self.node_id
+            for s_id in self.leases[node_id].get('active', [])
+        }
+
+        if live != self.live:
+            self.logger.info(f'cluster: live nodes changed: {sorted(self.live)} -> {sorted(live)}')
+            self.live=live
+            self._ring=hash_ring(live, self.vnodes)
+            self.counters['membership_changes'] += 1
+            # a dead node's remaining streams may be ours now
+            self._checked.clear()
+
+    """
+    take over the streams of dead nodes which this node now owns. a dead node's state is checked
+    once per membership change (or when its lease changes), not on every update
+    """
+    async def _take_over(self):
+        for node_id, lease in self.leases.items():
+            if node_id in self.live or not isinstance(lease, dict) or lease.get('state_url') is None:
+                continue
+            if self._checked.get(node_id) == lease.get('seq'):
+                continue
+
+            url=lease['state_url']
+            r=await self._client.get(url)
+            if r.status_code == 404:
+                self._checked[node_id]=lease.get('seq')
+                continue
+            r.raise_for_status()
+
+            states=state_codec().decode(r.text)
+            mine={s_id: s for s_id, s in states.items() if self._ring.owner(s_id) == self.node_id}
+            if len(mine) > 0:
+                adopted=await self.adopt(mine)
+                if len(adopted) > 0:
+                    self.logger.info(f'cluster: took over {len(adopted)} streams from {node_id}: {adopted}')
+                    self.counters['adopted'] += len(adopted)
+                    await self._remove(url, adopted)
+            self._checked[node_id]=lease.get('seq')
+
+    # remove s_ids from the state document at url, one patch each: a patch fails as a whole
+    # (409) if any of its keys is already gone
+    async def _remove(self, url, s_ids):
+        for s_id in s_ids:
+            r=await self._client.patch(url, content=json.dumps([
+                {'op': 'remove', 'path': _pointer(s_id)}
+            ]), headers={'content-type': 'application/json-patch+json'})
+            if r.status_code == 404:
+                # the document itself is gone
+                return
+            if r.status_code != 409:
+                r.raise_for_status()
+
+    def stats(self):
+        now=time.monotonic()
+        return {
+            'node_id': self.node_id,
+            'live': sorted(self.live),
+            'nodes': {
+                node_id: {
+                    'url': lease.get('url'),
+                    'live': node_id in self.live,
+                    'active': len(lease.get('active', [])),
+                    'last_change_sec': round(now - self._seen[node_id][1], 3) if node_id in self._seen else None,
+                } for node_id, lease in self.leases.items() if isinstance(lease, dict)
+            },
+            'last_renewal_sec': None if self._renewed is None else round(now - self._renewed, 3),
+            **self.counters,
+        }
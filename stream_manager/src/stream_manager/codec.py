@@ -0,0 +1,199 @@
+import json
+import logging
+import re
+
+from stream_manager.common import stream_state, stream_config
+
+"""
+state (de)serialization
+
+the state document maps each stream ID to a record; the document's shape is unchanged (so the
+/state API, state_url replication and JSON patch paths stay the same), but every record carries
+a schema version 'v':
+
+    {"s1": {"v":2,"pid":123,"retry_id":0,"config":{...},"datestr":"...",...}, ...}
+
+records without 'v' were written before versioning (version 1) and are migrated on load.
+
+encoding is done by hand into compact JSON rather than through a generic encoder: a stream's
+config is encoded once and cached on the (immutable) config object, and a record whose fields
+have not changed since it was last encoded is not encoded again - most state changes touch one
+stream out of many.
+
+decoding skips individual records which are invalid instead of giving up on the whole state,
+and salvages what it can from a document which is not valid JSON (e.g. truncated).
+"""
+
+VERSION=2
+
+_dumps=json.JSONEncoder(separators=(',', ':'), check_circular=False, ensure_ascii=False).encode
+_str=json.encoder.encode_basestring
+
+# one migration per version: migrates a record of that version to the next
+def _migrate_1(d):
+    return d
+
+MIGRATIONS={
+    1: _migrate_1,
+}
+
+
+class CodecError(Exception):
+    pass
+
+
+def encode_config(c):
+    try:
+        return c._json
+    except AttributeError:
+        pass
+    c._json=_dumps({
+        'stream_id': c.stream_id,
+        'qid': c.qid,
+        'qlist': c.qlist,
+        'retries': c.retries,
+    })
+    return c._json
+
+def _bool(b):
+    return 'true' if b else 'false'
+
+def encode_state(s):
+    pid='null' if s.pid is None else str(int(s.pid))
+    return (
+        f'{{"v":{VERSION},"pid":{pid},"retry_id":{int(s.retry_id)},'
+        f'"config":{encode_config(s.config)},"datestr":{_str(s.datestr)},'
+        f'"log_path":{_str(s.log_path)},"poll_attempt":{_bool(s.poll_attempt)},'
+        f'"resumed":{_bool(s.resumed)}}}'
+    )
+
+def join(parts):
+    return '{' + ','.join(f'{_str(k)}:{v}' for k, v in parts.items()) + '}'
+
+
+# expected types of a record's fields (exact types: a bool is not an int here)
+CONFIG_FIELDS=(('stream_id', str), ('qid', str), ('qlist', str), ('retries', int))
+STATE_FIELDS=(('retry_id', int), ('datestr', str), ('log_path', str), ('poll_attempt', bool),
+    ('resumed', bool))
+
+def _check(d, fields):
+    for field, t in fields:
+        if type(d[field]) is not t:
+            raise CodecError(f'{field}: unexpected {type(d[field]).__name__}')
+
+def decode_config(d):
+    if type(d) is not dict:
+        raise CodecError('config is not an object')
+    _check(d, CONFIG_FIELDS)
+    return stream_config(d['stream_id'], d['qid'], d['qlist'], d['retries'])
+
+def decode_state(d):
+    if type(d) is not dict:
+        raise CodecError(f'record is a {type(d).__name__}')
+
+    v=d.get('v', 1)
+    if type(v) is not int or v > VERSION:
+        raise CodecError(f'unsupported version {v}')
+    while v < VERSION:
+        d=MIGRATIONS[v](d)
+        v += 1
+
+    _check(d, STATE_FIELDS)
+    pid=d['pid']
+    if pid is not None and type(pid) is not int:
+        raise CodecError(f'pid: unexpected {type(pid).__name__}')
+
+    return stream_state(pid, d['retry_id'], decode_config(d['config']), d['datestr'],
+        d['log_path'], d['poll_attempt'], d['resumed'])
+
+
+class state_codec():
+
+    def __init__(self) -> None:
+        self.logger=logging.getLogger('stream_manager')
+        # stream ID -> (fields the record was encoded from, encoding)
+        self._cache={}
+        self.stats={
+            'encoded': 0,
+            'reused': 0,
+            'skipped': 0,
+        }
+
+    """
+    per-stream JSON for stream_state (a dict of stream ID -> stream_state); only records which
+    changed since the last call are encoded
+    """
+    def encode_all(self, stream_state):
+        cache=self._cache
+        parts={}
+        encoded=0
+        for k, s in stream_state.items():
+            key=(s.pid, s.retry_id, s.config, s.datestr, s.log_path, s.poll_attempt, s.resumed)
+            cached=cache.get(k)
+            if cached is not None and cached[0] == key and cached[0][2] is s.config:
+                parts[k]=cached[1]
+                continue
+            part=encode_state(s)
+            cache[k]=(key, part)
+            parts[k]=part
+            encoded += 1
+
+        if len(cache) > len(parts):
+            for k in [k for k in cache if k not in parts]:
+                del cache[k]
+
+        self.stats['encoded'] += encoded
+        self.stats['reused'] += len(parts) - encoded
+        return parts
+
+    """
+    dict of stream ID -> stream_state from a decoded document; invalid records are skipped (and
+    logged)
+    """
+    def decode_all(self, struct):
+        if not isinstance(struct, dict):
+            raise CodecError(f'state is a {type(struct).__name__}, not an object')
+
+        state={}
+        for k, d in struct.items():
+            try:
+                state[k]=decode_state(d)
+            except (CodecError, KeyError, TypeError, ValueError) as e:
+                self.stats['skipped'] += 1
+                self.logger.error(f'state_codec: skipping invalid record for {k}: {e!r}')
+        return state
+
+    def decode(self, text):
+        try:
+            struct=json.loads(text)
+        except json.JSONDecodeError as e:
+            self.logger.error(f'state_codec: state is not valid JSON ({e}), salvaging records')
+            struct=salvage(text)
+        return self.decode_all(struct)
+
+
+# a top-level entry: at the start of the document or after the end of the previous record. (a
+# record's nested config object never follows a '}')
+_ENTRY_RE=re.compile(r'(?:^\s*\{|\}\s*,)\s*("(?:[^"\\]|\\.)*")\s*:\s*(?=\{)')
+
+"""
+the records which can still be parsed from a damaged state document: each top-level
+"key": {...} entry is decoded on its own, and anything in between which can't be is skipped
+"""
+def salvage(text):
+    decoder=json.JSONDecoder()
+    struct={}
+    pos=0
+    while True:
+        m=_ENTRY_RE.search(text, pos)
+        if m is None:
+            return struct
+        try:
+            key=json.loads(m.group(1))
+            value, end=decoder.raw_decode(text, m.end())
+        except json.JSONDecodeError:
+            pos=m.end()
+            continue
+        struct[key]=value
+        # the next entry's match starts at this record's closing '}'
+        pos=end - 1
@@ -1,16 +1,78 @@
 from dataclasses import dataclass
 import json
+import os
+import re
+import tempfile
 
 from typing import Optional
 
 class json_encoder(json.JSONEncoder):
     def default(self, x):
-        return x.__dict__
+        if hasattr(x, '__dict__'):
+            return x.__dict__
+        # slotted records (see stream_config, stream_state)
+        return {k: getattr(x, k) for k in x.__slots__ if not k.startswith('_')}
 
 
+# write data to path such that a reader (or a crash) never observes a partially-written file:
+# write to a temporary file in the same directory, fsync it, then rename it over the destination
+def atomic_write(path, data):
+    if isinstance(data, str):
+        data=data.encode('utf-8')
+
+    directory=os.path.dirname(os.path.abspath(path))
+    fd, tmp_path=tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # make the rename itself durable
+    try:
+        dir_fd=os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+# recordings are named {stream}_{qid}_{datestr}_{retry_id}.mkv (see manager.video_path), and their
+# sidecars {recording}.json, {recording}_packets.json.gz etc.
+VIDEO_FILENAME_RE=re.compile(
+    r'^(?P<stream>.+?)_(?P<qid>audio_only|[^_]+)_(?P<datestr>\d{4}-\d{2}-\d{2}T[^_]+)_(?P<retry_id>\d+)\.mkv'
+)
+
+# dict with stream, qid, datestr and retry_id for a recording or sidecar, or None
+def parse_video_filename(path):
+    m=VIDEO_FILENAME_RE.match(os.path.basename(path))
+    if m is None:
+        return None
+    d=m.groupdict()
+    d['retry_id']=int(d['retry_id'])
+    return d
+
+
+# records are slotted: there is one of each per stream, and no __dict__ keeps them small. they
+# are (de)serialized by codec.py
+
 # config for a stream
 @dataclass()
 class stream_config():
+    # _json: the codec's cached encoding of this config (configs are not modified once created)
+    __slots__=('stream_id', 'qid', 'qlist', 'retries', '_json')
+
     stream_id: str
     qid: str
     qlist: str
@@ -19,6 +81,8 @@ class stream_config():
 # state for a specific stream
 @dataclass()
 class stream_state():
+    __slots__=('pid', 'retry_id', 'config', 'datestr', 'log_path', 'poll_attempt', 'resumed')
+
     pid : Optional[int]
 
     # current retry ID, starting from 0 (first try)
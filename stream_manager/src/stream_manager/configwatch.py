@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+
+"""
+support for incremental config reloads: parsed files are cached by (mtime, size), so a reload
+only re-parses the files which changed, and a watcher polls the config file and the
+ext-streamlist directory so changes are picked up without a call to /reload.
+
+the watcher polls (one stat() per file per interval) rather than using inotify or kqueue, so it
+works the same everywhere.
+"""
+
+def _signature(st):
+    return (st.st_mtime_ns, st.st_size)
+
+
+class file_cache():
+
+    def __init__(self) -> None:
+        # path -> (signature, parsed)
+        self._files={}
+        self.parsed=0
+
+    """
+    parse(f) of the file at path (opened in binary mode), or the cached result if the file has
+    not changed since it was last parsed
+    """
+    def load(self, path, parse):
+        sig=_signature(os.stat(path))
+        cached=self._files.get(path)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+
+        with open(path, 'rb') as f:
+            data=parse(f)
+        self._files[path]=(sig, data)
+        self.parsed += 1
+        return data
+
+    # forget files which are not in paths (e.g. deleted from a directory)
+    def retain(self, paths):
+        for path in list(self._files.keys()):
+            if path not in paths:
+                del self._files[path]
+
+
+class config_watcher():
+
+    def __init__(self, get_paths, callback, interval=10) -> None:
+        # get_paths() returns the files and directories to watch; evaluated on every check, as
+        # the config may have changed them
+        self.get_paths=get_paths
+        self.callback=callback
+        self.interval=interval
+        self.logger=logging.getLogger('stream_manager')
+
+        self._last=None
+        self._task=None
+
+    def signature(self):
+        sig=[]
+        for path in self.get_paths():
+            try:
+                st=os.stat(path)
+            except FileNotFoundError:
+                sig.append((path, None))
+                continue
+            sig.append((path, _signature(st)))
+
+            if os.path.isdir(path):
+                # a file which is rewritten in place doesn't change the directory's mtime
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            sig.append((entry.path, _signature(entry.stat())))
+                        except FileNotFoundError:
+                            pass
+        return sorted(sig, key=lambda x: x[0])
+
+    def start(self):
+        self._last=self.signature()
+        self._task=asyncio.create_task(self._run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                sig=self.signature()
+                if sig == self._last:
+                    continue
+                self._last=sig
+                self.logger.info('config_watcher: change detected, reloading')
+                self.callback()
+            except Exception as e:
+                self.logger.error(f'config_watcher: exception: {e}')
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from stream_manager.common import parse_video_filename
+from stream_manager.jobqueue import job_queue
+from stream_manager.mediainfo import probe_cache, ProbeError
+from stream_manager.encoding import preset_controller
+from stream_manager import packets
+
+"""
+conversion service: a Python replacement for convert.sh which runs several ffmpeg jobs at once
+
+recordings (*.mkv) in in_dir are converted into pending_dir along with their metadata sidecars
+(.json: ffprobe stream and format metadata, _packets.pkt: per-packet timing of the audio stream,
+see packets.py; or _packets.json.gz as written by convert.sh, with packets_format: json), and
+then moved to out_dir, after which the original is deleted - the same steps as convert.sh. jobs are tracked in a persistent queue (queue_path), so an interrupted run picks up
+where it left off.
+
+audio_only recordings are encoded to opus; anything else to x265 at the recording's resolution,
+at the fps in fps_dir/{stream} if it exists, otherwise default_fps. the x265 preset follows
+the conversion backlog with adaptive_preset (see encoding.py), and every conversion is recorded
+in stats_path.
+"""
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# copy the output of ffprobe proc into a gzip file at dst, and wait for ffprobe to exit
+def _gzip_output(proc, dst):
+    with proc.stdout, gzip.open(dst, 'wb', compresslevel=9) as f:
+        shutil.copyfileobj(proc.stdout, f, 1 << 16)
+    proc.wait()
+
+# move the converted file dst and its sidecars to dst2, then delete the original src
+def _finish(src, dst, dst2, suffixes):
+    for suffix in suffixes:
+        shutil.move(f'{dst}{suffix}', f'{dst2}{suffix}')
+    os.unlink(src)
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ConvertError(Exception):
+    pass
+
+
+class converter():
+
+    def __init__(self, config) -> None:
+        self.in_dir=config['in_dir']
+        self.pending_dir=config['pending_dir']
+        self.out_dir=config['out_dir']
+        self.fps_dir=config.get('fps_dir')
+        self.default_fps=config.get('default_fps', 30)
+        self.packets_format=config.get('packets_format', 'binary')
+
+        # threads per ffmpeg job, and as many jobs as there are cores for
+        self.threads=config.get('threads', 2)
+        self.workers=config.get('workers') or max(1, available_cpus() // self.threads)
+
+        self.ffmpeg=config.get('ffmpeg', 'ffmpeg')
+        self.ffprobe=config.get('ffprobe', 'ffprobe')
+
+        self.queue=job_queue(config['queue_path'])
+        # one ffprobe run per file, shared with anything else which needs the file's metadata
+        self.probes=probe_cache(config.get('probe_cache_path'), ffprobe=self.ffprobe)
+        self.presets=preset_controller(config, self.workers)
+        self.logger=logging.getLogger('stream_manager')
+        self.errors=0
+
+    # bytes of video recordings waiting for conversion
+    def backlog(self):
+        total=0
+        files=0
+        for path in self.queue.pending():
+            parsed=parse_video_filename(path)
+            if parsed is None or parsed['qid'] == 'audio_only':
+                continue
+            try:
+                total += os.stat(path).st_size
+                files += 1
+            except FileNotFoundError:
+                pass
+        return total, files
+
+    """
+    queue every recording in in_dir which isn't queued yet, smallest first (like `ls -Sr`)
+    """
+    def scan(self):
+        paths=glob.glob(os.path.join(self.in_dir, '*.mkv'))
+        sizes={}
+        for path in paths:
+            try:
+                sizes[path]=os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+
+        added=0
+        for path in sorted(sizes, key=sizes.get):
+            if self.queue.add(path):
+                added += 1
+        if added > 0:
+            self.logger.info(f'converter: queued {added} files from {self.in_dir}')
+        return added
+
+    async def run(self, once=True, scan_interval=60):
+        self.probes.prune()
+        self.scan()
+        workers=[asyncio.create_task(self._worker(i, once)) for i in range(self.workers)]
+        if not once:
+            workers.append(asyncio.create_task(self._scan_task(scan_interval)))
+
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            self.queue.close()
+            self.probes.close()
+
+    async def _scan_task(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.scan()
+
+    async def _worker(self, i, once):
+        while True:
+            job=self.queue.claim()
+            if job is None:
+                if once:
+                    return
+                await asyncio.sleep(5)
+                continue
+
+            path, data=job
+            if not os.path.isfile(path):
+                self.logger.warning(f'converter: file {path} disappeared')
+                self.queue.remove(path)
+                continue
+
+            try:
+                result=await self.convert(path)
+                self.queue.complete(path, result)
+            except (ConvertError, ProbeError, OSError) as e:
+                self.logger.error(f'converter: error for {path}: {e}')
+                self.errors += 1
+                self.queue.fail(path, e)
+            except Exception as e:
+                # e.g. unexpected ffprobe output: fail the job rather than the worker, so one bad
+                # file doesn't stop the run (and stop every following run on the same file)
+                self.logger.error(f'converter: error for {path}: {e}', exc_info=True)
+                self.errors += 1
+                self.queue.fail(path, e)
+
+    async def _exec(self, *args, stdout=subprocess.DEVNULL):
+        proc=await asyncio.create_subprocess_exec(
+            *args,
+            stdin=subprocess.DEVNULL,
+            stdout=stdout,
+            stderr=subprocess.PIPE,
+        )
+        return proc
+
+    async def _run(self, *args):
+        proc=await self._exec(*args, stdout=subprocess.PIPE)
+        try:
+            out, err=await proc.communicate()
+        except asyncio.CancelledError:
+            # don't leave ffmpeg running when the job is abandoned
+            proc.kill()
+            raise
+        if proc.returncode != 0:
+            raise ConvertError(f'{os.path.basename(args[0])} exited with {proc.returncode}: {err.decode(errors="replace").strip()}')
+        return out
+
+    """
+    dump per-packet timing of the first audio stream, gzipped, without holding it in memory
+    """
+    async def write_packets(self, path, dst):
+        # stderr goes to a file, so ffprobe can't block on it while stdout is being compressed
+        with tempfile.TemporaryFile() as err:
+            proc=subprocess.Popen(
+                [self.ffprobe, '-hide_banner', '-v', 'warning', '-i', path, '-of', 'json',
+                    '-select_streams', 'a:0', '-show_entries', 'packet=pts_time,dts_time,size,pos,duration_time'],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=err,
+            )
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, _gzip_output, proc, dst)
+            except BaseException:
+                proc.kill()
+                raise
+
+            if proc.returncode != 0:
+                err.seek(0)
+                raise ConvertError(f'ffprobe (packets) exited with {proc.returncode}: {err.read().decode(errors="replace").strip()}')
+
+    def fps(self, stream):
+        if self.fps_dir is not None:
+            try:
+                with open(os.path.join(self.fps_dir, stream), 'r') as f:
+                    return f.read().strip()
+            except FileNotFoundError:
+                pass
+        return str(self.default_fps)
+
+    def ffmpeg_args(self, src, dst, quality, stream, info, fps, preset):
+        if quality == 'audio_only':
+            return [
+                self.ffmpeg, '-y', '-hide_banner', '-loglevel', 'error', '-i', src,
+                '-threads', str(self.threads),
+                '-acodec', 'libopus', '-b:a', '24k', '-vbr', 'on', '-application', 'voip',
+                dst,
+            ]
+
+        video=info.video
+        if video is None:
+            raise ConvertError(f'no video stream in {src}')
+        scale=f'{video["width"]}x{video["height"]}'
+
+        self.logger.info(f'converter: {stream}: x265 preset {preset} fps {fps} scale {scale}')
+        return [
+            self.ffmpeg, '-y', '-hide_banner', '-loglevel', 'error', '-i', src,
+            '-threads', str(self.threads),
+            '-x265-params', f'log-level=error:pools={self.threads}',
+            '-map_metadata', '0', '-map_metadata:s:v', '0:s:v', '-map_metadata:s:a', '0:s:a',
+            '-vcodec', 'libx265', '-preset', preset, '-filter:v', f'fps={fps},scale={scale}',
+            '-acodec', 'libopus', '-b:a', '64k', '-vbr', 'on', '-application', 'voip',
+            dst,
+        ]
+
+    async def convert(self, src):
+        if not os.path.isfile(src):
+            raise ConvertError(f'file {src} disappeared')
+
+        # stream names may contain _ (see common.parse_video_filename)
+        parsed=parse_video_filename(src)
+        if parsed is None:
+            raise ConvertError(f'unexpected file name {src}')
+        stream, quality=parsed['stream'], parsed['qid']
+
+        name=os.path.basename(src)
+        dst=os.path.join(self.pending_dir, name)
+        dst2=os.path.join(self.out_dir, name)
+
+        # save the original metadata for the stream in case anything is lost; also shows this
+        # file's starting time relative to the start of the stream
+        info=await self.probes.probe(src)
+        loop=asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_file, f'{dst}.json', info.raw)
+
+        # full dump of packet timing, so absolute wallclock time can be determined for any moment
+        # of the stream within the file (e.g. across advertising segments which streamlink skips)
+        if self.packets_format == 'json':
+            packets_suffix='_packets.json.gz'
+            await self.write_packets(src, f'{dst}{packets_suffix}')
+        else:
+            packets_suffix='_packets.pkt'
+            if info.audio is None:
+                raise ConvertError(f'no audio stream in {src}')
+            try:
+                await packets.build(src, f'{dst}{packets_suffix}',
+                    time_base=info.audio['time_base'], ffprobe=self.ffprobe)
+            except RuntimeError as e:
+                raise ConvertError(str(e))
+
+        oldsize=os.stat(src).st_size
+        fps=self.fps(stream)
+        if quality == 'audio_only':
+            codec, preset, reason='opus', None, None
+            backlog, backlog_files=None, None
+        else:
+            # the job itself is running, so it isn't counted by backlog()
+            backlog, backlog_files=self.backlog()
+            backlog += oldsize
+            backlog_files += 1
+            codec='x265'
+            preset, reason=self.presets.choose(backlog)
+
+        self.logger.info(f'converter: converting {src} to {dst} ({quality})')
+        t=time.monotonic()
+        await self._run(*self.ffmpeg_args(src, dst, quality, stream, info, fps, preset))
+        elapsed=time.monotonic() - t
+
+        newsize=os.stat(dst).st_size
+        reduction=100 * (1 - newsize / oldsize) if oldsize > 0 else 0.0
+        self.logger.info(f'converter: finished {src} in {elapsed:.0f}s, reduced size by {reduction:.1f}% ({oldsize} -> {newsize})')
+
+        duration=info.duration
+        try:
+            frames=duration * float(fps) if duration is not None and codec == 'x265' else None
+        except ValueError:
+            frames=None
+        self.presets.record({
+            'time': round(time.time(), 3),
+            'file': name,
+            'stream': stream,
+            'quality': quality,
+            'codec': codec,
+            'preset': preset,
+            'reason': reason,
+            'fps': fps if codec == 'x265' else None,
+            'backlog_bytes': backlog,
+            'backlog_files': backlog_files,
+            'workers': self.workers,
+            'duration': duration,
+            'seconds': round(elapsed, 3),
+            'encode_fps': round(frames / elapsed, 2) if frames is not None and elapsed > 0 else None,
+            'realtime': round(duration / elapsed, 3) if duration is not None and elapsed > 0 else None,
+            'input_bytes': oldsize,
+            'output_bytes': newsize,
+            'reduction_pct': round(reduction, 2),
+        })
+
+        await loop.run_in_executor(None, _finish, src, dst, dst2, ('', '.json', packets_suffix))
+
+        return {
+            'output': dst2,
+            'files': [f'{dst2}{suffix}' for suffix in ('', '.json', packets_suffix)],
+            'seconds': round(elapsed, 1),
+            'old_size': oldsize,
+            'new_size': newsize,
+            'preset': preset,
+        }
+
+
+async def main():
+    prs=argparse.ArgumentParser(
+        prog='stream_manager.convert',
+        description='convert recordings (see the convert section of the config)',
+    )
+    prs.add_argument('--config', required=True)
+    prs.add_argument('--daemon', default=False, action='store_true',
+        help='keep running and re-scan the input directory periodically')
+    args=vars(prs.parse_args())
+
+    logger=logging.getLogger('stream_manager')
+    logger.setLevel(logging.INFO)
+    h=logging.StreamHandler(stream=sys.stdout)
+    h.setFormatter(logging.Formatter(fmt='[%(asctime)s] %(message)s'))
+    logger.addHandler(h)
+
+    with open(args['config'], 'rb') as f:
+        config=yaml.safe_load(f)
+
+    try:
+        c=converter(config['convert'])
+    except RuntimeError as e:
+        # another instance is running
+        logger.info(str(e))
+        return 0
+
+    await c.run(once=not args['daemon'], scan_interval=config['convert'].get('scan_interval', 60))
+    return 1 if c.errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
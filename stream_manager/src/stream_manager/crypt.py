@@ -0,0 +1,225 @@
+import base64
+import hashlib
+import os
+import shlex
+
+"""
+in-process equivalent of the filename encryption in s3-sync.sh:
+
+    encrypt () { echo $1 | openssl enc $OPENSSL_ARGS | xxd -p | tr -d \\\\n ; }
+
+openssl_enc takes the same OPENSSL_ARGS string and produces the same hex output (and decrypts
+it), so keys written by the script and by the Python uploader are interchangeable. note that
+`echo` appends a newline, which is part of the encrypted name.
+
+supported options: -aes-{128,192,256}-{cbc,ecb,ctr,cfb,ofb}, -k, -pass (pass:, env:, file:),
+-K, -iv, -S, -salt, -nosalt, -md, -pbkdf2, -iter, -a/-base64, -A, -nopad, -e, -d.
+
+requires the 'cryptography' package (pip install tw-etl[sync]).
+"""
+
+SALT_MAGIC=b'Salted__'
+
+class openssl_enc():
+
+    def __init__(self, args) -> None:
+        if isinstance(args, str):
+            args=shlex.split(args)
+
+        self.cipher=None
+        self.password=None
+        self.key=None
+        self.iv=None
+        self.salt=None
+        self.use_salt=True
+        # OpenSSL >= 1.1.0 defaults to sha256 for key derivation
+        self.md='sha256'
+        self.pbkdf2=False
+        self.iterations=10000
+        self.base64=False
+        self.base64_oneline=False
+        self.pad=True
+
+        i=0
+        def value():
+            nonlocal i
+            i += 1
+            if i >= len(args):
+                raise ValueError(f'openssl_enc: missing value for {args[i-1]}')
+            return args[i]
+
+        while i < len(args):
+            a=args[i]
+            if a in ('-e', '-d', 'enc'):
+                pass
+            elif a == '-k':
+                self.password=value().encode()
+            elif a == '-pass':
+                self.password=_password(value())
+            elif a == '-K':
+                self.key=bytes.fromhex(value())
+            elif a == '-iv':
+                self.iv=bytes.fromhex(value())
+            elif a == '-S':
+                self.salt=bytes.fromhex(value())
+            elif a == '-salt':
+                self.use_salt=True
+            elif a == '-nosalt':
+                self.use_salt=False
+            elif a == '-md':
+                self.md=value().lower()
+            elif a == '-pbkdf2':
+                self.pbkdf2=True
+            elif a == '-iter':
+                self.pbkdf2=True
+                self.iterations=int(value())
+            elif a in ('-a', '-base64'):
+                self.base64=True
+            elif a == '-A':
+                self.base64_oneline=True
+            elif a == '-nopad':
+                self.pad=False
+            elif a.startswith('-') and _parse_cipher(a[1:]) is not None:
+                self.cipher=a[1:]
+            else:
+                raise ValueError(f'openssl_enc: unsupported option {a}')
+            i += 1
+
+        if self.cipher is None:
+            raise ValueError('openssl_enc: no cipher given')
+        self.key_len, self.mode=_parse_cipher(self.cipher)
+        self.iv_len=0 if self.mode == 'ecb' else 16
+
+        if self.key is None and self.password is None:
+            raise ValueError('openssl_enc: no password or key given')
+
+    # key and IV for salt (None: unsalted)
+    def _derive(self, salt):
+        if self.key is not None:
+            # explicit key: the IV must be explicit too (except for ECB)
+            key=self.key.ljust(self.key_len, b'\0')[:self.key_len]
+            iv=(self.iv or b'').ljust(self.iv_len, b'\0')[:self.iv_len]
+            return key, iv
+
+        n=self.key_len + self.iv_len
+        if self.pbkdf2:
+            d=hashlib.pbkdf2_hmac(self.md, self.password, salt or b'', self.iterations, n)
+        else:
+            # EVP_BytesToKey with a count of 1
+            d=b''
+            prev=b''
+            while len(d) < n:
+                prev=hashlib.new(self.md, prev + self.password + (salt or b'')).digest()
+                d+=prev
+        key, iv=d[:self.key_len], d[self.key_len:n]
+        if self.iv is not None:
+            iv=self.iv
+        return key, iv
+
+    def _uses_salt(self):
+        return self.key is None and self.use_salt
+
+    def _cipher(self, key, iv):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        mode={
+            'cbc': lambda: modes.CBC(iv),
+            'ecb': lambda: modes.ECB(),
+            'ctr': lambda: modes.CTR(iv),
+            'cfb': lambda: modes.CFB(iv),
+            'ofb': lambda: modes.OFB(iv),
+        }[self.mode]()
+        return Cipher(algorithms.AES(key), mode)
+
+    def _padded(self):
+        return self.pad and self.mode in ('cbc', 'ecb')
+
+    def encrypt_bytes(self, data):
+        from cryptography.hazmat.primitives import padding
+
+        salt=None
+        if self._uses_salt():
+            salt=self.salt if self.salt is not None else os.urandom(8)
+
+        key, iv=self._derive(salt)
+        if self._padded():
+            p=padding.PKCS7(128).padder()
+            data=p.update(data) + p.finalize()
+
+        e=self._cipher(key, iv).encryptor()
+        out=e.update(data) + e.finalize()
+        # like OpenSSL >= 3.0, the salt header is only written for a random salt
+        if salt is not None and self.salt is None:
+            out=SALT_MAGIC + salt + out
+
+        if self.base64:
+            out=_base64(out, self.base64_oneline)
+        return out
+
+    def decrypt_bytes(self, data):
+        from cryptography.hazmat.primitives import padding
+
+        if self.base64:
+            data=base64.b64decode(b''.join(data.split()))
+
+        salt=None
+        if self._uses_salt():
+            # accept a salt header even with -S, as written by OpenSSL < 3.0
+            if data.startswith(SALT_MAGIC):
+                salt=data[8:16]
+                data=data[16:]
+            elif self.salt is not None:
+                salt=self.salt
+            else:
+                raise ValueError('openssl_enc: bad magic number')
+
+        key, iv=self._derive(salt)
+        d=self._cipher(key, iv).decryptor()
+        out=d.update(data) + d.finalize()
+        if self._padded():
+            u=padding.PKCS7(128).unpadder()
+            out=u.update(out) + u.finalize()
+        return out
+
+    """
+    encrypt a filename like s3-sync.sh's encrypt(): hex of `echo $name | openssl enc`
+    """
+    def encrypt(self, name):
+        return self.encrypt_bytes(name.encode() + b'\n').hex()
+
+    def decrypt(self, hex_name):
+        out=self.decrypt_bytes(bytes.fromhex(hex_name))
+        if out.endswith(b'\n'):
+            out=out[:-1]
+        return out.decode()
+
+
+def _parse_cipher(name):
+    parts=name.lower().split('-')
+    if len(parts) != 3 or parts[0] != 'aes':
+        return None
+    if parts[1] not in ('128', '192', '256') or parts[2] not in ('cbc', 'ecb', 'ctr', 'cfb', 'ofb'):
+        return None
+    return int(parts[1]) // 8, parts[2]
+
+
+def _password(spec):
+    kind, _, value=spec.partition(':')
+    if kind == 'pass':
+        return value.encode()
+    elif kind == 'env':
+        return os.environ[value].encode()
+    elif kind == 'file':
+        with open(value, 'rb') as f:
+            return f.readline().rstrip(b'\r\n')
+    raise ValueError(f'openssl_enc: unsupported -pass {kind}')
+
+
+# base64 as written by openssl: 64 characters per line, newline-terminated (-A: one line, no
+# newline)
+def _base64(data, oneline):
+    b=base64.b64encode(data)
+    if oneline:
+        return b
+    lines=[b[i:i+64] for i in range(0, len(b), 64)]
+    return b'\n'.join(lines) + b'\n'
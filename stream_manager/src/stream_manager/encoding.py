@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+
+"""
+backlog-aware choice of the x265 preset for each conversion
+
+convert.sh always used -preset medium, so when recordings arrive faster than they can be
+converted at that preset, the conversion input directory grows until the disk is full. instead,
+before each video conversion the preset is chosen from the conversion backlog (bytes of video
+recordings waiting in the queue, including the one about to be converted) and the measured
+speed of each preset:
+
+- speed is measured per preset as input bytes converted per second of a job (so it already
+  accounts for the jobs running next to each other), as an exponentially weighted average. a
+  preset which hasn't been measured yet is estimated from the nearest measured one with the
+  rough relative speeds of x265's presets (RELATIVE_SPEED)
+- the slowest preset (best compression) which is expected to convert the whole backlog within
+  target_backlog_sec with all workers is chosen; if none is, the fastest one
+- to avoid flapping, the preset moves towards slower presets one step at a time, and only while
+  the backlog would be converted within slack * target_backlog_sec at the slower preset.
+  moving towards faster presets happens at once, since falling behind fills the disk
+
+with nothing measured at all, conversion starts at start_preset.
+
+every conversion (including audio_only ones, which don't use x265) is recorded as one JSON line
+in stats_path: the preset and why it was chosen, the backlog at the time, the encoding speed
+(frames per second, and the realtime factor: seconds of recording per second of conversion) and
+the size reduction. on start, the measured speeds are restored from the end of this file.
+"""
+
+PRESETS=('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+
+# approximate encoding speed of x265's presets relative to medium
+RELATIVE_SPEED={
+    'ultrafast': 6.0,
+    'superfast': 5.0,
+    'veryfast': 3.5,
+    'faster': 2.2,
+    'fast': 1.6,
+    'medium': 1.0,
+    'slow': 0.45,
+    'slower': 0.15,
+    'veryslow': 0.06,
+}
+
+# how much of the end of stats_path is read on start
+_STATS_TAIL_BYTES=1 << 20
+
+
+class preset_controller():
+
+    """
+    config is the convert section; with adaptive_preset, the preset is chosen as above,
+    otherwise it is always `preset` (default medium)
+    """
+    def __init__(self, config, workers) -> None:
+        self.workers=workers
+        self.stats_path=config.get('stats_path')
+        self.logger=logging.getLogger('stream_manager')
+
+        adaptive=config.get('adaptive_preset')
+        self.adaptive=adaptive is not None
+        if adaptive is None:
+            adaptive={}
+        self.fixed=config.get('preset', 'medium')
+        # fastest first
+        presets=adaptive.get('presets', ['veryfast', 'faster', 'fast', 'medium', 'slow'])
+        for p in presets + [self.fixed]:
+            if p not in RELATIVE_SPEED:
+                raise ValueError(f'preset_controller: unknown x265 preset {p}')
+        self.presets=sorted(presets, key=lambda p: -RELATIVE_SPEED[p])
+        self.target=adaptive.get('target_backlog_sec', 6 * 3600)
+        self.slack=adaptive.get('slack', 0.5)
+        self.alpha=adaptive.get('alpha', 0.3)
+
+        start=adaptive.get('start_preset', self.fixed)
+        self.current=start if start in self.presets else self.presets[len(self.presets) // 2]
+
+        # preset -> average input bytes per second of a job
+        self.speed={}
+        # preset -> number of conversions measured
+        self.measured={}
+        self.counters={
+            'conversions': 0,
+            'faster': 0,
+            'slower': 0,
+            'input_bytes': 0,
+            'output_bytes': 0,
+        }
+        self.last=None
+
+        self._load()
+
+    def _load(self):
+        if self.stats_path is None:
+            return
+        try:
+            with open(self.stats_path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size=f.tell()
+                f.seek(max(0, size - _STATS_TAIL_BYTES))
+                lines=f.read().split(b'\n')
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.logger.error(f'preset_controller: could not read {self.stats_path}: {e}')
+            return
+
+        # the first line may be cut off, the last one may be incomplete
+        for line in lines[1 if size > _STATS_TAIL_BYTES else 0:]:
+            try:
+                r=json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(r, dict) and r.get('codec') == 'x265':
+                self._measure(r.get('preset'), r.get('input_bytes'), r.get('seconds'))
+        if len(self.speed) > 0:
+            self.logger.info(f'preset_controller: restored encoding speeds from {self.stats_path}: {self._speeds()}')
+
+    def _measure(self, preset, input_bytes, seconds):
+        if preset not in RELATIVE_SPEED or not input_bytes or not seconds or seconds <= 0:
+            return
+        rate=input_bytes / seconds
+        prev=self.speed.get(preset)
+        self.speed[preset]=rate if prev is None else self.alpha * rate + (1 - self.alpha) * prev
+        self.measured[preset]=self.measured.get(preset, 0) + 1
+
+    # expected input bytes per second of a job at preset, or None without any measurement
+    def estimate(self, preset):
+        if preset in self.speed:
+            return self.speed[preset]
+        if len(self.speed) == 0:
+            return None
+        ref=min(self.speed, key=lambda p: abs(PRESETS.index(p) - PRESETS.index(preset)))
+        return self.speed[ref] * RELATIVE_SPEED[preset] / RELATIVE_SPEED[ref]
+
+    # expected seconds to convert backlog_bytes at preset with all workers
+    def drain_time(self, preset, backlog_bytes):
+        rate=self.estimate(preset)
+        if rate is None:
+            return None
+        return backlog_bytes / (rate * self.workers)
+
+    """
+    choose the preset for the next video conversion; returns (preset, reason)
+    """
+    def choose(self, backlog_bytes):
+        if not self.adaptive:
+            return self.fixed, 'fixed'
+        if len(self.speed) == 0:
+            return self.current, 'unmeasured'
+
+        # slowest preset which keeps up
+        target=len(self.presets) - 1
+        while target > 0 and self.drain_time(self.presets[target], backlog_bytes) > self.target:
+            target -= 1
+
+        i=self.presets.index(self.current)
+        if target < i:
+            self.current=self.presets[target]
+            self.counters['faster'] += 1
+            reason='behind'
+        elif target > i and self.drain_time(self.presets[i + 1], backlog_bytes) <= self.slack * self.target:
+            self.current=self.presets[i + 1]
+            self.counters['slower'] += 1
+            reason='ahead'
+        else:
+            reason='steady'
+        return self.current, reason
+
+    """
+    record a finished conversion (see convert.convert): measure its speed if it used x265, and
+    append it to stats_path
+    """
+    def record(self, r):
+        self.counters['conversions'] += 1
+        self.counters['input_bytes'] += r['input_bytes']
+        self.counters['output_bytes'] += r['output_bytes']
+        if r['codec'] == 'x265':
+            self._measure(r['preset'], r['input_bytes'], r['seconds'])
+        self.last=r
+
+        if self.stats_path is None:
+            return
+        try:
+            with open(self.stats_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(r, separators=(',', ':')) + '\n')
+        except OSError as e:
+            self.logger.error(f'preset_controller: could not write {self.stats_path}: {e}')
+
+    def _speeds(self):
+        return {p: round(self.speed[p]) for p in PRESETS if p in self.speed}
+
+    def stats(self):
+        total_in=self.counters['input_bytes']
+        return {
+            'adaptive': self.adaptive,
+            'preset': self.current if self.adaptive else self.fixed,
+            'presets': self.presets if self.adaptive else [self.fixed],
+            # measured input bytes per second of a job
+            'speed': self._speeds(),
+            'measured': dict(self.measured),
+            'reduction_pct': round(100 * (1 - self.counters['output_bytes'] / total_in), 1) if total_in > 0 else None,
+            'last': self.last,
+            **self.counters,
+        }
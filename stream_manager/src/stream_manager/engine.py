@@ -0,0 +1,596 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+
+"""
+in-process download engine: recordings run in a pool of long-lived worker processes which use
+streamlink's Python API, instead of a download_script process (and a new Python interpreter for
+streamlink, importing its plugins) for every attempt
+
+each worker (python -m stream_manager.engine --worker) imports streamlink once and records one
+stream at a time, keeping its streamlink sessions (and so their HTTP connection pools) across
+recordings. it is started in its own session, like download_script, so its PID is also its
+process group ID: try_stream records it as the download's pid, and the stall monitor and /kill
+kill the worker (which the pool then replaces). workers talk to the manager over their
+stdin/stdout, one JSON object per line:
+
+  manager -> worker   {"op": "record", "url": ..., "qlist": ..., "path": ..., "log_path": ...,
+                       "args": [...]}
+  worker -> manager   {"event": "ready"}                            (streamlink imported)
+                      {"event": "started", "quality": ...}          (stream opened)
+                      {"event": "unsupported", "error": ...}        (see streamlink_args below)
+                      {"event": "progress", "bytes": ...}           (every progress_interval_sec)
+                      {"event": "done", "code": 0|1, "bytes": ..., "error": ...}
+
+streamlink's own log of a recording goes to log_path, as with download_script.
+
+when the manager exits, the workers finish their current recording (nobody reads their reports
+any more) and then exit, so a restarted manager resumes them by their PID like any other
+download process.
+
+streamlink_args: per-stream streamlink command-line arguments are mapped to the API - the
+session options in SESSION_ARGS (--http-proxy URL, --hls-live-edge 2, ...) and plugin arguments
+(--twitch-disable-ads). a worker keeps one session per distinct set of session options. a
+stream whose arguments can't be mapped is reported as unsupported, and from then on recorded
+with download_script, which is also used for everything if streamlink can't be imported.
+"""
+
+class _worker():
+
+    def __init__(self, proc) -> None:
+        self.proc=proc
+        self.pid=proc.pid
+        self.ready=asyncio.get_running_loop().create_future()
+        self.download=None
+        self.idle_since=time.monotonic()
+        self.reader=None
+
+
+class engine_download():
+
+    def __init__(self, s_id, worker) -> None:
+        self.s_id=s_id
+        self.worker=worker
+        self.pid=worker.pid
+        self.quality=None
+        self.bytes=0
+        self.error=None
+        loop=asyncio.get_running_loop()
+        self.started=loop.create_future()
+        self.done=loop.create_future()
+
+    def finish(self, code, error=None):
+        if error is not None:
+            self.error=error
+        if not self.started.done():
+            self.started.set_result(None)
+        if not self.done.done():
+            self.done.set_result(code)
+
+    async def wait(self):
+        return await self.done
+
+
+class download_engine():
+
+    """
+    config: the engine section; used for download_script arguments (stream, qlist, path,
+    log_path, extra args), see manager.try_stream
+    """
+    def __init__(self, config) -> None:
+        self.url=config.get('url', 'https://twitch.tv/{stream}')
+        # idle workers kept ready
+        self.min_idle=config.get('workers', 4)
+        self.max_idle=config.get('max_idle_workers', self.min_idle * 2)
+        self.progress_interval=config.get('progress_interval_sec', 10)
+        # session options for every recording, as in streamlink_args
+        self.args=config.get('args', [])
+        self.worker_log=config.get('worker_log')
+        self.python=config.get('python', sys.executable)
+        self.logger=logging.getLogger('stream_manager')
+
+        self._idle=[]
+        self._busy=set()
+        self._spawning=0
+        # every worker which has been started and not reaped yet, including those still starting
+        self._workers=set()
+        self._closed=False
+        # streams recorded with download_script, see above
+        self.fallback=set()
+        self.disabled=None
+        self.errors=collections.deque(maxlen=100)
+        self.counters={
+            'workers_started': 0,
+            'workers_exited': 0,
+            'recordings': 0,
+            'failed': 0,
+            'unsupported': 0,
+            'bytes': 0,
+        }
+        self._tasks=set()
+
+    def available(self, s_id):
+        return not self._closed and self.disabled is None and s_id not in self.fallback
+
+    def start(self):
+        self._refill()
+
+    # workers which are starting or idle exit right away, busy ones once their recording ends
+    async def close(self):
+        self._closed=True
+        for t in list(self._tasks):
+            t.cancel()
+        for w in self._workers:
+            self._stop(w)
+        self._idle=[]
+
+        # busy workers may record for hours: their readers are cancelled rather than waited for
+        readers=[w.reader for w in self._workers]
+        for t in readers:
+            t.cancel()
+        await asyncio.gather(*self._tasks, *readers, return_exceptions=True)
+
+    def _stop(self, w):
+        try:
+            w.proc.stdin.close()
+        except (OSError, RuntimeError):
+            pass
+
+    async def _spawn(self):
+        stderr=subprocess.DEVNULL
+        if self.worker_log is not None:
+            stderr=open(self.worker_log, 'ab')
+        try:
+            proc=await asyncio.create_subprocess_exec(
+                self.python, '-m', 'stream_manager.engine', '--worker',
+                '--progress-interval', str(self.progress_interval),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                start_new_session=True,
+                # reports can be long (error messages)
+                limit=1 << 20,
+            )
+        except OSError as e:
+            self.disabled=str(e)
+            self.logger.error(f'engine: could not start a worker, using download_script: {e}')
+            return None
+        finally:
+            if stderr is not subprocess.DEVNULL:
+                stderr.close()
+
+        w=_worker(proc)
+        w.reader=asyncio.create_task(self._read(w))
+        self._workers.add(w)
+        self.counters['workers_started'] += 1
+        if self._closed:
+            # closed while the process was starting
+            self._stop(w)
+            return None
+        if not await w.ready or self._closed:
+            return None
+        return w
+
+    # keep min_idle workers ready
+    async def _fill(self):
+        while not self._closed and self.disabled is None and len(self._idle) + self._spawning < self.min_idle:
+            self._spawning += 1
+            try:
+                w=await self._spawn()
+            finally:
+                self._spawning -= 1
+            if w is None:
+                break
+            self._idle.append(w)
+
+    def _refill(self):
+        if self._closed or self.disabled is not None or len(self._idle) + self._spawning >= self.min_idle:
+            return
+        t=asyncio.create_task(self._fill())
+        self._tasks.add(t)
+        t.add_done_callback(self._tasks.discard)
+
+    async def _read(self, w):
+        try:
+            while True:
+                line=await w.proc.stdout.readline()
+                if len(line) == 0:
+                    break
+                try:
+                    msg=json.loads(line)
+                except ValueError:
+                    continue
+                self._handle(w, msg)
+        except asyncio.CancelledError:
+            # the engine is closing (see close): the worker is left to exit by itself, and its
+            # recording (if any) to be resumed by its pid
+            self._workers.discard(w)
+            if not w.ready.done():
+                w.ready.set_result(False)
+            raise
+        except Exception as e:
+            self.logger.error(f'engine: worker {w.pid}: exception: {e}')
+
+        code=await w.proc.wait()
+        self._workers.discard(w)
+        self.counters['workers_exited'] += 1
+        # a worker which never got ready isn't replaced (it would fail the same way)
+        was_ready=w.ready.done() and w.ready.result()
+        if not w.ready.done():
+            w.ready.set_result(False)
+        if w in self._idle:
+            self._idle.remove(w)
+        self._busy.discard(w)
+        if w.download is not None:
+            w.download.finish(code, w.download.error or f'worker exited with {code}')
+            w.download=None
+        if was_ready:
+            self._refill()
+
+    def _handle(self, w, msg):
+        event=msg.get('event')
+        d=w.download
+        if event == 'ready':
+            w.ready.set_result(True)
+        elif event == 'error' and not w.ready.done():
+            # streamlink could not be imported: download_script for everything
+            self.disabled=msg.get('error')
+            self.logger.error(f'engine: workers can\'t start, using download_script: {self.disabled}')
+            w.ready.set_result(False)
+        elif d is None:
+            return
+        elif event == 'started':
+            d.quality=msg.get('quality')
+            d.started.set_result(True)
+        elif event == 'unsupported':
+            self.fallback.add(d.s_id)
+            self.counters['unsupported'] += 1
+            d.error=msg.get('error')
+            d.started.set_result(False)
+            self._release(w)
+        elif event == 'progress':
+            self.counters['bytes'] += msg['bytes'] - d.bytes
+            d.bytes=msg['bytes']
+        elif event == 'done':
+            self.counters['bytes'] += msg.get('bytes', d.bytes) - d.bytes
+            d.bytes=msg.get('bytes', d.bytes)
+            if msg.get('error') is not None:
+                self.counters['failed'] += 1
+                self.errors.append({
+                    'time': round(time.time(), 3),
+                    'stream': d.s_id,
+                    'bytes': d.bytes,
+                    'error': msg['error'],
+                })
+            d.finish(msg.get('code', 1), msg.get('error'))
+            self._release(w)
+
+    def _release(self, w):
+        w.download=None
+        self._busy.discard(w)
+        w.idle_since=time.monotonic()
+        if len(self._idle) >= self.max_idle:
+            self._stop(w)
+        else:
+            self._idle.append(w)
+
+    """
+    start a recording with download_script's arguments; returns an engine_download (with pid
+    and wait(), like a process), or None if the stream has to be recorded with download_script
+    """
+    async def spawn(self, s_id, args):
+        stream, qlist, path, log_path, extra=args
+        while True:
+            if not self.available(s_id):
+                return None
+            if len(self._idle) > 0:
+                w=self._idle.pop()
+            else:
+                self._spawning += 1
+                try:
+                    w=await self._spawn()
+                finally:
+                    self._spawning -= 1
+                if w is None:
+                    return None
+
+            d=engine_download(s_id, w)
+            w.download=d
+            self._busy.add(w)
+            try:
+                w.proc.stdin.write((json.dumps({
+                    'op': 'record',
+                    'url': self.url.format(stream=stream),
+                    'qlist': qlist,
+                    'path': path,
+                    'log_path': log_path,
+                    'args': list(self.args) + list(extra),
+                }) + '\n').encode())
+                await w.proc.stdin.drain()
+            except (OSError, RuntimeError):
+                # the worker died while idle; its reader cleans up
+                w.download=None
+                self._busy.discard(w)
+                continue
+
+            self._refill()
+            if await d.started is False:
+                self.logger.warning(f'engine({s_id}): {d.error}; using download_script')
+                continue
+            self.counters['recordings'] += 1
+            return d
+
+    def stats(self):
+        return {
+            'disabled': self.disabled,
+            'workers': {
+                'idle': len(self._idle),
+                'busy': len(self._busy),
+                'starting': self._spawning,
+            },
+            'active': {
+                w.download.s_id: {
+                    'pid': w.pid,
+                    'quality': w.download.quality,
+                    'bytes': w.download.bytes,
+                }
+                for w in self._busy if w.download is not None
+            },
+            'fallback': sorted(self.fallback),
+            'errors': list(self.errors),
+            **self.counters,
+        }
+
+
+# --- worker side ---
+
+class UnsupportedArgument(Exception):
+    pass
+
+
+def _flag(value):
+    if value is None:
+        return True
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f'not a boolean: {value}')
+
+
+def _not_flag(value):
+    return not _flag(value)
+
+
+def _comma_list(value):
+    return [x.strip() for x in value.split(',') if x.strip() != '']
+
+
+def _key_value(value):
+    key, sep, value=value.partition('=')
+    if sep == '' or key.strip() == '':
+        raise ValueError(f'not KEY=VALUE: {key}')
+    return key.strip(), value
+
+
+def _filesize(value):
+    units={'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    value=value.strip().lower().removesuffix('b')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+# streamlink command-line arguments which can be used in streamlink_args, as
+# argument -> (session option, parser of the argument's value). the parser gets None for an
+# argument without a value; KEY=VALUE arguments can be repeated and build a dict
+SESSION_ARGS={
+    'http-proxy': ('http-proxy', str),
+    'http-cookie': ('http-cookies', _key_value),
+    'http-header': ('http-headers', _key_value),
+    'http-query-param': ('http-query-params', _key_value),
+    'http-ignore-env': ('http-trust-env', _not_flag),
+    'http-no-ssl-verify': ('http-ssl-verify', _not_flag),
+    'http-disable-dh': ('http-disable-dh', _flag),
+    'http-ssl-cert': ('http-ssl-cert', str),
+    'http-timeout': ('http-timeout', float),
+    'ipv4': ('ipv4', _flag),
+    'ipv6': ('ipv6', _flag),
+    'interface': ('interface', str),
+    'ringbuffer-size': ('ringbuffer-size', _filesize),
+    'hls-live-edge': ('hls-live-edge', int),
+    'hls-live-restart': ('hls-live-restart', _flag),
+    'hls-start-offset': ('hls-start-offset', float),
+    'hls-segment-stream-data': ('hls-segment-stream-data', _flag),
+    'hls-segment-ignore-names': ('hls-segment-ignore-names', _comma_list),
+    'hls-segment-key-uri': ('hls-segment-key-uri', str),
+    'hls-audio-select': ('hls-audio-select', _comma_list),
+    'hls-playlist-reload-attempts': ('hls-playlist-reload-attempts', int),
+    'hls-playlist-reload-time': ('hls-playlist-reload-time', str),
+    'stream-segment-attempts': ('stream-segment-attempts', int),
+    'stream-segment-threads': ('stream-segment-threads', int),
+    'stream-segment-timeout': ('stream-segment-timeout', float),
+    'stream-timeout': ('stream-timeout', float),
+}
+
+
+"""
+map streamlink command-line arguments to session options (see SESSION_ARGS) and plugin options;
+raises UnsupportedArgument for anything else, and ValueError for a value which doesn't parse
+"""
+def parse_args(session, url, args):
+    pluginname, pluginclass, url=session.resolve_url(url)
+    plugin_args={a.name: a for a in pluginclass.arguments}
+
+    session_options={}
+    plugin_options={}
+    i=0
+    while i < len(args):
+        arg=args[i]
+        i += 1
+        if not arg.startswith('--'):
+            raise UnsupportedArgument(f'unexpected argument {arg}')
+        name, sep, value=arg[2:].partition('=')
+        if sep == '' and i < len(args) and not args[i].startswith('--'):
+            value=args[i]
+            i += 1
+        elif sep == '':
+            value=None
+
+        if name.startswith(f'{pluginname}-') and name[len(pluginname) + 1:] in plugin_args:
+            a=plugin_args[name[len(pluginname) + 1:]]
+            if value is None:
+                value=a.const if a.action == 'store_const' else a.action != 'store_false'
+            elif a.type is not None:
+                value=a.type(value)
+            if a.action == 'append':
+                plugin_options.setdefault(a.dest, []).append(value)
+            else:
+                plugin_options[a.dest]=value
+        elif name in SESSION_ARGS:
+            option, parse=SESSION_ARGS[name]
+            if value is None and parse not in (_flag, _not_flag):
+                raise ValueError(f'{arg} needs a value')
+            value=parse(value)
+            if parse is _key_value:
+                session_options.setdefault(option, {})[value[0]]=value[1]
+            else:
+                session_options[option]=value
+        else:
+            raise UnsupportedArgument(f'unsupported streamlink argument {arg}')
+    return session_options, plugin_options
+
+
+class _reporter():
+
+    def __init__(self) -> None:
+        self.lock=threading.Lock()
+        # the manager has gone away: keep recording, stop reporting
+        self.gone=False
+
+    def send(self, **msg):
+        with self.lock:
+            if self.gone:
+                return
+            try:
+                sys.stdout.write(json.dumps(msg) + '\n')
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                self.gone=True
+
+
+def record(sessions, cmd, report, progress_interval):
+    from streamlink import Streamlink
+    from streamlink.exceptions import StreamlinkError
+    from streamlink.options import Options
+
+    log=logging.getLogger('streamlink')
+    handler=None
+    if cmd.get('log_path'):
+        handler=logging.FileHandler(cmd['log_path'])
+        handler.setFormatter(logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s'))
+        log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    written=0
+    try:
+        probe=sessions.get(())
+        if probe is None:
+            probe=sessions[()]=Streamlink()
+        try:
+            session_options, plugin_options=parse_args(probe, cmd['url'], cmd['args'])
+        except (UnsupportedArgument, ValueError, TypeError, StreamlinkError) as e:
+            report.send(event='unsupported', error=str(e))
+            return
+
+        key=tuple(sorted((k, json.dumps(v)) for k, v in session_options.items()))
+        session=sessions.get(key)
+        if session is None:
+            session=sessions[key]=Streamlink(session_options)
+
+        try:
+            streams=session.streams(cmd['url'], options=Options(plugin_options))
+        except StreamlinkError as e:
+            log.error(f'could not fetch streams: {e}')
+            report.send(event='done', code=1, bytes=0, error=str(e))
+            return
+
+        quality=next((q for q in cmd['qlist'].split(',') if q in streams), None)
+        if quality is None:
+            log.error(f'no playable streams ({", ".join(streams) or "offline"})')
+            report.send(event='done', code=1, bytes=0, error=None)
+            return
+
+        try:
+            fd=streams[quality].open()
+        except StreamlinkError as e:
+            log.error(f'could not open stream {quality}: {e}')
+            report.send(event='done', code=1, bytes=0, error=str(e))
+            return
+
+        report.send(event='started', quality=quality)
+        log.info(f'recording {quality} to {cmd["path"]}')
+        error=None
+        last=time.monotonic()
+        try:
+            with open(cmd['path'], 'wb') as f:
+                while True:
+                    data=fd.read(1 << 16)
+                    if len(data) == 0:
+                        break
+                    f.write(data)
+                    written += len(data)
+                    if time.monotonic() - last >= progress_interval:
+                        last=time.monotonic()
+                        report.send(event='progress', bytes=written)
+        except (OSError, StreamlinkError) as e:
+            error=str(e)
+            log.error(f'error while recording: {e}')
+        finally:
+            fd.close()
+        log.info(f'stream ended, {written} bytes written')
+        report.send(event='done', code=0 if error is None else 1, bytes=written, error=error)
+    except Exception as e:
+        log.error(f'exception: {e}')
+        report.send(event='done', code=1, bytes=written, error=f'{type(e).__name__}: {e}')
+    finally:
+        if handler is not None:
+            log.removeHandler(handler)
+            handler.close()
+
+
+def worker(progress_interval):
+    report=_reporter()
+    try:
+        import streamlink
+    except ImportError as e:
+        report.send(event='error', error=str(e))
+        return 1
+
+    sessions={}
+    report.send(event='ready', version=streamlink.__version__)
+    for line in sys.stdin:
+        try:
+            cmd=json.loads(line)
+        except ValueError:
+            continue
+        if cmd.get('op') == 'record':
+            record(sessions, cmd, report, progress_interval)
+    # stdin closed: the manager is done with this worker, or has exited
+    return 0
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser(prog='stream_manager.engine')
+    prs.add_argument('--worker', default=False, action='store_true')
+    prs.add_argument('--progress-interval', type=float, default=10)
+    args=prs.parse_args()
+    if not args.worker:
+        prs.error('only --worker is supported (the engine is started by the manager)')
+    sys.exit(worker(args.progress_interval))
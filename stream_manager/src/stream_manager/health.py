@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+
+"""
+detect a streamlink (shell script) instance which has stalled in some way.
+
+normally, when there isn't any recent data (file modification is not recent), streamlink will
+fail and exit, which is our signal to invoke a retry. if this doesn't happen, we need to kill the
+"stale" process manually.
+
+a single task samples the size of every active download's video_path every sample_interval
+seconds, tracking throughput and when the file last grew. a download whose file has not grown
+for stall_timeout seconds (counting from when the process was started, so new retries get the
+full timeout) has its process group sent SIGTERM, then SIGKILL after kill_grace seconds. the
+process exiting is then handled by try_stream like any other exit.
+"""
+
+class _download():
+
+    def __init__(self, path, pgid, now):
+        self.path=path
+        self.pgid=pgid
+        self.started=now
+        self.last_sample=now
+        self.last_growth=now
+        self.size=0
+        self.bytes_per_sec=0.0
+        self.killed=False
+
+    def stats(self, now):
+        return {
+            'path': self.path,
+            'pgid': self.pgid,
+            'bytes': self.size,
+            'bytes_per_sec': round(self.bytes_per_sec, 1),
+            'running_sec': round(now - self.started, 1),
+            'since_growth_sec': round(now - self.last_growth, 1),
+            'killed': self.killed,
+        }
+
+
+class stream_monitor():
+
+    # weight of the newest sample in the throughput moving average
+    ALPHA=0.3
+
+    def __init__(self, sample_interval=30, stall_timeout=600, kill_grace=10) -> None:
+        self.sample_interval=sample_interval
+        self.stall_timeout=stall_timeout
+        self.kill_grace=kill_grace
+        self.logger=logging.getLogger('stream_manager')
+
+        self._downloads={}
+        self._task=None
+        self._kill_tasks=set()
+        self.kills=0
+
+    def watch(self, s_id, path, pgid):
+        d=_download(path, pgid, time.monotonic())
+        try:
+            # a resumed download may already have data
+            d.size=os.stat(path).st_size
+        except FileNotFoundError:
+            pass
+        self._downloads[s_id]=d
+
+        if self._task is None or self._task.done():
+            self._task=asyncio.create_task(self._run())
+
+    def unwatch(self, s_id):
+        self._downloads.pop(s_id, None)
+
+    async def _run(self):
+        while len(self._downloads) > 0:
+            await asyncio.sleep(self.sample_interval)
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f'stream_monitor: exception: {e}')
+
+    def sample(self):
+        now=time.monotonic()
+        for s_id, d in list(self._downloads.items()):
+            try:
+                size=os.stat(d.path).st_size
+            except FileNotFoundError:
+                size=0
+
+            elapsed=now - d.last_sample
+            if elapsed > 0:
+                rate=max(0, size - d.size) / elapsed
+                d.bytes_per_sec=self.ALPHA * rate + (1 - self.ALPHA) * d.bytes_per_sec
+
+            if size > d.size:
+                d.last_growth=now
+            d.size=size
+            d.last_sample=now
+
+            if not d.killed and now - d.last_growth > self.stall_timeout:
+                self.logger.warning(f'stream_monitor({s_id}): no data for {int(now - d.last_growth)}s, killing process group {d.pgid}')
+                d.killed=True
+                self.kills += 1
+                self.kill(s_id, d.pgid)
+
+    # SIGTERM pgid, then SIGKILL if it's still there after kill_grace; returns immediately
+    def kill(self, s_id, pgid):
+        t=asyncio.create_task(self._kill(s_id, pgid))
+        self._kill_tasks.add(t)
+        t.add_done_callback(self._kill_tasks.discard)
+
+    async def _kill(self, s_id, pgid):
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        except OSError as e:
+            self.logger.error(f'stream_monitor({s_id}): unable to kill {pgid}: {e}')
+            return
+
+        await asyncio.sleep(self.kill_grace)
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+            self.logger.warning(f'stream_monitor({s_id}): process group {pgid} ignored SIGTERM, sent SIGKILL')
+        except ProcessLookupError:
+            pass
+        except OSError as e:
+            self.logger.error(f'stream_monitor({s_id}): unable to kill {pgid}: {e}')
+
+    def stats(self):
+        now=time.monotonic()
+        return {
+            'stall_timeout_sec': self.stall_timeout,
+            'kills': self.kills,
+            'streams': {
+                s_id: d.stats(now) for s_id, d in self._downloads.items()
+            },
+        }
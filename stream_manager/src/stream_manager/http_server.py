@@ -1,7 +1,59 @@
+import json
+import logging
 
+# TODO: FastAPI
+import aiohttp
+from aiohttp import web
 
-import httpx
+from stream_manager.common import json_encoder
 
+"""
+minimal HTTP server for the manager's API: each route's handler is called as
+handler(request, match) and returns data which is sent back as JSON, or a web.Response (e.g. for
+non-JSON content) which is sent as is
+"""
+class http_server():
 
-async with httpx.AsyncClient() as client:
-class 
\ No newline at end of file
+    def __init__(self, listen_addr, listen_port) -> None:
+        self.listen_addr=listen_addr
+        self.listen_port=listen_port
+        self.logger=logging.getLogger('stream_manager')
+
+        self.router=aiohttp.web.UrlDispatcher()
+        self._runner=None
+
+    def add_routes(self, routes):
+        self.router.add_routes(routes)
+
+    @staticmethod
+    def to_json(data):
+        return json.dumps(data, indent=4, cls=json_encoder)+"\n"
+
+    async def handler(self, request):
+        match=await self.router.resolve(request)
+        if match.http_exception:
+            return aiohttp.web.Response(text='', status=match.http_exception.status)
+
+        try:
+            ret=await match.handler(request, match)
+        except Exception as e:
+            self.logger.error(f'http_server: {request.method} {request.path}: {e}', exc_info=True)
+            return aiohttp.web.Response(text=self.to_json({
+                'error': str(e),
+            }), status=500)
+
+        if isinstance(ret, aiohttp.web.StreamResponse):
+            return ret
+        return aiohttp.web.Response(text=self.to_json(ret), status=200)
+
+    async def start(self):
+        server = web.Server(self.handler)
+        self._runner = web.ServerRunner(server)
+        await self._runner.setup()
+        x = web.TCPSite(self._runner, str(self.listen_addr), self.listen_port)
+        await x.start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner=None
@@ -0,0 +1,188 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from stream_manager.common import atomic_write
+
+"""
+durable FIFO job queue, persisted as a JSON file (written atomically after every change)
+
+each job is identified by a key (e.g. the path of the file to process) and carries a dict of
+data. jobs are pending, running, done or failed; jobs which were running when the process
+stopped are pending again on the next start, so no work is lost across restarts. only the
+keep_finished most recently finished (done or failed) jobs are kept.
+
+when used from a running event loop, the file is written from the default executor rather than
+on the loop, and changes made while a write is in progress are saved together by the next one;
+close() writes out anything still unsaved. without a running loop, every change is written
+before returning.
+
+the queue file is locked (flock) for as long as the queue is open, so two processes can't work
+on the same queue; unlike a lock file, the lock goes away if the process crashes.
+"""
+class job_queue():
+
+    PENDING='pending'
+    RUNNING='running'
+    DONE='done'
+    FAILED='failed'
+
+    def __init__(self, path, max_attempts=3, keep_finished=1000) -> None:
+        self.path=path
+        self.max_attempts=max_attempts
+        self.keep_finished=keep_finished
+        self.logger=logging.getLogger('stream_manager')
+
+        self._lock_fd=os.open(f'{path}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise RuntimeError(f'job_queue: {path} is in use by another process')
+
+        self.jobs={}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.jobs=json.load(f)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            self.logger.error(f'job_queue: could not load {path}, starting empty: {e}')
+
+        for job in self.jobs.values():
+            if job['status'] == self.RUNNING:
+                job['status']=self.PENDING
+        self._prune()
+
+        # changes are numbered, so a write never replaces a newer one
+        self._version=0
+        self._written=0
+        self._write_lock=threading.Lock()
+        self._flush=None
+
+    def close(self):
+        if self._written < self._version:
+            self._write(self._version, json.dumps(self.jobs))
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd=None
+
+    def _save(self):
+        self._version += 1
+        try:
+            loop=asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._version, json.dumps(self.jobs))
+            return
+        if self._flush is None:
+            self._flush=loop.create_task(self._flush_task())
+
+    def _write(self, version, data):
+        with self._write_lock:
+            if version <= self._written:
+                return
+            atomic_write(self.path, data)
+            self._written=version
+
+    async def _flush_task(self):
+        loop=asyncio.get_running_loop()
+        try:
+            while self._written < self._version:
+                # serialized on the loop, so the jobs don't change under json.dumps
+                version=self._version
+                data=json.dumps(self.jobs)
+                await loop.run_in_executor(None, self._write, version, data)
+        except OSError as e:
+            # retried with the next change, or by close()
+            self.logger.error(f'job_queue: could not save {self.path}: {e}')
+        finally:
+            self._flush=None
+
+    """
+    add a job unless one with the same key is already queued; returns True if added.
+    a finished (done or failed) job with the same key is replaced
+    """
+    def add(self, key, data=None):
+        job=self.jobs.get(key)
+        if job is not None and job['status'] in (self.PENDING, self.RUNNING):
+            return False
+
+        self.jobs[key]={
+            'status': self.PENDING,
+            'data': data or {},
+            'attempts': 0,
+            'added': time.time(),
+            'error': None,
+        }
+        self._save()
+        return True
+
+    """
+    claim the oldest pending job (among those accepted by filter, if given); returns
+    (key, data), or None if there is nothing to do
+    """
+    def claim(self, filter=None):
+        for key, job in self.jobs.items():
+            if job['status'] != self.PENDING:
+                continue
+            if filter is not None and not filter(key, job['data']):
+                continue
+
+            job['status']=self.RUNNING
+            job['attempts'] += 1
+            self._save()
+            return key, job['data']
+
+        return None
+
+    def complete(self, key, data=None):
+        job=self.jobs[key]
+        job['status']=self.DONE
+        job['finished']=time.time()
+        if data is not None:
+            job['data'].update(data)
+        self._prune()
+        self._save()
+
+    """
+    record a failed attempt; the job is retried until it has failed max_attempts times
+    """
+    def fail(self, key, error):
+        job=self.jobs[key]
+        job['error']=str(error)
+        if job['attempts'] >= self.max_attempts:
+            job['status']=self.FAILED
+            job['finished']=time.time()
+            self._prune()
+        else:
+            job['status']=self.PENDING
+        self._save()
+
+    def remove(self, key):
+        if self.jobs.pop(key, None) is not None:
+            self._save()
+
+    # forget the oldest finished jobs beyond keep_finished
+    def _prune(self):
+        finished=sorted(
+            (k for k, job in self.jobs.items() if job['status'] in (self.DONE, self.FAILED)),
+            key=lambda k: self.jobs[k].get('finished', 0),
+        )
+        for k in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[k]
+
+    def pending(self):
+        return [k for k, job in self.jobs.items() if job['status'] == self.PENDING]
+
+    def count(self, status):
+        return sum(1 for job in self.jobs.values() if job['status'] == status)
+
+    def stats(self):
+        return {
+            status: self.count(status)
+            for status in (self.PENDING, self.RUNNING, self.DONE, self.FAILED)
+        }
@@ -0,0 +1,245 @@
+import collections
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+
+"""
+non-blocking logging for the manager
+
+log calls on the event loop only put the record on a bounded queue; a background thread
+(logging.handlers.QueueListener) formats and writes them, so a slow consumer of stdout (a pipe,
+journald) can't hold up the event loop. when the queue is full, records are dropped and counted
+instead of waiting.
+
+records carry the stream they are about (stream_id, retry_id), from a context variable which is
+set by the stream's task (see set_context, and manager.try_stream) - asyncio copies the context
+into every task, so this needs no changes to the log calls themselves. messages of the usual
+form "func(stream): ..." are attributed to func, and to the stream if there is no context.
+
+with format: json, every record is one JSON object per line (time, level, func, stream_id,
+retry_id, msg, and exc for tracebacks); otherwise the familiar "[time] msg" lines.
+
+speculative poll attempts (see set_context) are most of the log at thousands of streams, and
+almost always uninteresting: with sample_poll: N, only every Nth of their info and debug records
+is kept, per stream and call site. warnings and errors are always kept.
+
+with stream_log_dir, the records of each stream are also written to {stream_log_dir}/{stream}.log,
+rotated at stream_log_max_bytes (keeping stream_log_backups old files). at most
+stream_log_max_open of these files are kept open at once.
+
+counters (records queued, dropped, sampled out, queue depth) are at GET /logging.
+"""
+
+_context=contextvars.ContextVar('stream_manager_log_context', default=None)
+
+# "func(stream): message"
+_PREFIX_RE=re.compile(r'^(\w+)\(([^)]*)\):')
+
+"""
+attach fields to every record logged from the current task (and the tasks it starts):
+stream_id, retry_id, and poll (True for a speculative poll attempt, see sample_poll)
+"""
+def set_context(**fields):
+    _context.set(fields)
+
+
+class text_formatter(logging.Formatter):
+
+    # time.strftime has no %f
+    def formatTime(self, record, datefmt=None):
+        t=datetime.datetime.fromtimestamp(record.created)
+        return t.strftime(datefmt) if datefmt else t.isoformat(sep=' ', timespec='milliseconds')
+
+
+class json_formatter(logging.Formatter):
+
+    def format(self, record):
+        data={
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+        }
+        for k in ('func', 'stream_id', 'retry_id'):
+            v=getattr(record, k, None)
+            if v is not None:
+                data[k]=v
+        data['msg']=record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text=self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc']=record.exc_text
+        return json.dumps(data, default=str)
+
+
+class _queue_handler(logging.handlers.QueueHandler):
+
+    def __init__(self, q, counters, sample_poll) -> None:
+        super().__init__(q)
+        self.counters=counters
+        self.sample_poll=sample_poll
+        # (stream_id, call site) -> poll records seen
+        self._seen=collections.Counter()
+
+    # runs on the caller's thread: as little as possible
+    def prepare(self, record):
+        ctx=_context.get()
+        m=_PREFIX_RE.match(record.msg) if isinstance(record.msg, str) else None
+        record.func=m.group(1) if m is not None else None
+        if ctx is not None:
+            record.stream_id=ctx.get('stream_id')
+            record.retry_id=ctx.get('retry_id')
+            record.poll=ctx.get('poll', False)
+        else:
+            record.stream_id=m.group(2).lower() if m is not None and len(m.group(2)) > 0 else None
+            record.retry_id=None
+            record.poll=False
+
+        # merge args now: they may change before the record is written
+        if record.args:
+            record.msg=record.getMessage()
+            record.args=None
+        return record
+
+    def emit(self, record):
+        try:
+            record=self.prepare(record)
+            if record.poll and self.sample_poll > 1 and record.levelno < logging.WARNING:
+                key=(record.stream_id, record.pathname, record.lineno)
+                self._seen[key] += 1
+                if self._seen[key] % self.sample_poll != 1:
+                    self.counters['sampled_out'] += 1
+                    return
+            self.queue.put_nowait(record)
+            self.counters['queued'] += 1
+            depth=self.queue.qsize()
+            if depth > self.counters['max_depth']:
+                self.counters['max_depth']=depth
+        except queue.Full:
+            self.counters['dropped'] += 1
+            self.counters['dropped_by_level'][record.levelname.lower()] += 1
+        except Exception:
+            self.handleError(record)
+
+
+class _stream_files(logging.Handler):
+
+    def __init__(self, directory, max_bytes, backups, max_open) -> None:
+        super().__init__()
+        self.directory=directory
+        self.max_bytes=max_bytes
+        self.backups=backups
+        self.max_open=max_open
+        # stream ID -> RotatingFileHandler, least recently used first
+        self._files=collections.OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def emit(self, record):
+        s_id=getattr(record, 'stream_id', None)
+        if s_id is None:
+            return
+        h=self._files.get(s_id)
+        if h is None:
+            while len(self._files) >= self.max_open:
+                self._files.popitem(last=False)[1].close()
+            h=logging.handlers.RotatingFileHandler(
+                os.path.join(self.directory, f'{s_id}.log'),
+                maxBytes=self.max_bytes, backupCount=self.backups, encoding='utf-8',
+            )
+            h.setFormatter(self.formatter)
+            self._files[s_id]=h
+        else:
+            self._files.move_to_end(s_id)
+        h.emit(record)
+
+    def close(self):
+        for h in self._files.values():
+            h.close()
+        self._files.clear()
+        super().close()
+
+
+class _listener(logging.handlers.QueueListener):
+
+    # the queue may be full when stopping: wait for the thread to make room for the sentinel,
+    # rather than failing (queue.Full) and losing what is queued
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class log_pipeline():
+
+    """
+    config: the logging section of the config (may be empty); replaces the handlers of logger
+    """
+    def __init__(self, logger, config) -> None:
+        self.logger=logger
+        fmt=config.get('format', 'text')
+        if fmt == 'json':
+            formatter=json_formatter()
+        else:
+            formatter=text_formatter(fmt='[%(asctime)s] %(message)s', datefmt='%Y-%m-%d_%H-%M-%S.%f')
+
+        handlers=[]
+        h=logging.StreamHandler(stream=sys.stdout)
+        h.setFormatter(formatter)
+        handlers.append(h)
+
+        h=logging.StreamHandler(stream=sys.stderr)
+        h.setLevel(logging.ERROR)
+        handlers.append(h)
+
+        if config.get('stream_log_dir') is not None:
+            h=_stream_files(
+                config['stream_log_dir'],
+                config.get('stream_log_max_bytes', 1 << 20),
+                config.get('stream_log_backups', 3),
+                config.get('stream_log_max_open', 256),
+            )
+            h.setFormatter(formatter)
+            handlers.append(h)
+
+        self.queue=queue.Queue(maxsize=config.get('queue_size', 10000))
+        self.counters={
+            'queued': 0,
+            'dropped': 0,
+            'dropped_by_level': collections.Counter(),
+            'sampled_out': 0,
+            'max_depth': 0,
+        }
+        self.handler=_queue_handler(self.queue, self.counters, config.get('sample_poll', 1))
+        self.listener=_listener(self.queue, *handlers, respect_handler_level=True)
+        self._handlers=handlers
+
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+        logger.addHandler(self.handler)
+        logger.setLevel(getattr(logging, config.get('level', 'debug').upper()))
+
+    def start(self):
+        self.listener.start()
+
+    # write out whatever is queued
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        for h in self._handlers:
+            h.flush()
+            if isinstance(h, _stream_files):
+                h.close()
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_max_depth': self.counters['max_depth'],
+            'queue_size': self.queue.maxsize,
+            'sample_poll': self.handler.sample_poll,
+            'queued': self.counters['queued'],
+            'dropped': self.counters['dropped'],
+            'dropped_by_level': dict(self.counters['dropped_by_level']),
+            'sampled_out': self.counters['sampled_out'],
+        }
@@ -1,20 +1,20 @@
 import subprocess
 import asyncio
+import contextlib
 
-# TODO: FastAPI
-import aiohttp
 from aiohttp import web
 
 import argparse
 import logging
 import yaml, json
 import random
-import traceback 
 
 import datetime
+import time
 
 import os
 import re
+import signal
 
 from dataclasses import dataclass
 
@@ -24,7 +24,31 @@ from stream_manager import state
 
 from stream_manager.common import stream_state, stream_config, json_encoder
 from stream_manager.state import state
-
+from stream_manager.status import make_status_probe
+from stream_manager.scheduler import scheduler
+from stream_manager.http_server import http_server
+from stream_manager.procwatch import process_watcher
+from stream_manager.health import stream_monitor
+from stream_manager.pipeline import pipeline
+from stream_manager.admission import admission
+from stream_manager.engine import download_engine
+from stream_manager import logs
+from stream_manager.metrics import metrics, loop_lag_monitor
+from stream_manager.statefeed import state_feed
+from stream_manager.configwatch import file_cache, config_watcher
+from stream_manager.supervisor import supervisor
+from stream_manager.cluster import cluster, FORWARDED_HEADER
+from stream_manager.pollmodel import poll_model
+
+
+# config keys without a default
+REQUIRED_CONFIG=('download_script', 'download_dir', 'download_log_dir', 'completed_dir', 'state_path', 'ext_streamlist_dir')
+
+# seconds between checks whether a speculative poll attempt has started writing its file
+LIVE_CHECK_INTERVAL=1.0
+
+# seconds; from polling every minute to every few hours
+POLL_GAP_BUCKETS=(30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
 
 class actual_defaultdict(dict):
     def __init__(self, **defaults):
@@ -34,28 +58,68 @@ class actual_defaultdict(dict):
 
 class manager():
 
-    def __init__(self, config_path, logger):
+    def __init__(self, config_path, logger, log_pipeline=None):
         self._config_path=config_path
         self._logger=logger
+        self.log_pipeline=log_pipeline
 
         self.stream_config={}
         self.ext_streamlist=[]
-        self.awaitables=[]
+        self.supervisor=supervisor()
         self.stream_lock : Dict[str, asyncio.Lock]={}
         self.stream_state : Dict[str, stream_state]={}
+        # stream ID -> (poll_task task, event which stops it)
+        self.poll_tasks={}
+        self._poll_interval=None
+        self._file_cache=file_cache()
+        self.config_watcher=None
+        self.status_probe=None
+        self.pipeline=None
+        self.state_feed=None
+        self.cluster=None
+        self.poll_model=None
+        self.admission=None
+        self.engine=None
 
         self.load_config()
 
+        self.scheduler=scheduler(
+            max_downloads=self.config['max_downloads'],
+            max_probes=self.config['max_probes'],
+            poll_rate=self.config['poll_rate'],
+        )
+        self.process_watcher=process_watcher(self.config['process_poll_interval'])
+        self.monitor=stream_monitor(
+            sample_interval=self.config['healthcheck_interval_sec'],
+            stall_timeout=self.config['stall_timeout_sec'],
+        )
+        self.metrics=metrics()
+        self.metrics.add_collector(self.collect_metrics)
+        self.loop_lag=loop_lag_monitor(self.metrics, self.config['loop_lag_interval_sec'])
+
+        # config key -> state() argument
+        state_args={
+            'state_path': 'state_path',
+            'state_url': 'state_url',
+            'state_url_timeout_sec': 'http_timeout',
+            'state_write_interval_sec': 'write_interval',
+            'state_url_mode': 'http_mode',
+        }
         self.state=state(
             **{
-                k: self.config[k] for k in
-                filter(lambda k: k in ['state_path', 'state_url', 'state_url_timeout_sec'], self.config.keys())
+                state_args[k]: self.config[k] for k in
+                filter(lambda k: k in state_args, self.config.keys())
             }
         )
 
 
     async def start(self):
 
+        # before anything is resumed: resumed downloads would be left to a manager which exits
+        if self.config['cluster'] is not None and self.config['state_url'] is None:
+            self._logger.error('cluster requires state_url, so that other nodes can take over this one\'s streams')
+            return
+
         try:
             self.stream_state=await self.state.load()
         except Exception as e:
@@ -68,98 +132,280 @@ class manager():
 
         # resume existing state
         for k, state in self.stream_state.items():
-            if not k in self.stream_config:
-                self._logger.error(f'could not resume stream {k}: not configured')
-                continue
-
-            state.resumed=True
-            self.awaitables.append(asyncio.create_task(self.try_stream(self.stream_config[k], state.poll_attempt)))
+            self.resume_stream(k, state)
+
+        # join the cluster before anything is polled (see cluster.py)
+        if self.config['cluster'] is not None:
+            self.cluster=cluster(
+                self.config['cluster'],
+                self.config['state_url'],
+                lambda: self.stream_state,
+                self.adopt_streams,
+                http_timeout=self.config['state_url_timeout_sec'] or 5,
+            )
+            self.supervisor.add_service(await self.cluster.start(), 'cluster')
         
 
+        if self.config['pipeline'] == True:
+            try:
+                self.pipeline=pipeline(self.config)
+                for t in self.pipeline.start():
+                    self.supervisor.add_service(t, 'pipeline')
+            except Exception as e:
+                self.pipeline=None
+                self._logger.error(f'could not start pipeline: {e}', exc_info=True)
+
+        if self.config['engine'] is not None:
+            self.engine=download_engine(self.config['engine'])
+            self.engine.start()
+
+        if self.config['admission'] is not None:
+            self.admission=admission(
+                self.config['admission'],
+                lambda: list(dict.fromkeys([self.config['download_dir'], self.config['completed_dir'], self.completed_dir()])),
+                lambda: list((self.config['streams'] or {}).keys()),
+            )
+            self.supervisor.add_service(self.admission.start(), 'admission')
+
+        self.loop_lag.start()
         await self.start_http_server()
 
         if self.config['poll'] == True:
             await self.spawn_poll_tasks(self.config['poll_interval'])
 
-        # wait for all tasks to complete, including any newly arrived ones
-        while len(self.awaitables) > 0:
-            awaitable=self.awaitables.pop()
-            try:
-                await awaitable
-            except Exception as e:
-                self._logger.error(f'awaitable list: exception: {e}')
-                print(traceback.format_exc())
+        if self.config['config_watch_interval_sec'] is not None:
+            self.config_watcher=config_watcher(
+                lambda: [self._config_path, self.config['ext_streamlist_dir']],
+                self.load_config,
+                interval=self.config['config_watch_interval_sec'],
+            )
+            self.supervisor.add_service(self.config_watcher.start(), 'config_watcher')
+
+        try:
+            # wait for all tasks to complete, including any newly arrived ones
+            await self.supervisor.join()
+        finally:
+            # downloads keep running; their state is saved so they are resumed by the next instance
+            await self.supervisor.shutdown()
+
+            self.loop_lag.stop()
+
+            if self.config_watcher is not None:
+                self.config_watcher.stop()
+
+            if self.cluster is not None:
+                await self.cluster.close()
 
+            if self.admission is not None:
+                self.admission.close()
+
+            if self.engine is not None:
+                await self.engine.close()
+
+            if self.poll_model is not None:
+                await self.poll_model.close()
+
+            if self.state_feed is not None:
+                self.state_feed.close()
+
+            # make sure the most recent state reaches disk before exiting
+            await self.state.close()
+
+            if self.status_probe is not None:
+                await self.status_probe.close()
+
+            if self.pipeline is not None:
+                await self.pipeline.close()
+
+
+    # with a pid, the download process may have outlived the previous instance; it is re-adopted
+    # by waiting on its process group (see try_stream)
+    def resume_stream(self, k, state):
+        if not k in self.stream_config:
+            self._logger.error(f'could not resume stream {k}: not configured')
+            return False
+
+        state.resumed=True
+
+        if state.pid is not None:
+            members=self.process_watcher.adopt(state.pid)
+            if members is not None and len(members) == 0:
+                self._logger.info(f'resume({k}): process group {state.pid} has exited')
+            else:
+                self._logger.info(f'resume({k}): re-adopting process group {state.pid} (members: {members})')
+        self.spawn_stream(self.stream_config[k], state.poll_attempt)
+        return True
+
+    """
+    take over streams from a dead node (see cluster.py): they continue from the dead node's
+    retry_id and datestr, as if this instance was resuming them. returns the stream IDs taken
+    over; the others are left for the dead node (or whichever node owns them)
+    """
+    async def adopt_streams(self, states):
+        adopted=[]
+        for k, state in states.items():
+            if k in self.stream_state or k not in self.stream_config:
+                continue
+
+            # the download process (if any) ran on the dead node's host, and so did its log
+            state.pid=None
+            state.log_path=os.path.join(self.config['download_log_dir'], os.path.basename(state.log_path))
+            self.stream_state[k]=state
+            adopted.append(k)
+
+        if len(adopted) > 0:
+            # recorded here before they are removed from the dead node's state
+            await self.write_state()
+            await self.state.flush()
+            for k in adopted:
+                self.resume_stream(k, self.stream_state[k])
+        return adopted
+
+    # whether this instance should attempt s_id (always, unless it's part of a cluster)
+    def owns(self, s_id):
+        return self.cluster is None or self.cluster.owns(s_id)
+
+    """
+    forward a stream signal (e.g. 'online') to the node which owns the stream; returns None if
+    the stream should be handled here: it is owned by this node, the request was already
+    forwarded, or the owner could not be reached
+    """
+    async def forward_signal(self, request, signal, s_id):
+        if self.owns(s_id) or FORWARDED_HEADER in request.headers:
+            return None
+
+        owner=self.cluster.owner(s_id)
+        result=await self.cluster.forward(owner, f'/{signal}/{s_id}')
+        if result is None:
+            self._logger.warning(f'{signal}_handler({s_id}): could not forward to {owner}, handling here')
+            return None
+        self._logger.info(f'{signal}_handler({s_id}): forwarded to {owner}')
+        return {'forwarded_to': owner, 'result': result}
 
+    """
+    (re)load the config file and ext_streamlist_dir. the new config only replaces the current
+    one once it has been parsed and checked, and the stream config built from it; otherwise the
+    exception is raised and the current config stays in effect
+    """
     def load_config(self):
-        self.config=actual_defaultdict(
+        config=actual_defaultdict(
             poll=True,
             poll_interval=240,
             retry_count=50,
+            process_poll_interval=5,
+            healthcheck_interval_sec=30,
+            stall_timeout_sec=600,
+            pipeline=False,
+            max_upload_backlog=20,
+            loop_lag_interval_sec=1.0,
         )
 
-        with open(self._config_path, 'rb') as f:
-            self.config.update(yaml.safe_load(f))
-                               
-    
+        data=self._file_cache.load(self._config_path, yaml.safe_load)
+        # e.g. a file which is still being written
+        if not isinstance(data, dict):
+            raise ValueError(f'load_config: {self._config_path} is not a mapping')
+        missing=[k for k in REQUIRED_CONFIG if data.get(k) is None]
+        if len(missing) > 0:
+            raise ValueError(f'load_config: {self._config_path} is missing {", ".join(missing)}')
+        config.update(data)
+
+        new_config, ext_streamlist=self.build_stream_config(config)
+
+        self.config=config
+        self.ext_streamlist=ext_streamlist
         self._listen_addr = self.config['listen_addr']
         self._listen_port = self.config['listen_port']
 
-        self.stream_config={}
-        self.ext_streamlist=[]
-
-        k=list(self.stream_lock.keys())
-        for s_id in k:
-            if s_id not in self.stream_state:
-                del self.stream_lock[s_id]
-            
+        diff=self.apply_stream_config(new_config)
 
-        def add_stream(s_config):
-            self.stream_config[s_config.stream_id]=s_config
-            self.stream_lock[s_id]=asyncio.Lock()
+        #print(self.config)
+        self._logger.info(
+            f'successfully loaded config and ext-streamlist: {len(self.stream_config)} streams '
+            f'({len(diff["added"])} added, {len(diff["removed"])} removed, {len(diff["changed"])} changed)'
+        )
+        return diff
 
-            self._logger.debug(f'load_config: added stream {s_config}')
+    """
+    stream config from config (see load_config) and ext_streamlist_dir; returns (stream_config,
+    ext_streamlist). only files which changed since the last reload are parsed again
+    """
+    def build_stream_config(self, config):
+        new_config={}
 
         # generate stream config 
-        for fmt, data in self.config['streams'].items():
+        for fmt, data in (config['streams'] or {}).items():
             for s_id in data['streams']:
-                s_config=stream_config(
+                new_config[s_id]=stream_config(
                     stream_id=s_id,
                     qid=fmt,
                     qlist=data['format'],
-                    retries=self.config['retry_count']
+                    retries=config['retry_count']
                 )
-                add_stream(s_config)
 
-        ext_streamlist_dir=self.config['ext_streamlist_dir']
-        for filename in os.listdir(ext_streamlist_dir):
+        # a dict keeps the order in which streams were first seen, and is a set for lookups
+        ext_streamlist={}
+        ext_streamlist_dir=config['ext_streamlist_dir']
+        paths=set([self._config_path])
+        for filename in sorted(os.listdir(ext_streamlist_dir)):
             path=os.path.join(ext_streamlist_dir, filename)
-            with open(path, 'rb') as f:
-                ext_streamlist=json.load(f)
-
-                for s_id in ext_streamlist:
-                    s_id=s_id.replace('#', '')
-
-                    if s_id in self.ext_streamlist:
-                        continue
-
-                    if len(s_id) == 0 or s_id.isspace():
-                        continue
+            paths.add(path)
+            for s_id in self._file_cache.load(path, json.load):
+                s_id=s_id.replace('#', '')
+
+                if s_id in ext_streamlist:
+                    continue
+
+                if len(s_id) == 0 or s_id.isspace():
+                    continue
+
+                ext_streamlist[s_id]=None
+                if s_id not in new_config:
+                    new_config[s_id]=stream_config(
+                        stream_id=s_id,
+                        qid='audio_only',
+                        qlist='audio_only',
+                        retries=config['retry_count']
+                    )
+        self._file_cache.retain(paths)
 
-                    self.ext_streamlist.append(s_id)
-                    if s_id not in self.stream_config:
-                        s_config=stream_config(
-                            stream_id=s_id,
-                            qid='audio_only',
-                            qlist='audio_only',
-                            retries=self.config['retry_count']
-                        )
+        return new_config, list(ext_streamlist.keys())
 
-                        add_stream(s_config)
+    """
+    switch to new_config, touching only the streams which were added, removed or changed;
+    returns those stream IDs
+    """
+    def apply_stream_config(self, new_config):
+        old_config=self.stream_config
+        diff={
+            'added': [s_id for s_id in new_config if s_id not in old_config],
+            'removed': [s_id for s_id in old_config if s_id not in new_config],
+            'changed': [
+                s_id for s_id, c in new_config.items()
+                if s_id in old_config and old_config[s_id] != c
+            ],
+        }
+
+        # unchanged streams keep their config object, which running tasks refer to
+        for s_id, c in new_config.items():
+            if s_id in old_config and old_config[s_id] == c:
+                new_config[s_id]=old_config[s_id]
+        self.stream_config=new_config
+
+        # locks are keyed like stream_state (see try_stream); a lock is kept for as long as it
+        # may be in use
+        for s_id in new_config:
+            self.stream_lock.setdefault(s_id.lower(), asyncio.Lock())
+        for s_id in diff['removed']:
+            k=s_id.lower()
+            if k in self.stream_lock and k not in self.stream_state and not self.stream_lock[k].locked():
+                del self.stream_lock[k]
+
+        for s_id in diff['added'] + diff['removed'] + diff['changed']:
+            self._logger.debug(f'load_config: {s_id}: {old_config.get(s_id)} -> {new_config.get(s_id)}')
+
+        self.update_poll_tasks(diff['removed'] + diff['changed'])
+        return diff
 
-        #print(self.config)
-        self._logger.info('successfully loaded config and ext-streamlist')
-        
     async def online_handler(self, request, match):
         try:
             stream=match['stream']
@@ -168,110 +414,328 @@ class manager():
             # TODO dump request
 
         self._logger.debug(f'online_handler: {stream}')
+        forwarded=await self.forward_signal(request, 'online', stream)
+        if forwarded is not None:
+            return forwarded
+
+        if self.poll_model is not None and stream in self.stream_config and not self.supervisor.active(stream.lower()):
+            self.poll_model.missed(stream)
+
         if stream in self.stream_config:
-            self.awaitables.append(asyncio.create_task(self.try_stream(self.stream_config[stream], False)))
+            # during a poll attempt, the online attempt follows it
+            self.spawn_stream(self.stream_config[stream], False, follow_up=True)
         else:
             self._logger.info(f'online_handler({stream}): not configured, ignoring')
 
         return {}
 
+    """
+    stop retrying: a download in progress is allowed to finish (the stream is ending anyway),
+    after which its files are moved to completed_dir as if all retries had been used
+    """
     async def offline_handler(self, request, match):
-        try:
-            s_id=match['stream']
-        except KeyError:
-            self._logger.error('offline_handler: no stream provided')
+        s_id=match['stream'].lower()
 
-        # TODO stop retries
-        return {}
+        forwarded=await self.forward_signal(request, 'offline', s_id)
+        if forwarded is not None:
+            return forwarded
+
+        if not self.supervisor.stop(s_id):
+            self._logger.info(f'offline_handler({s_id}): no active download')
+            return {'stopped': False}
 
+        state=self.stream_state.get(s_id)
+        if state is None or state.pid is None:
+            # nothing running (waiting for a slot, or between retries): no need to wait
+            self.supervisor.cancel(s_id)
+        self._logger.info(f'offline_handler({s_id}): stopping retries')
+        return {'stopped': True}
+
+    # stop retrying and kill the current download's process group
     async def kill_handler(self, request, match):
-        try:
-            s_id=match['stream']
-        except KeyError:
-            self._logger.error('kill_handler: no stream provided')
+        s_id=match['stream'].lower()
 
-        # TODO kill process
-        return {}
+        forwarded=await self.forward_signal(request, 'kill', s_id)
+        if forwarded is not None:
+            return forwarded
+
+        state=self.stream_state.get(s_id)
+        if not self.supervisor.stop(s_id):
+            self._logger.info(f'kill_handler({s_id}): no active download')
+            return {'killed': False}
 
+        if state is not None and state.pid is not None:
+            self._logger.info(f'kill_handler({s_id}): killing process group {state.pid}')
+            self.monitor.kill(s_id, state.pid)
+        else:
+            self.supervisor.cancel(s_id)
+        return {'killed': True}
+
+    """
+    start try_stream for s_config unless the stream already has a task (see supervisor.spawn)
+    """
+    def spawn_stream(self, s_config, poll_attempt, follow_up=False):
+        s_id=s_config.stream_id.lower()
+        if follow_up and s_id in self.stream_state and not self.stream_state[s_id].poll_attempt:
+            # already an online attempt, which goes through all retries anyway
+            follow_up=False
+
+        return self.supervisor.spawn(
+            s_id,
+            lambda: self.try_stream(s_config, poll_attempt),
+            follow_up=follow_up,
+        )
+
+    # served from the cached serialization, see statefeed.py
     async def state_handler(self, request, match):
-        self._logger.info(f'state_handler')
-        return self.stream_state
+        return await self.state_feed.get(request, match)
 
 
+    """
+    values which are kept elsewhere anyway, read when /metrics is scraped
+    """
+    def collect_metrics(self, m):
+        for kind, n in self.supervisor.counts().items():
+            m.set('stream_manager_supervised', 'tasks held by the supervisor', n, (('kind', kind),))
+        for event, n in self.supervisor.stats.items():
+            m.counter('stream_manager_supervisor_total', 'stream task events', n, (('event', event),))
+        m.set('stream_manager_tasks', 'tasks on the event loop', len(asyncio.all_tasks()))
+        m.set('stream_manager_loop_lag_max_seconds', 'largest event loop lag since start', self.loop_lag.max)
+        m.set('stream_manager_streams', 'streams with state (downloading or being attempted)', len(self.stream_state))
+
+        for s_id, st in self.stream_state.items():
+            m.set('stream_manager_stream_retry_id', 'current retry of a stream', st.retry_id, (('stream', s_id),))
+
+        s=self.state.stats
+        m.counter('stream_manager_state_marks_total', 'state changes marked for writing', s['marked'])
+        m.counter('stream_manager_state_writes_total', 'state writes to state_path', s['written'])
+        m.counter('stream_manager_state_write_bytes_total', 'bytes of state written', s['write_bytes_total'])
+        m.counter('stream_manager_state_write_seconds_total', 'time spent writing state', s['write_sec_total'])
+        m.set('stream_manager_state_last_write_bytes', 'size of the last state write', s['last_write_bytes'])
+
+        if self.state.replicator is not None:
+            r=self.state.replicator.stats
+            for result in ('sent_full', 'sent_delta', 'failed', 'dropped', 'superseded'):
+                m.counter('stream_manager_replication_total', 'state replication to state_url by result',
+                    r[result], (('result', result),))
+            m.counter('stream_manager_replication_bytes_total', 'bytes sent to state_url', r['bytes_total'])
+            m.counter('stream_manager_replication_seconds_total', 'time spent in successful requests to state_url', r['latency_sec_total'])
+            m.set('stream_manager_replication_last_seconds', 'latency of the last successful request to state_url', r['last_latency_sec'])
+
+        for kind, l in self.scheduler.stats().items():
+            if not isinstance(l, dict):
+                continue
+            m.set('stream_manager_scheduler_active', 'slots in use', l['active'], (('kind', kind),))
+            for lane, n in l['queued'].items():
+                m.set('stream_manager_scheduler_queued', 'waiters for a slot', n, (('kind', kind), ('lane', lane)))
+
+        health=self.monitor.stats()
+        m.counter('stream_manager_stall_kills_total', 'downloads killed for not making progress', health['kills'])
+        for s_id, d in health['streams'].items():
+            m.set('stream_manager_download_bytes_per_second', 'download throughput (moving average)',
+                d['bytes_per_sec'], (('stream', s_id),))
+            m.set('stream_manager_download_bytes', 'size of the current download', d['bytes'], (('stream', s_id),))
+
+        if self.cluster is not None:
+            c=self.cluster.counters
+            m.set('stream_manager_cluster_live_nodes', 'nodes this node considers live', len(self.cluster.live))
+            m.counter('stream_manager_cluster_adopted_total', 'streams taken over from dead nodes', c['adopted'])
+            m.counter('stream_manager_cluster_forwarded_total', 'stream signals forwarded to their owner', c['forwarded'])
+            m.counter('stream_manager_cluster_renew_failures_total', 'failed lease renewals', c['renew_failures'])
+
+        if self.poll_model is not None:
+            c=self.poll_model.counters
+            m.counter('stream_manager_polls_total', 'poll attempts started by poll tasks', c['polls'])
+            m.counter('stream_manager_poll_detections_total', 'streams found online, by how',
+                c['detected_by_poll'], (('by', 'poll'),))
+            m.counter('stream_manager_poll_detections_total', 'streams found online, by how',
+                c['missed_by_poll'], (('by', 'signal'),))
+
+        if self.log_pipeline is not None:
+            l=self.log_pipeline.stats()
+            m.set('stream_manager_log_queue_depth', 'log records waiting to be written', l['queue_depth'])
+            m.counter('stream_manager_log_records_total', 'log records by outcome', l['queued'], (('outcome', 'queued'),))
+            m.counter('stream_manager_log_records_total', 'log records by outcome', l['dropped'], (('outcome', 'dropped'),))
+            m.counter('stream_manager_log_records_total', 'log records by outcome', l['sampled_out'], (('outcome', 'sampled_out'),))
+
+        if self.engine is not None:
+            e=self.engine.stats()
+            for status, n in e['workers'].items():
+                m.set('stream_manager_engine_workers', 'download engine workers by status', n, (('status', status),))
+            m.counter('stream_manager_engine_recordings_total', 'recordings started in engine workers', e['recordings'])
+            m.counter('stream_manager_engine_failed_total', 'engine recordings which ended with an error', e['failed'])
+            m.counter('stream_manager_engine_bytes_total', 'bytes written by engine recordings', e['bytes'])
+            m.set('stream_manager_engine_fallback_streams', 'streams recorded with download_script instead of the engine', len(e['fallback']))
+
+        if self.admission is not None:
+            a=self.admission.stats()
+            for fs in a['filesystems']:
+                if fs['free_bytes'] is None:
+                    continue
+                m.set('stream_manager_disk_free_bytes', 'free space on the download filesystems', fs['free_bytes'], (('path', fs['path']),))
+                m.set('stream_manager_disk_inflow_bytes_per_second', 'rate at which free space goes down (moving average)',
+                    fs['inflow_bytes_per_sec'], (('path', fs['path']),))
+            for action in (admission.ADMIT, admission.DOWNGRADE, admission.REFUSE):
+                m.counter('stream_manager_admission_total', 'admission decisions for new sessions', a[action], (('action', action),))
+            m.counter('stream_manager_admission_poll_refused_total', 'poll attempts skipped for lack of disk space', a['poll_refused'])
+
+        if self.pipeline is not None:
+            pipeline_stats=self.pipeline.stats()
+            for name, st in pipeline_stats.items():
+                if not isinstance(st, dict) or 'queue' not in st:
+                    continue
+                for status, n in st['queue'].items():
+                    m.set('stream_manager_pipeline_jobs', 'pipeline jobs by stage and status', n,
+                        (('stage', name), ('status', status)))
+                m.counter('stream_manager_pipeline_errors_total', 'failed pipeline jobs by stage', st['errors'], (('stage', name),))
+            enc=pipeline_stats['encoding']
+            for preset, speed in enc['speed'].items():
+                m.set('stream_manager_convert_speed_bytes', 'measured input bytes per second of a conversion job, by x265 preset',
+                    speed, (('preset', preset),))
+            m.counter('stream_manager_convert_preset_changes_total', 'x265 preset changes, by direction', enc['faster'], (('direction', 'faster'),))
+            m.counter('stream_manager_convert_preset_changes_total', 'x265 preset changes, by direction', enc['slower'], (('direction', 'slower'),))
+            m.counter('stream_manager_convert_input_bytes_total', 'bytes of recordings converted', enc['input_bytes'])
+            m.counter('stream_manager_convert_output_bytes_total', 'bytes of conversion output', enc['output_bytes'])
+
+
+    # marks the state dirty; the actual write happens in the background (see state.mark_dirty)
     async def write_state(self):
-        await self.state.write(self.stream_state, state_path=self.config['state_path'], state_url=self.config['state_url'])
+        self.state.mark_dirty(self.stream_state)
 
 
     async def start_http_server(self):
 
         async def reload_handler(request, match):
-            self.load_config()
-            return {}
+            return self.load_config()
 
         async def ext_streamlist_handler(request, match):
             return self.ext_streamlist
 
+        async def scheduler_handler(request, match):
+            return self.scheduler.stats()
 
-        router=aiohttp.web.UrlDispatcher()
-        router.add_routes([
-            web.post('/online/{stream}', self.online_handler),
-            #web.post('/offline/{stream}', self.online_handler), TODO
-            #web.post('/kill/{stream}', self.online_handler), TODO
-            web.get('/state', self.state_handler),
-            web.get('/ext-streamlist', ext_streamlist_handler),
-            web.post('/reload', reload_handler),
-        ])
+        async def health_handler(request, match):
+            return self.monitor.stats()
 
-        def to_json(data):
-            return json.dumps(data, indent=4, cls=json_encoder)+"\n"
+        async def metrics_handler(request, match):
+            return web.Response(
+                text=self.metrics.render(),
+                headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+            )
 
-        async def handler(request):
-            match=await router.resolve(request)
-            if match.http_exception:
-                return aiohttp.web.Response(text='', status=match.http_exception.status)
-            
-            try:
-                ret=await match.handler(request, match)
-            except Exception as e:
-                print(traceback.format_exc())
-                return aiohttp.web.Response(text=to_json({
-                    'error': str(e),
-                }), status=500)
+        async def cluster_handler(request, match):
+            if self.cluster is None:
+                return {}
+            return self.cluster.stats()
 
-            return aiohttp.web.Response(text=to_json(ret), status=200)
+        async def polling_handler(request, match):
+            if self.poll_model is None:
+                return {}
+            return self.poll_model.stats()
 
+        async def admission_handler(request, match):
+            if self.admission is None:
+                return {}
+            return self.admission.stats()
 
-        server = web.Server(handler)
-        runner = web.ServerRunner(server)
-        await runner.setup()
-        x = web.TCPSite(runner, str(self._listen_addr), self._listen_port)
-        await x.start()
+        async def engine_handler(request, match):
+            if self.engine is None:
+                return {}
+            return self.engine.stats()
 
-    """
-    TODO
-    Detect a streamlink (shell script) instance which has stalled in some way.
-    Specifically: kill the process if there have not been any recent data, AND no
-    recent retries. 
-    
-    normally, when there isn't any recent data (file modification is not recent), 
-    streamlink will fail and exit, which is our signal to invoke a retry.
-    if this doesn't happen, we need to kill the "stale" process manually
-    """
-    async def stream_healthcheck_task(self, s_id):
-        while True:
-            if s_id not in self.stream_config:
-                break
+        async def logging_handler(request, match):
+            if self.log_pipeline is None:
+                return {}
+            return self.log_pipeline.stats()
 
-            await asyncio.sleep(60)
-        
-            
-        
+        async def pipeline_handler(request, match):
+            if self.pipeline is None:
+                return {}
+            return self.pipeline.stats()
+
+
+        self.state_feed=state_feed(self.state, lambda: self.stream_state)
+
+        self.http_server=http_server(self._listen_addr, self._listen_port)
+        self.http_server.add_routes([
+            web.post('/online/{stream}', self.online_handler),
+            web.post('/offline/{stream}', self.offline_handler),
+            web.post('/kill/{stream}', self.kill_handler),
+            web.get('/state', self.state_handler),
+            web.get('/state/events', self.state_feed.events),
+            web.get('/state/{stream}', self.state_feed.get_stream),
+            web.get('/ext-streamlist', ext_streamlist_handler),
+            web.get('/scheduler', scheduler_handler),
+            web.get('/health', health_handler),
+            web.get('/pipeline', pipeline_handler),
+            web.get('/admission', admission_handler),
+            web.get('/engine', engine_handler),
+            web.get('/logging', logging_handler),
+            web.get('/cluster', cluster_handler),
+            web.get('/polling', polling_handler),
+            web.get('/metrics', metrics_handler),
+            web.post('/reload', reload_handler),
+        ])
+        await self.http_server.start()
+
+    # where try_stream moves finished recordings: with session assembly (see assemble.py), they
+    # are merged first, by the pipeline or by stream_manager.assemble from cron
+    def completed_dir(self):
+        if self.config['assemble'] is not None:
+            return self.config['assemble']['in_dir']
+        return self.config['completed_dir']
 
     def video_path(self, directory, s_config, state, retry_id):
         video_filename=f'{s_config.stream_id}_{s_config.qid}_{state.datestr}_{retry_id}.mkv'
         video_path=os.path.join(directory, video_filename)
         return video_path
 
+    # scheduler lane for a download attempt
+    def lane(self, state, poll_attempt):
+        if not poll_attempt:
+            return 'online'
+        elif state.resumed:
+            return 'resume'
+        return 'poll'
+
+    """
+    start a download with args (stream, qlist, path, log_path, list of extra streamlink
+    arguments): with the engine (see engine.py) in one of its workers, otherwise by starting
+    download_script in its own session, so its PID is also its process group ID. returns an
+    asyncio.subprocess.Process or engine_download (or anything with pid and wait(), see
+    test/fleet_bench.py)
+    """
+    async def spawn_download(self, s_id, args):
+        if self.engine is not None and self.engine.available(s_id):
+            d=await self.engine.spawn(s_id, args)
+            if d is not None:
+                return d
+
+        # download_script takes the extra arguments as one word-split argument
+        *args, extra=args
+        # TODO need a debug mode where stdout, stderr are visible
+        return await asyncio.create_subprocess_exec(
+            self.config['download_script'],
+            *args,
+            ' '.join(extra),
+            stdout=subprocess.DEVNULL,  
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    # wait until a download process has exited (the future exited is done), or its file at path
+    # has data, whichever comes first; returns whether the file has data
+    async def wait_live(self, exited, path):
+        while True:
+            done, pending=await asyncio.wait([exited], timeout=LIVE_CHECK_INTERVAL)
+            try:
+                if os.stat(path).st_size > 0:
+                    return True
+            except FileNotFoundError:
+                pass
+            if len(done) > 0:
+                return False
+
     """
     poll_attempt (formerly "retry_if_empty"): if False, we will process retries even if there was no file created
         or that file is empty after the dowload process exits
@@ -280,6 +744,7 @@ class manager():
     """
     async def try_stream(self, s_config, poll_attempt):
         s_id=s_config.stream_id.lower()
+        logs.set_context(stream_id=s_id, poll=poll_attempt)
 
         retry_id=0
 
@@ -292,7 +757,36 @@ class manager():
         await self.stream_lock[s_id].acquire()
 
 
+        # admission decision for a poll attempt, recorded once it turns out to be live
+        decision=None
         if s_id not in self.stream_state:
+            # a new session: check that there is room for it (see admission.py)
+            if self.admission is not None:
+                decision=self.admission.check(s_config, 'poll' if poll_attempt else 'online')
+                action=decision['action']
+                if action == admission.REFUSE or not poll_attempt:
+                    self.admission.record(decision)
+                    decision=None
+                if action == admission.REFUSE:
+                    if poll_attempt:
+                        self._logger.debug(f'try_stream({s_id}): not enough disk space, skipping poll attempt')
+                    else:
+                        self._logger.warning(f'try_stream({s_id}): not enough disk space, refusing to start')
+                    self.stream_lock[s_id].release()
+                    return
+                elif action == admission.DOWNGRADE:
+                    msg=f'try_stream({s_id}): low on disk space, recording audio_only instead of {s_config.qid}'
+                    if poll_attempt:
+                        self._logger.debug(msg)
+                    else:
+                        self._logger.warning(msg)
+                    s_config=stream_config(
+                        stream_id=s_config.stream_id,
+                        qid='audio_only',
+                        qlist='audio_only',
+                        retries=s_config.retries
+                    )
+
             datestr=datetime.datetime.now().isoformat()
             log_filename=f'{s_config.stream_id}_{s_config.qid}_{datestr}'
             log_path=os.path.join(self.config['download_log_dir'], log_filename)
@@ -311,9 +805,23 @@ class manager():
         retry_id=self.stream_state[s_id].retry_id
         state=self.stream_state[s_id]
 
+        # a session which was downgraded when it started stays audio_only
+        if state.config.qid == 'audio_only' and s_config.qid != 'audio_only':
+            s_config=state.config
+
+        # cancelled by the shutdown of this instance (see supervisor.shutdown), rather than by /kill
+        shutdown=False
         try:
             while retry_id <= s_config.retries:
+                if self.supervisor.stopping(s_id):
+                    self._logger.info(f'try_stream({s_id}): stopped before retry_id={retry_id}')
+                    break
+
+                # only the first attempt of a poll is speculative (see logs.py)
+                logs.set_context(stream_id=s_id, retry_id=retry_id,
+                    poll=poll_attempt and retry_id == 0 and not state.resumed)
                 self._logger.info(f'try_stream({s_id}): attempting download (retry_id={retry_id})')
+                attempt_start=time.time()
 
                 video_path_thistry=self.video_path(self.config['download_dir'], s_config, state, retry_id)
 
@@ -330,34 +838,54 @@ class manager():
 
                     if 'streamlink_args' in self.config and s_id in self.config['streamlink_args']:
                         extra_args=self.config['streamlink_args'][s_id]
-                        args.append(extra_args)
+                        if isinstance(extra_args, str):
+                            extra_args=extra_args.split()
+                        args.append(list(extra_args))
                         self._logger.info(f'try_stream({s_id}): extra arguments for streamlink: {extra_args}')
                     else:
-                        args.append('')
-
-                    # TODO need a debug mode where stdout, stderr are visible
-                    proc_obj=await asyncio.create_subprocess_exec(
-                        self.config['download_script'],
-                        *args,
-                        stdout=subprocess.DEVNULL,  
-                        stderr=subprocess.DEVNULL,
-                        start_new_session=True
-                    )
-
-                    self.stream_state[s_id].pid=proc_obj.pid
-                    await self.write_state()
+                        args.append([])
+
+                    async with contextlib.AsyncExitStack() as slots:
+                        # a first poll attempt is speculative: it is rate limited and also
+                        # counts against the probe limit, until it turns out to be live
+                        probe=None
+                        if poll_attempt and retry_id == 0 and not state.resumed:
+                            await self.scheduler.poll_ticket()
+                            probe=await slots.enter_async_context(contextlib.AsyncExitStack())
+                            await probe.enter_async_context(self.scheduler.slot('probe', 'poll'))
+                        await slots.enter_async_context(self.scheduler.slot('download', self.lane(state, poll_attempt)))
+
+                        t=time.monotonic()
+                        proc_obj=await self.spawn_download(s_id, args)
+                        self.metrics.observe('stream_manager_spawn_seconds',
+                            'time taken to start a download process', time.monotonic() - t)
+
+                        self.stream_state[s_id].pid=proc_obj.pid
+                        await self.write_state()
 
-                    await proc_obj.wait()
+                        self.monitor.watch(s_id, video_path_thistry, proc_obj.pid)
+                        exited=asyncio.ensure_future(proc_obj.wait())
+                        try:
+                            if probe is not None:
+                                if await self.wait_live(exited, video_path_thistry) and decision is not None:
+                                    self.admission.record(decision)
+                                    decision=None
+                                # from here on it's a download, which only takes a download slot
+                                await probe.aclose()
+                            await exited
+                        finally:
+                            exited.cancel()
+                            self.monitor.unwatch(s_id)
                 else:
-                    # poll the process
-                    self._logger.debug(f'try_stream({s_id}): polling on existing process {state.pid}')
-                    while True:
+                    # the process is already running, so it takes a download slot regardless of the limit
+                    async with self.scheduler.slot('download', 'resume', force=True):
+                        self._logger.debug(f'try_stream({s_id}): waiting on existing process group {state.pid}')
+                        self.monitor.watch(s_id, video_path_thistry, state.pid)
                         try:
-                            os.kill(state.pid, 0)
-                        except:
-                            self._logger.debug(f'try_stream({s_id}): existing process {state.pid} exited, continuing retries')
-                            break
-                        await asyncio.sleep(1)
+                            await self.process_watcher.wait_group(state.pid)
+                        finally:
+                            self.monitor.unwatch(s_id)
+                        self._logger.debug(f'try_stream({s_id}): existing process group {state.pid} exited, continuing retries')
 
 
                 self._logger.debug(f'try_stream({s_id}): process {state.pid} exited, removing PID')
@@ -375,6 +903,19 @@ class manager():
                 except FileNotFoundError: 
                     empty=True
 
+                self.metrics.inc('stream_manager_download_attempts_total',
+                    'finished download attempts by stream and outcome',
+                    (('stream', s_id), ('outcome', 'empty' if empty else 'data')))
+
+                if self.poll_model is not None and not empty:
+                    self.poll_model.observe(s_id, attempt_start, time.time())
+                    if poll_attempt and retry_id == 0 and not state.resumed:
+                        gap=self.poll_model.detected(s_id)
+                        if gap is not None:
+                            self.metrics.observe('stream_manager_poll_detection_gap_seconds',
+                                'time between the poll attempt which found a stream online and the one before it',
+                                gap, buckets=POLL_GAP_BUCKETS)
+
                 if empty:
                     self._logger.warning(f'try_stream({s_id}): file is empty or does not exist (retry_id={retry_id})')
                     if not poll_attempt:
@@ -384,9 +925,11 @@ class manager():
                         break
                 else:
                     retry_id += 1
+        except asyncio.CancelledError:
+            shutdown=not self.supervisor.stopping(s_id)
+            raise
         except Exception as e:
-            self._logger.error(f'try_stream({s_id}): exception: {e}')
-            print(traceback.format_exc())
+            self._logger.error(f'try_stream({s_id}): exception: {e}', exc_info=True)
             raise e
         except KeyboardInterrupt:
             exit(0)
@@ -394,13 +937,22 @@ class manager():
             # all retries have been exhausted, or there was an exception
 
             try: 
-                # if true, all retries have been exhausted, so we are done
-                if retry_id == s_config.retries + 1:
+                if shutdown:
+                    # the download keeps running: its state (and pid) is kept, and nothing is
+                    # moved, so the next instance resumes it (see resume_stream)
+                    if state.pid is None and poll_attempt and retry_id == 0 and not state.resumed:
+                        # except a speculative poll attempt which hadn't started a download yet
+                        del self.stream_state[s_id]
+                        await self.write_state()
+                    else:
+                        self._logger.info(f'try_stream({s_id}): shutting down, leaving retry_id={retry_id} (pid {state.pid}) to the next instance')
+                # if true, all retries have been exhausted (or we were told to stop), so we are done
+                elif retry_id == s_config.retries + 1 or self.supervisor.stopping(s_id):
                     # this should never happen
                     if state.pid is not None:
                         try:
                             pid=state.pid
-                            os.kill(pid)
+                            os.killpg(pid, signal.SIGTERM)
                             self._logger.debug(f'try_stream({s_id}): killed {pid}')
                         except Exception as e:
                             self._logger.warning(f'try_stream({s_id}): unable to kill {pid}: {e}')
@@ -410,21 +962,29 @@ class manager():
 
                     # don't bother keeping track of which retries were successful (generated data on disk) or not; 
                     # try moving all of them
-                    for i in range(0, retry_id):
+                    # (when stopped, the current retry may have produced a file too)
+                    attempted=min(retry_id + 1, s_config.retries + 1)
+                    completed_dir=self.completed_dir()
+                    failed=[]
+                    moved=[]
+                    for i in range(0, attempted):
                         download_path=self.video_path(self.config['download_dir'], s_config, state, i)
-                        completed_path=self.video_path(self.config['completed_dir'], s_config, state, i)
-                        failed=[]
+                        completed_path=self.video_path(completed_dir, s_config, state, i)
                         try:
                             os.rename(download_path, completed_path)
                             self._logger.debug(f'try_stream({s_id}): moved {download_path} -> {completed_path}')
+                            moved.append(completed_path)
                         except OSError as e:
                             failed.append((i, e))
 
-                        # if not a single move was successful, something is wrong
-                        # (we went through all s_config.retries # of retries, meaning an "online" signal was generated,
-                        # but not a single file was written to disk)
-                        if len(failed) == retry_id + 1:
-                            self._logger.error(f'try_stream: could not move to completed: {failed}')
+                    if self.pipeline is not None and len(moved) > 0:
+                        self.pipeline.downloaded(moved)
+
+                    # if not a single move was successful, something is wrong
+                    # (we went through all s_config.retries # of retries, meaning an "online" signal was generated,
+                    # but not a single file was written to disk)
+                    if len(failed) == attempted:
+                        self._logger.error(f'try_stream: could not move to completed: {failed}')
                 else:
                     # it was just a failed poll attempt (normal)
                     if state.poll_attempt == True:
@@ -442,21 +1002,138 @@ class manager():
 
 
 
-    async def poll_task(self, s_config, interval):
+    """
+    stop: set when the stream is removed or its config changes (see update_poll_tasks); an
+    attempt in progress is allowed to finish
+    """
+    async def poll_task(self, s_config, interval, stop):
         def jitter(interval):
-            return random.randint(0, interval)
+            return random.randint(0, int(interval))
 
-        blocklist=self.config['blocklist']
-        if s_config.stream_id in blocklist:
-            self._logger.warning(f'poll_task: stream {s_config.stream_id} in blocklist, skipping')
+        async def sleep(t):
+            try:
+                await asyncio.wait_for(stop.wait(), t)
+            except asyncio.TimeoutError:
+                pass
+            return stop.is_set()
+
+        def next_interval():
+            if self.poll_model is None:
+                return interval
+            return self.poll_model.interval(s_config.stream_id)
+
+        # with the poll model, the interval changes over time (see pollmodel.py), so it is
+        # checked again every reallocate_interval
+        async def wait(since):
+            while True:
+                remaining=since + next_interval() - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if self.poll_model is not None:
+                    remaining=min(remaining, self.poll_model.reallocate_interval)
+                if await sleep(remaining):
+                    return True
+
+        if await sleep(jitter(next_interval())):
             return
+        while True:
+            logs.set_context(stream_id=s_config.stream_id.lower(), poll=True)
+            if not self.owns(s_config.stream_id):
+                self._logger.debug(f'poll_task: {s_config.stream_id} is owned by another node, skipping')
+            else:
+                self._logger.info(f'poll_task: trying {s_config.stream_id}')
+                if self.poll_model is not None:
+                    self.poll_model.polled(s_config.stream_id)
+                # skipped if the stream already has a download task
+                await self.supervisor.run(
+                    s_config.stream_id.lower(), lambda: self.try_stream(s_config, True)
+                )
+            if await wait(time.monotonic()):
+                self._logger.info(f'poll_task: stopped polling {s_config.stream_id}')
+                return
+
+    # streams which poll tasks attempt (the poll model divides its budget among them)
+    def polled_streams(self):
+        blocklist=self.config['blocklist'] or []
+        return [s_id for s_id in self.stream_config if s_id not in blocklist and self.owns(s_id)]
 
-        await asyncio.sleep(jitter(interval))
+    def start_poll_task(self, s_config):
+        stop=asyncio.Event()
+        task=asyncio.create_task(self.poll_task(s_config, self._poll_interval, stop))
+        self.poll_tasks[s_config.stream_id]=(task, stop)
+        self.supervisor.add_service(task, f'poll_task({s_config.stream_id})')
+
+    """
+    make the per-stream poll tasks match the config: stop the ones for streams which were
+    removed, blocklisted or restarted (changed config), and start any which are missing
+    """
+    def update_poll_tasks(self, restart=()):
+        if self._poll_interval is None or not self.status_probe.spawns:
+            return
+
+        blocklist=self.config['blocklist'] or []
+        for s_id in list(self.poll_tasks.keys()):
+            if s_id not in self.stream_config or s_id in blocklist or s_id in restart:
+                task, stop=self.poll_tasks.pop(s_id)
+                stop.set()
+
+        for s_id, s_config in self.stream_config.items():
+            if s_id in blocklist:
+                continue
+            if s_id not in self.poll_tasks:
+                self.start_poll_task(s_config)
+
+    """
+    instead of running download_script for every stream, check all of them in batches with the
+    configured status probe, and only call try_stream for the ones which are live
+    """
+    async def probe_task(self, interval):
+        await asyncio.sleep(random.randint(0, interval))
         while True:
-            self._logger.info(f'poll_task: trying {s_config.stream_id}')
-            await self.try_stream(s_config, True)
+            blocklist=self.config['blocklist'] or []
+
+            # streams with state are already being downloaded (or attempted)
+            s_ids=[
+                s_id for s_id in self.stream_config.keys()
+                if s_id not in blocklist and s_id.lower() not in self.stream_state and self.owns(s_id)
+            ]
+
+            try:
+                async with self.scheduler.slot('probe', 'poll'):
+                    status=await self.status_probe.probe(s_ids)
+            except Exception as e:
+                self._logger.error(f'probe_task: exception: {e}', exc_info=True)
+                status={}
+
+            live=[s_id for s_id, online in status.items() if online]
+            unknown=sum(1 for online in status.values() if online is None)
+            self._logger.info(f'probe_task: probed {len(s_ids)} streams: {len(live)} live, {unknown} unknown')
+
+            for s_id in live:
+                if s_id in self.stream_config:
+                    self.spawn_stream(self.stream_config[s_id], True)
+
             await asyncio.sleep(interval)
 
     async def spawn_poll_tasks(self, interval):
-        for s_id, s_config in self.stream_config.items():
-            self.awaitables.append(asyncio.create_task(self.poll_task(s_config, interval)))
+        self.status_probe=make_status_probe(self.config['status_probe'])
+
+        self._poll_interval=interval
+        if self.status_probe.spawns:
+            if self.config['adaptive_poll'] is not None:
+                self.poll_model=poll_model(
+                    self.config['adaptive_poll'],
+                    self.polled_streams,
+                    interval,
+                    os.path.join(os.path.dirname(os.path.abspath(self.config['state_path'])), 'poll_history.json'),
+                )
+                self.poll_model.load()
+                self.supervisor.add_service(self.poll_model.start(), 'poll_model')
+
+            blocklist=self.config['blocklist'] or []
+            for s_id in blocklist:
+                if s_id in self.stream_config:
+                    self._logger.warning(f'poll_task: stream {s_id} in blocklist, skipping')
+            self.update_poll_tasks()
+        else:
+            self.supervisor.add_service(asyncio.create_task(self.probe_task(interval)), 'probe_task')
@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from stream_manager.common import parse_video_filename
+
+"""
+local record of everything the archive sync has uploaded (or started uploading)
+
+each file gets a row with its size, SHA-256 (computed while streaming the upload), encrypted
+key, storage class and status. this makes sync:
+- resumable: a multipart upload's ID and finished parts are recorded as they complete, so an
+  interrupted upload continues from the next part instead of starting over
+- dedup-aware: a file whose name, size and checksum match an archived one is not uploaded again
+- searchable: the stream, quality and date parsed from the file name are stored alongside the
+  encrypted key, so "what's archived for stream X on date Y" needs no bucket listing or key
+  decryption
+
+the manifest is shared by the upload threads; access is serialized with a lock.
+"""
+
+class ManifestError(Exception):
+    pass
+
+
+PENDING='pending'
+UPLOADING='uploading'
+DONE='done'
+FAILED='failed'
+
+class manifest():
+
+    def __init__(self, path) -> None:
+        self._lock=threading.Lock()
+        self._db=sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory=sqlite3.Row
+        with self._lock:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS uploads (
+                    path TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    stream TEXT,
+                    qid TEXT,
+                    datestr TEXT,
+                    retry_id INTEGER,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT,
+                    etag TEXT,
+                    key TEXT NOT NULL,
+                    storage_class TEXT,
+                    status TEXT NOT NULL,
+                    upload_id TEXT,
+                    parts TEXT,
+                    error TEXT,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS uploads_stream_date ON uploads (stream, datestr);
+                CREATE INDEX IF NOT EXISTS uploads_name ON uploads (name);
+            ''')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            cur=self._db.execute(sql, args)
+            self._db.commit()
+            return cur.fetchall()
+
+    def get(self, path):
+        rows=self._execute('SELECT * FROM uploads WHERE path=?', (path,))
+        return dict(rows[0]) if len(rows) > 0 else None
+
+    """
+    an archived copy of a file with the same name and size, if any (its checksum still has to
+    be compared before skipping the upload)
+    """
+    def archived(self, name, size):
+        rows=self._execute(
+            'SELECT * FROM uploads WHERE name=? AND size=? AND status=?', (name, size, DONE)
+        )
+        return [dict(r) for r in rows]
+
+    """
+    record the start of an upload of path, replacing an earlier unfinished one. raises
+    ManifestError if path was already archived: its record is the only one of that object
+    """
+    def begin(self, path, key, size, storage_class):
+        parsed=parse_video_filename(path) or {}
+        with self._lock:
+            row=self._db.execute('SELECT status, key FROM uploads WHERE path=?', (path,)).fetchone()
+            if row is not None and row['status'] == DONE:
+                raise ManifestError(f'{path} was already archived as {row["key"]} with different content')
+            self._db.execute('''
+                INSERT OR REPLACE INTO uploads
+                    (path, name, stream, qid, datestr, retry_id, size, key, storage_class, status, parts, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                path, os.path.basename(path), parsed.get('stream'), parsed.get('qid'),
+                parsed.get('datestr'), parsed.get('retry_id'), size, key, storage_class, UPLOADING,
+                '[]', time.time(),
+            ))
+            self._db.commit()
+
+    def set_upload_id(self, path, upload_id):
+        self._execute(
+            'UPDATE uploads SET upload_id=?, parts=?, updated=? WHERE path=?',
+            (upload_id, '[]', time.time(), path),
+        )
+
+    # record a finished part of a multipart upload: {'PartNumber', 'ETag', 'md5'}
+    def add_part(self, path, part):
+        with self._lock:
+            row=self._db.execute('SELECT parts FROM uploads WHERE path=?', (path,)).fetchone()
+            parts=json.loads(row['parts'] or '[]')
+            parts.append(part)
+            self._db.execute(
+                'UPDATE uploads SET parts=?, updated=? WHERE path=?',
+                (json.dumps(parts), time.time(), path),
+            )
+            self._db.commit()
+
+    def finish(self, path, etag, sha256):
+        self._execute(
+            'UPDATE uploads SET status=?, etag=?, sha256=?, upload_id=NULL, parts=NULL, error=NULL, updated=? WHERE path=?',
+            (DONE, etag, sha256, time.time(), path),
+        )
+
+    def fail(self, path, error):
+        self._execute(
+            'UPDATE uploads SET status=?, error=?, updated=? WHERE path=?',
+            (FAILED, str(error), time.time(), path),
+        )
+
+    """
+    archived files for a stream, optionally on a date (a prefix of datestr, e.g. 2026-10-18)
+    """
+    def find(self, stream, date=None):
+        if date is None:
+            rows=self._execute(
+                'SELECT * FROM uploads WHERE stream=? AND status=? ORDER BY datestr, retry_id, name',
+                (stream, DONE),
+            )
+        else:
+            rows=self._execute(
+                'SELECT * FROM uploads WHERE stream=? AND datestr LIKE ? AND status=? ORDER BY datestr, retry_id, name',
+                (stream, date.replace('%', '') + '%', DONE),
+            )
+        return [dict(r) for r in rows]
+
+    def stats(self):
+        rows=self._execute('SELECT status, COUNT(*) AS n, SUM(size) AS bytes FROM uploads GROUP BY status')
+        return {r['status']: {'files': r['n'], 'bytes': r['bytes']} for r in rows}
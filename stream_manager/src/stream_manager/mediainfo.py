@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+
+"""
+media metadata from a single ffprobe run per file, cached by (path, size, mtime) so that
+conversion, sidecar generation and upload all reuse the same result instead of probing again.
+
+streams are identified by codec_type rather than by index: a recording doesn't necessarily have
+its video stream at index 1.
+"""
+
+class ProbeError(Exception):
+    pass
+
+
+class media_info():
+
+    def __init__(self, path, raw) -> None:
+        self.path=path
+        # ffprobe's JSON output, as bytes (saved as the .json sidecar)
+        self.raw=raw
+
+        data=json.loads(raw)
+        self.streams=data.get('streams', [])
+        self.format=data.get('format', {})
+
+    def streams_of(self, codec_type):
+        return [s for s in self.streams if s.get('codec_type') == codec_type]
+
+    @property
+    def video(self):
+        v=self.streams_of('video')
+        return v[0] if len(v) > 0 else None
+
+    @property
+    def audio(self):
+        a=self.streams_of('audio')
+        return a[0] if len(a) > 0 else None
+
+    @property
+    def duration(self):
+        try:
+            return float(self.format['duration'])
+        except (KeyError, ValueError):
+            return None
+
+    # start of this file relative to the start of the stream, in seconds
+    @property
+    def start_time(self):
+        try:
+            return float(self.format['start_time'])
+        except (KeyError, ValueError):
+            return None
+
+
+class probe_cache():
+
+    def __init__(self, cache_path=None, ffprobe='ffprobe') -> None:
+        self.ffprobe=ffprobe
+        self.logger=logging.getLogger('stream_manager')
+
+        self._db=sqlite3.connect(cache_path or ':memory:')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS probes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        self._db.commit()
+
+        # paths currently being probed, so concurrent callers share one ffprobe run
+        self._inflight={}
+        self.stats={
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def get(self, path):
+        st=os.stat(path)
+        row=self._db.execute(
+            'SELECT data FROM probes WHERE path=? AND size=? AND mtime_ns=?',
+            (path, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        if row is None:
+            return None
+        return media_info(path, row[0])
+
+    async def probe(self, path):
+        info=self.get(path)
+        if info is not None:
+            self.stats['hits'] += 1
+            return info
+
+        if path in self._inflight:
+            return await asyncio.shield(self._inflight[path])
+
+        self.stats['misses'] += 1
+        fut=asyncio.get_running_loop().create_future()
+        self._inflight[path]=fut
+        try:
+            st=os.stat(path)
+            info=media_info(path, await self._run_ffprobe(path))
+            self._db.execute(
+                'INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, info.raw),
+            )
+            self._db.commit()
+            fut.set_result(info)
+            return info
+        except BaseException as e:
+            fut.set_exception(e)
+            # don't warn about an exception nobody else was waiting for
+            fut.exception()
+            raise
+        finally:
+            del self._inflight[path]
+
+    async def _run_ffprobe(self, path):
+        proc=await asyncio.create_subprocess_exec(
+            self.ffprobe, '-hide_banner', '-v', 'error', '-i', path,
+            '-show_streams', '-show_format', '-print_format', 'json',
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        out, err=await proc.communicate()
+        if proc.returncode != 0:
+            raise ProbeError(f'ffprobe exited with {proc.returncode} for {path}: {err.decode(errors="replace").strip()}')
+        return out
+
+    """
+    carry a cached result over to a file's new path after it was moved (a rename keeps the
+    size and mtime)
+    """
+    def rename(self, src, dst):
+        self._db.execute('UPDATE OR REPLACE probes SET path=? WHERE path=?', (dst, src))
+        self._db.commit()
+
+    # forget results for files which no longer exist
+    def prune(self):
+        paths=[row[0] for row in self._db.execute('SELECT path FROM probes')]
+        gone=[(p,) for p in paths if not os.path.exists(p)]
+        if len(gone) > 0:
+            self._db.executemany('DELETE FROM probes WHERE path=?', gone)
+            self._db.commit()
+        return len(gone)
+
+    def close(self):
+        self._db.close()
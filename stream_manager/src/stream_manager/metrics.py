@@ -0,0 +1,146 @@
+import asyncio
+import bisect
+import time
+
+"""
+metrics in the Prometheus text exposition format, served at GET /metrics
+
+kept deliberately small (no client library): counters and histograms are updated in place on
+the hot path (a dict lookup and an addition), and everything which already exists elsewhere
+(state, replicator, scheduler and monitor stats) is read only when /metrics is scraped, by
+collector functions registered with add_collector().
+"""
+
+# seconds; spawning a process and writing state should take milliseconds
+DEFAULT_BUCKETS=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels) + '}'
+
+def _escape(v):
+    return v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _value(v):
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    if isinstance(v, float):
+        return repr(v)
+    return str(v)
+
+
+class histogram():
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets=tuple(buckets)
+        self.counts=[0] * (len(self.buckets) + 1)
+        self.sum=0.0
+        self.count=0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def lines(self, name, labels):
+        out=[]
+        cumulative=0
+        for le, n in zip(self.buckets, self.counts):
+            cumulative += n
+            out.append(f'{name}_bucket{_labels(labels + (("le", _value(float(le))),))} {cumulative}')
+        out.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {self.count}')
+        out.append(f'{name}_sum{_labels(labels)} {_value(self.sum)}')
+        out.append(f'{name}_count{_labels(labels)} {self.count}')
+        return out
+
+
+class metrics():
+
+    def __init__(self) -> None:
+        # name -> (type, help)
+        self._meta={}
+        # name -> {labels: value or histogram}
+        self._values={}
+        self._collectors=[]
+
+    def _get(self, name, type, help):
+        if name not in self._meta:
+            self._meta[name]=(type, help)
+            self._values[name]={}
+        return self._values[name]
+
+    """
+    labels are passed as a tuple of (name, value) pairs so they can be used as a key as is
+    """
+    def inc(self, name, help, labels=(), value=1):
+        values=self._get(name, 'counter', help)
+        values[labels]=values.get(labels, 0) + value
+
+    def set(self, name, help, value, labels=()):
+        self._get(name, 'gauge', help)[labels]=value
+
+    def observe(self, name, help, value, labels=(), buckets=DEFAULT_BUCKETS):
+        values=self._get(name, 'histogram', help)
+        h=values.get(labels)
+        if h is None:
+            h=values[labels]=histogram(buckets)
+        h.observe(value)
+
+    """
+    collector(m) is called on every scrape; it adds its values with m.set(), or m.counter() for
+    totals it keeps itself
+    """
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        scrape=metrics()
+        for c in self._collectors:
+            c(scrape)
+
+        out=[]
+        for registry in (self, scrape):
+            for name, (type, help) in registry._meta.items():
+                out.append(f'# HELP {name} {help}')
+                out.append(f'# TYPE {name} {type}')
+                for labels, v in registry._values[name].items():
+                    if isinstance(v, histogram):
+                        out+=v.lines(name, labels)
+                    else:
+                        out.append(f'{name}{_labels(labels)} {_value(v)}')
+        return '\n'.join(out) + '\n'
+
+    # a total maintained elsewhere, reported as a counter (for use in collectors)
+    def counter(self, name, help, value, labels=()):
+        self._get(name, 'counter', help)[labels]=value
+
+
+"""
+measures how late the event loop runs a callback which should run every interval seconds;
+lag means something is blocking the loop
+"""
+class loop_lag_monitor():
+
+    def __init__(self, metrics, interval=1.0) -> None:
+        self.metrics=metrics
+        self.interval=interval
+        self.last=0.0
+        self.max=0.0
+        self._task=None
+
+    def start(self):
+        self._task=asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            t=time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last=max(0.0, time.monotonic() - t - self.interval)
+            self.max=max(self.max, self.last)
+            self.metrics.observe('stream_manager_loop_lag_seconds',
+                'delay of a periodic event loop callback beyond its scheduled time', self.last)
@@ -0,0 +1,427 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import gzip
+import json
+import mmap
+import os
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from fractions import Fraction
+
+"""
+per-packet timing sidecars: map media time to byte position in the recording and back
+
+the original sidecar (_packets.json.gz) is ffprobe's JSON dump of every audio packet. this module
+defines a compact binary replacement (_packets.pkt), built by streaming ffprobe's output, which
+can be queried in O(log n) without decompressing or parsing the whole file.
+
+layout (all integers little-endian):
+
+    header      magic "TWPKT\\0\\0\\0", version u16, reserved u16, block_size u32,
+                time_base numerator i32, time_base denominator i32
+    blocks      for each block of up to block_size packets, zlib-compressed: the columns pts,
+                dts, pos, size and duration, one after the other, as varints (see below)
+    index       for each block: offset u64, compressed length u32, packet count u32, then the
+                pts and pos of the block's first packet which has both (NONE if none has) as i64
+    trailer     index offset u64, block count u32, packet count u64, magic "TWPKEND\\0"
+
+each value is stored as its difference from the previous value of its column in the block (the
+first one from 0), zigzag-encoded, shifted left by one with the low bit set. a missing value
+(N/A in ffprobe) is a single 0 byte and leaves the previous value as it is. packets are regular,
+so the differences are small and repetitive, and a block compresses to a few bytes per packet.
+timestamps are in time_base units.
+
+queries only consider packets which have both pts and pos, and assume that these increase
+monotonically, which holds for the audio stream of our recordings. a query decodes one block
+(the most recently used ones are kept).
+"""
+
+MAGIC=b'TWPKT\x00\x00\x00'
+END_MAGIC=b'TWPKEND\x00'
+VERSION=2
+
+HEADER=struct.Struct('<8sHHIii')
+INDEX_ENTRY=struct.Struct('<QIIqq')
+TRAILER=struct.Struct('<QIQ8s')
+
+NONE=-(1 << 63)
+
+COLUMNS=('pts', 'dts', 'pos', 'size', 'duration')
+
+# decoded blocks kept by packet_reader
+CACHED_BLOCKS=4
+
+
+def _encode_column(values, out):
+    prev=0
+    for v in values:
+        if v is None:
+            out.append(0)
+            continue
+        d=v - prev
+        prev=v
+        code=((d << 1 if d >= 0 else (-d << 1) - 1) << 1) | 1
+        while code >= 0x80:
+            out.append((code & 0x7f) | 0x80)
+            code >>= 7
+        out.append(code)
+
+# columns of count values each from data; returns a list of lists
+def _decode_columns(data, columns, count):
+    ret=[]
+    i=0
+    for c in range(columns):
+        col=[]
+        prev=0
+        for _ in range(count):
+            code=0
+            shift=0
+            while True:
+                byte=data[i]
+                i += 1
+                code |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            if code == 0:
+                col.append(None)
+                continue
+            z=code >> 1
+            prev += -(z >> 1) - 1 if z & 1 else z >> 1
+            col.append(prev)
+        ret.append(col)
+    return ret
+
+
+class packet_writer():
+
+    def __init__(self, path, time_base, block_size=4096) -> None:
+        self.time_base=Fraction(time_base)
+        self.block_size=block_size
+
+        self._f=open(path, 'wb')
+        self._f.write(HEADER.pack(MAGIC, VERSION, 0, block_size,
+            self.time_base.numerator, self.time_base.denominator))
+
+        self._index=[]
+        self._count=0
+        self._block=[]
+
+    def add(self, pts, dts, pos, size, duration):
+        self._block.append((pts, dts, pos, size, duration))
+        if len(self._block) >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        n=len(self._block)
+        if n == 0:
+            return
+
+        out=bytearray()
+        for c in range(len(COLUMNS)):
+            _encode_column([p[c] for p in self._block], out)
+        data=zlib.compress(bytes(out), 9)
+
+        first=next(
+            ((p[0], p[2]) for p in self._block if p[0] is not None and p[2] is not None),
+            (NONE, NONE)
+        )
+        self._index.append((self._f.tell(), len(data), n) + first)
+        self._f.write(data)
+
+        self._count += n
+        self._block=[]
+
+    def close(self):
+        self._flush_block()
+
+        index_offset=self._f.tell()
+        for entry in self._index:
+            self._f.write(INDEX_ENTRY.pack(*entry))
+        self._f.write(TRAILER.pack(index_offset, len(self._index), self._count, END_MAGIC))
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class packet_reader():
+
+    def __init__(self, path) -> None:
+        self._f=open(path, 'rb')
+        self._mm=mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.block_size, num, den=HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path}: not a packet sidecar')
+        if version != VERSION:
+            raise ValueError(f'{path}: unsupported version {version}')
+        self.time_base=Fraction(num, den)
+
+        index_offset, blocks, self.count, end=TRAILER.unpack_from(self._mm, len(self._mm) - TRAILER.size)
+        if end != END_MAGIC:
+            raise ValueError(f'{path}: truncated')
+
+        # the index is small (one entry per block_size packets), so it's kept in memory
+        self._blocks=[
+            INDEX_ENTRY.unpack_from(self._mm, index_offset + i * INDEX_ENTRY.size)
+            for i in range(blocks)
+        ]
+        self._first_pts=self._keys(3)
+        self._first_pos=self._keys(4)
+        # block -> (columns, (pts, pos) of the packets which have both), least recently used first
+        self._cache=collections.OrderedDict()
+
+    # sorted bisect keys from field of the index: a block without any packet which has both pts
+    # and pos gets the key of the block before it
+    def _keys(self, field):
+        keys=[]
+        last=NONE
+        for entry in self._blocks:
+            last=max(last, entry[field])
+            keys.append(last)
+        return keys
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self._cache.clear()
+        self._mm.close()
+        self._f.close()
+
+    def _block(self, b):
+        cached=self._cache.get(b)
+        if cached is not None:
+            self._cache.move_to_end(b)
+            return cached
+
+        offset, length, n, _, _=self._blocks[b]
+        cols=dict(zip(COLUMNS, _decode_columns(zlib.decompress(self._mm[offset:offset + length]), len(COLUMNS), n)))
+        known=[i for i in range(n) if cols['pts'][i] is not None and cols['pos'][i] is not None]
+        cached=(cols, ([cols['pts'][i] for i in known], [cols['pos'][i] for i in known]))
+
+        self._cache[b]=cached
+        while len(self._cache) > CACHED_BLOCKS:
+            self._cache.popitem(last=False)
+        return cached
+
+    def packet(self, b, i):
+        cols=self._block(b)[0]
+        return {name: cols[name][i] for name in COLUMNS}
+
+    # (pts, pos) of the last packet with both whose pts (key 0) or pos (key 1) is <= value
+    def _find(self, key, keys, value):
+        b=bisect.bisect_right(keys, value) - 1
+        # only blocks without such packets are skipped
+        while b >= 0:
+            known=self._block(b)[1]
+            i=bisect.bisect_right(known[key], value) - 1
+            if i >= 0:
+                return known[0][i], known[1][i]
+            b -= 1
+        return None
+
+    """
+    byte position of the packet playing at media time t (seconds), or None if t is before the
+    first packet
+    """
+    def time_to_pos(self, t):
+        found=self._find(0, self._first_pts, int(Fraction(t) / self.time_base))
+        if found is None:
+            return None
+        return found[1]
+
+    """
+    media time (seconds) of the packet at byte position pos, or None if pos is before the
+    first packet
+    """
+    def pos_to_time(self, pos):
+        found=self._find(1, self._first_pos, pos)
+        if found is None:
+            return None
+        return float(found[0] * self.time_base)
+
+
+"""
+the original _packets.json.gz format, read fully into memory, with the same query API as
+packet_reader so old archives keep working
+"""
+class legacy_packet_reader():
+
+    def __init__(self, path) -> None:
+        with gzip.open(path, 'rb') as f:
+            data=json.load(f)
+
+        self._times=[]
+        self._pos=[]
+        for p in data.get('packets', []):
+            t=_float(p.get('pts_time'))
+            pos=_int(p.get('pos'))
+            if t is None or pos is None:
+                continue
+            self._times.append(t)
+            self._pos.append(pos)
+        self.packets=data.get('packets', [])
+
+    def __len__(self):
+        return len(self.packets)
+
+    def close(self):
+        pass
+
+    def time_to_pos(self, t):
+        i=bisect.bisect_right(self._times, t) - 1
+        return self._pos[i] if i >= 0 else None
+
+    def pos_to_time(self, pos):
+        i=bisect.bisect_right(self._pos, pos) - 1
+        return self._times[i] if i >= 0 else None
+
+
+def open_packets(path):
+    with open(path, 'rb') as f:
+        magic=f.read(len(MAGIC))
+    if magic == MAGIC:
+        return packet_reader(path)
+    return legacy_packet_reader(path)
+
+
+def _int(x):
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        return None
+
+def _float(x):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+build a binary sidecar for the first audio stream of media_path, streaming ffprobe's output
+packet by packet. ffprobe's output is parsed in the default executor, so a long recording
+doesn't hold up the event loop
+"""
+async def build(media_path, dst, time_base=None, ffprobe='ffprobe', block_size=4096):
+    if time_base is None:
+        time_base=await _audio_time_base(media_path, ffprobe)
+
+    # stderr goes to a file, so ffprobe can't block on it while stdout is being read
+    with tempfile.TemporaryFile() as err:
+        proc=subprocess.Popen(
+            [ffprobe, '-hide_banner', '-v', 'warning', '-i', media_path,
+                '-select_streams', 'a:0', '-show_entries', 'packet=pts,dts,size,pos,duration',
+                '-of', 'compact=p=0'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=err,
+        )
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _index, proc, dst, time_base, block_size)
+        except BaseException:
+            # the executor thread sees ffprobe's output end and finishes
+            proc.kill()
+            raise
+
+        if proc.returncode != 0:
+            err.seek(0)
+            raise RuntimeError(f'ffprobe exited with {proc.returncode}: {err.read().decode(errors="replace").strip()}')
+
+
+# write a sidecar from the output of ffprobe proc (see build); removed if ffprobe fails
+def _index(proc, dst, time_base, block_size):
+    with proc.stdout, packet_writer(dst, time_base, block_size) as w:
+        for line in proc.stdout:
+            # pts=...|dts=...|duration=...|size=...|pos=...
+            fields=dict(
+                kv.split('=', 1) for kv in line.decode().strip().split('|') if '=' in kv
+            )
+            w.add(
+                _int(fields.get('pts')), _int(fields.get('dts')), _int(fields.get('pos')),
+                _int(fields.get('size')), _int(fields.get('duration')),
+            )
+    if proc.wait() != 0:
+        os.unlink(dst)
+
+
+async def _audio_time_base(media_path, ffprobe):
+    proc=await asyncio.create_subprocess_exec(
+        ffprobe, '-hide_banner', '-v', 'error', '-i', media_path,
+        '-select_streams', 'a:0', '-show_entries', 'stream=time_base', '-of', 'json',
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err=await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f'ffprobe exited with {proc.returncode}: {err.decode(errors="replace").strip()}')
+    return json.loads(out)['streams'][0]['time_base']
+
+
+"""
+convert an old _packets.json.gz sidecar; its times are decimal seconds, stored in microseconds
+"""
+def convert_legacy(src, dst, block_size=4096):
+    time_base=Fraction(1, 1000000)
+    with gzip.open(src, 'rb') as f:
+        data=json.load(f)
+
+    def us(x):
+        x=_float(x)
+        return None if x is None else round(x * 1000000)
+
+    with packet_writer(dst, time_base, block_size) as w:
+        for p in data.get('packets', []):
+            w.add(us(p.get('pts_time')), us(p.get('dts_time')), _int(p.get('pos')),
+                _int(p.get('size')), us(p.get('duration_time')))
+
+
+def main():
+    prs=argparse.ArgumentParser(
+        prog='stream_manager.packets',
+        description='build, convert and query per-packet timing sidecars',
+    )
+    sub=prs.add_subparsers(dest='command', required=True)
+
+    p=sub.add_parser('build', help='build a sidecar from a recording')
+    p.add_argument('media')
+    p.add_argument('output')
+
+    p=sub.add_parser('convert', help='convert a _packets.json.gz sidecar')
+    p.add_argument('input')
+    p.add_argument('output')
+
+    p=sub.add_parser('query', help='map media time to byte position or back')
+    p.add_argument('sidecar')
+    g=p.add_mutually_exclusive_group(required=True)
+    g.add_argument('--time', type=float)
+    g.add_argument('--pos', type=int)
+
+    args=prs.parse_args()
+
+    if args.command == 'build':
+        asyncio.run(build(args.media, args.output))
+    elif args.command == 'convert':
+        convert_legacy(args.input, args.output)
+    elif args.command == 'query':
+        r=open_packets(args.sidecar)
+        if args.time is not None:
+            print(r.time_to_pos(args.time))
+        else:
+            print(r.pos_to_time(args.pos))
+        r.close()
+
+
+if __name__ == '__main__':
+    main()
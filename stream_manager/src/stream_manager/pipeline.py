@@ -0,0 +1,265 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+
+from stream_manager.jobqueue import job_queue
+from stream_manager.convert import converter
+from stream_manager.assemble import assembler
+from stream_manager import sync
+
+"""
+in-process handoff from download to conversion to upload, replacing the cron-driven
+convert.sh/s3-sync.sh directory scans
+
+a finished download (moved to completed_dir by try_stream) is queued for conversion right away,
+and the output of each conversion is queued for upload. both queues are durable job_queues, so
+nothing is lost across restarts; the conversion queue is the same one `stream_manager.convert`
+uses (convert.queue_path), so the two can't run at the same time.
+
+stages run on the manager's event loop, so their blocking work - moving recordings (a copy
+across filesystems), deleting them, writing sidecars and indexing packets - is done in the
+default executor (see convert.py and assemble.py); uploads have their own thread pool.
+
+stages wake up when work is queued for them rather than polling. conversion is held back while
+the upload backlog is at max_upload_backlog files, so converted files don't pile up on disk
+faster than they can be archived. downloads are never held back - a live stream can't wait.
+
+with an assemble section, the recordings of a session are first merged into one file (see
+assemble.py): try_stream moves them to assemble.in_dir instead of completed_dir, and the
+merged file goes on to conversion.
+
+on start, the conversion input directory and the conversion output directory are scanned once,
+to pick up files which were added by hand or left over from before the pipeline was enabled.
+
+the pipeline is configured by the convert and sync sections of the config (see
+config.yml.sample) and enabled with pipeline: true. cron jobs for convert.sh and s3-sync.sh
+should be disabled, or at least not cover the same directories.
+"""
+
+class stage():
+
+    def __init__(self, name, queue, workers, handler, ready=None, retry_delay=30, idle_timeout=60) -> None:
+        self.name=name
+        self.queue=queue
+        self.workers=workers
+        self.handler=handler
+        # False: hold off on claiming new jobs (backpressure from the next stage)
+        self.ready=ready or (lambda: True)
+        self.retry_delay=retry_delay
+        self.idle_timeout=idle_timeout
+        self.logger=logging.getLogger('stream_manager')
+
+        self.errors=0
+        self.completed=0
+        self._wake=asyncio.Event()
+        self._tasks=[]
+
+    def add(self, key, data=None):
+        added=self.queue.add(key, data)
+        if added:
+            self.wake()
+        return added
+
+    def wake(self):
+        self._wake.set()
+
+    async def _wait(self):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=self.idle_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def start(self):
+        self._tasks=[asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        return self._tasks
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks=[]
+
+    async def _worker(self, i):
+        while True:
+            if not self.ready():
+                await self._wait()
+                continue
+
+            job=self.queue.claim()
+            if job is None:
+                await self._wait()
+                continue
+
+            key, data=job
+            try:
+                result=await self.handler(key, data)
+                self.queue.complete(key, result)
+                self.completed += 1
+            except Exception as e:
+                self.logger.error(f'pipeline({self.name}): {key} failed: {e}', exc_info=True)
+                self.errors += 1
+                self.queue.fail(key, e)
+                await asyncio.sleep(self.retry_delay)
+
+    def stats(self):
+        return {
+            'queue': self.queue.stats(),
+            'workers': self.workers,
+            'completed': self.completed,
+            'errors': self.errors,
+            'ready': self.ready(),
+        }
+
+
+class pipeline():
+
+    def __init__(self, config) -> None:
+        self.logger=logging.getLogger('stream_manager')
+        self.max_upload_backlog=config['max_upload_backlog']
+
+        convert_config=config['convert']
+        sync_config=config['sync']
+
+        # raises RuntimeError if stream_manager.convert is running
+        self.converter=converter(convert_config)
+
+        self.assembler=None
+        self.manifest=None
+        self.uploader=None
+        self.upload_queue=None
+        self._sync_lock=sync.acquire_lock(sync_config)
+        if self._sync_lock is None:
+            self.converter.queue.close()
+            raise RuntimeError('pipeline: sync is locked by another process')
+
+        try:
+            if config['assemble'] is not None:
+                self.assembler=assembler(config['assemble'], self.converter.in_dir,
+                    self.converter.out_dir, self.converter.probes, ffmpeg=self.converter.ffmpeg)
+            self.manifest=sync.make_manifest(sync_config)
+            self.uploader=sync.make_uploader(sync_config, self.manifest)
+            self.upload_queue=job_queue(sync_config.get(
+                'queue_path', os.path.join(sync_config.get('base', '.'), 'sync', 'queue.json')
+            ))
+        except BaseException:
+            self._close_resources()
+            raise
+
+        self._upload_pool=concurrent.futures.ThreadPoolExecutor(max_workers=self.uploader.concurrency)
+
+        self.assemble=None
+        if self.assembler is not None:
+            self.assemble=stage(
+                'assemble', self.assembler.queue, self.assembler.workers, self._assemble,
+            )
+        self.convert=stage(
+            'convert', self.converter.queue, self.converter.workers, self._convert,
+            ready=self._upload_ready,
+        )
+        self.upload=stage(
+            'upload', self.upload_queue, self.uploader.concurrency, self._upload,
+        )
+
+    def _upload_ready(self):
+        backlog=self.upload_queue.count(job_queue.PENDING) + self.upload_queue.count(job_queue.RUNNING)
+        return backlog < self.max_upload_backlog
+
+    # the recordings of a finished session; called by try_stream
+    def downloaded(self, paths):
+        if self.assembler is not None:
+            keys=set(self.assembler.session_key(path) for path in paths)
+            for key in keys - {None}:
+                if self.assemble.add(key):
+                    self.logger.info(f'pipeline: queued {key} for assembly')
+            return
+
+        for path in paths:
+            if self.convert.add(path):
+                self.logger.info(f'pipeline: queued {path} for conversion')
+
+    async def _assemble(self, key, data):
+        result=await self.assembler.assemble(key)
+        for path in result['outputs']:
+            self.convert.add(path)
+        for path in result['sidecars']:
+            self.upload.add(path, {'storage_class': sync.storage_class(path)})
+        return result
+
+    async def _convert(self, path, data):
+        if not os.path.isfile(path):
+            self.logger.warning(f'pipeline(convert): {path} disappeared')
+            return {'missing': True}
+
+        result=await self.converter.convert(path)
+        for f in result['files']:
+            self.upload.add(f, {'storage_class': sync.storage_class(f)})
+        return result
+
+    async def _upload(self, path, data):
+        if not os.path.isfile(path):
+            self.logger.warning(f'pipeline(upload): {path} disappeared')
+            return {'missing': True}
+
+        loop=asyncio.get_running_loop()
+        try:
+            storage_class=data.get('storage_class') or sync.storage_class(path)
+            return await loop.run_in_executor(self._upload_pool, self.uploader.upload, path, storage_class)
+        finally:
+            # the backlog went down (or a retry is due), so conversion may go on
+            self.convert.wake()
+
+    """
+    queue files which arrived without passing through the pipeline: recordings in the
+    conversion input directory, and conversion output which hasn't been uploaded
+    """
+    def scan(self):
+        if self.assembler is not None:
+            self.assembler.scan()
+        self.converter.scan()
+
+        added=0
+        for path in sync.ready_files([self.converter.out_dir]):
+            if self.upload.add(path, {'storage_class': sync.storage_class(path)}):
+                added += 1
+        if added > 0:
+            self.logger.info(f'pipeline: queued {added} files from {self.converter.out_dir} for upload')
+
+    def start(self):
+        self.converter.probes.prune()
+        self.scan()
+        tasks=self.convert.start() + self.upload.start()
+        if self.assemble is not None:
+            tasks+=self.assemble.start()
+        return tasks
+
+    def _close_resources(self):
+        if self.assembler is not None:
+            self.assembler.queue.close()
+        self.converter.queue.close()
+        self.converter.probes.close()
+        if self.upload_queue is not None:
+            self.upload_queue.close()
+        if self.manifest is not None:
+            self.manifest.close()
+        if self._sync_lock is not None:
+            os.close(self._sync_lock)
+            self._sync_lock=None
+
+    async def close(self):
+        if self.assemble is not None:
+            await self.assemble.stop()
+        await self.convert.stop()
+        await self.upload.stop()
+        self._upload_pool.shutdown(wait=True)
+        self._close_resources()
+
+    def stats(self):
+        return {
+            'assemble': None if self.assemble is None else self.assemble.stats(),
+            'convert': self.convert.stats(),
+            'upload': self.upload.stats(),
+            'encoding': self.converter.presets.stats(),
+            'max_upload_backlog': self.max_upload_backlog,
+        }
@@ -0,0 +1,317 @@
+import asyncio
+import base64
+import json
+import logging
+import math
+import time
+
+from stream_manager.common import atomic_write
+
+"""
+adaptive poll intervals, learned from when each stream has been online
+
+history: for each stream, the likelihood of it being online in each hour of the week (168 bins,
+UTC). every week, a bin's likelihood moves towards 1 if the stream was seen online in that hour
+and towards 0 if not, by `decay` (the weight of the latest week), so old habits fade out over a
+few weeks. a stream is "seen online" in an hour when a download attempt during that hour
+produced data (see manager.try_stream). the current week's sightings are kept as a bitmask and
+folded in lazily, the first time the stream is touched in a later week.
+
+intervals: the total poll budget (poll attempts per second across all streams) is divided so
+that every stream is polled at least every max_interval, and the rest goes to streams in
+proportion to the square root of their likelihood of being online now (or lead_sec from now,
+so polling picks up before a stream's usual start). with p the likelihood and r the poll rate of
+a stream, the expected detection latency is proportional to p / r, and the square root split is
+what minimizes its sum for a given total rate. no stream is polled more often than
+min_interval; budget a stream can't use goes to the others. with no history at all, every
+stream gets the same interval, as without the model.
+
+on disk (history_path), only streams which have ever been seen online are stored, as
+[week, base64 of 168 likelihoods quantized to a byte each, hex bitmask of this week's sightings].
+
+detection latency: when a poll attempt finds a stream online, the stream went online some time
+since the previous poll attempt, so the gap between the two bounds the latency (and half of it
+is the expected latency). an /online signal for a stream which polling has not found is
+counted as missed by polling.
+"""
+
+BINS=168
+BIN_SEC=3600
+WEEK_SEC=BINS * BIN_SEC
+
+def _bin(t):
+    return int(t // BIN_SEC) % BINS
+
+def _week(t):
+    return int(t // WEEK_SEC)
+
+
+class _history():
+    __slots__=('week', 'p', 'seen')
+
+    def __init__(self, week, p=None, seen=0) -> None:
+        self.week=week
+        # likelihood per bin, 0-255
+        self.p=bytearray(BINS) if p is None else p
+        # bins seen online during week
+        self.seen=seen
+
+    # fold the sightings of self.week into p, and decay p for the weeks since
+    def fold(self, week, decay):
+        if week <= self.week:
+            return
+        p=self.p
+        for b in range(BINS):
+            v=(1 - decay) * p[b]
+            if self.seen >> b & 1:
+                v += decay * 255
+            p[b]=int(v)
+        keep=(1 - decay) ** (week - self.week - 1)
+        if keep < 1:
+            for b in range(BINS):
+                p[b]=int(p[b] * keep)
+        self.seen=0
+        self.week=week
+
+    # likelihood (0-1) for bin b, counting this week's sightings as if the week had ended
+    def likelihood(self, b, decay):
+        v=(1 - decay) * self.p[b]
+        if self.seen >> b & 1:
+            v += decay * 255
+        return v / 255
+
+    def empty(self):
+        return self.seen == 0 and not any(self.p)
+
+
+class poll_model():
+
+    """
+    get_streams() returns the stream IDs which are polled (the budget is divided among them);
+    default_interval is used for the default budget (the same average rate as a fixed
+    poll_interval)
+    """
+    def __init__(self, config, get_streams, default_interval, default_path) -> None:
+        self.get_streams=get_streams
+        self.budget=config.get('budget')
+        self.default_interval=default_interval
+        self.min_interval=config.get('min_interval_sec', 60)
+        self.max_interval=config.get('max_interval_sec', default_interval * 4)
+        self.decay=config.get('decay', 0.25)
+        self.lead_sec=config.get('lead_sec', 900)
+        self.reallocate_interval=config.get('reallocate_interval_sec', 60)
+        self.save_interval=config.get('save_interval_sec', 300)
+        self.path=config.get('history_path', default_path)
+        self.logger=logging.getLogger('stream_manager')
+
+        # stream ID (lowercase) -> _history
+        self._history={}
+        self._dirty=False
+        # stream ID -> interval, from the last allocation
+        self._intervals={}
+        self._allocated=None
+        # budget of the last allocation, and how much of it was allocated
+        self._budget=0.0
+        self._budget_used=0.0
+
+        # stream ID -> (start of the poll attempt before the last one, start of the last one)
+        self._polls={}
+        # gaps (seconds) between a detection and the poll attempt before it, most recent last
+        self._gaps=[]
+        self.counters={
+            'polls': 0,
+            'detected_by_poll': 0,
+            'missed_by_poll': 0,
+        }
+
+        self._task=None
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data=json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.error(f'poll_model: could not load {self.path}: {e}')
+            return
+
+        if data.get('version') != 1 or data.get('bins') != BINS or data.get('bin_sec') != BIN_SEC:
+            self.logger.warning(f'poll_model: {self.path} has an incompatible layout, starting over')
+            return
+
+        for s_id, (week, p, seen) in data['streams'].items():
+            p=bytearray(base64.b64decode(p))
+            if len(p) != BINS:
+                continue
+            self._history[s_id]=_history(week, p, int(seen, 16))
+        self.logger.info(f'poll_model: loaded history for {len(self._history)} streams')
+
+    def _serialize(self):
+        return json.dumps({
+            'version': 1,
+            'bins': BINS,
+            'bin_sec': BIN_SEC,
+            'decay': self.decay,
+            'streams': {
+                s_id: [h.week, base64.b64encode(h.p).decode(), format(h.seen, 'x')]
+                for s_id, h in self._history.items() if not h.empty()
+            },
+        }, separators=(',', ':'))
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty=False
+        data=self._serialize()
+        loop=asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, atomic_write, self.path, data)
+        except OSError as e:
+            self._dirty=True
+            self.logger.error(f'poll_model: could not save {self.path}: {e}')
+
+    def start(self):
+        self._task=asyncio.create_task(self._save_task())
+        return self._task
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.save()
+
+    async def _save_task(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            await self.save()
+
+    def _get(self, s_id, now):
+        h=self._history.get(s_id)
+        if h is not None:
+            h.fold(_week(now), self.decay)
+        return h
+
+    # s_id was online (a download attempt produced data) from start until end (epoch seconds)
+    def observe(self, s_id, start, end):
+        s_id=s_id.lower()
+        h=self._get(s_id, end)
+        if h is None:
+            h=self._history[s_id]=_history(_week(end))
+        t=start - start % BIN_SEC
+        while t <= end:
+            h.seen |= 1 << _bin(t)
+            t += BIN_SEC
+        self._dirty=True
+
+    def likelihood(self, s_id, now=None):
+        if now is None:
+            now=time.time()
+        h=self._get(s_id.lower(), now)
+        if h is None:
+            return 0.0
+        return max(h.likelihood(_bin(now), self.decay), h.likelihood(_bin(now + self.lead_sec), self.decay))
+
+    """
+    divide the budget among the polled streams, see above. returns stream ID -> interval
+    """
+    def allocate(self, now=None):
+        if now is None:
+            now=time.time()
+        streams=list(self.get_streams())
+        n=len(streams)
+        if n == 0:
+            self._intervals={}
+            self._budget=self._budget_used=0.0
+            return self._intervals
+
+        budget=self.budget if self.budget is not None else n / self.default_interval
+        self._budget=budget
+        floor=1 / self.max_interval
+        cap=1 / self.min_interval
+        if budget <= n * floor:
+            # not even enough for the floor: everyone gets the same share
+            rates={s_id: budget / n for s_id in streams}
+        else:
+            rates={s_id: floor for s_id in streams}
+            spare=budget - n * floor
+            weights={s_id: math.sqrt(self.likelihood(s_id, now)) for s_id in streams}
+            weighted=[s_id for s_id in streams if weights[s_id] > 0]
+
+            # water-filling: streams which would go above the cap are capped, and their share
+            # goes to the others
+            while spare > 1e-9 and len(weighted) > 0:
+                total=sum(weights[s_id] for s_id in weighted)
+                capped=[s_id for s_id in weighted if rates[s_id] + spare * weights[s_id] / total >= cap]
+                if len(capped) == 0:
+                    for s_id in weighted:
+                        rates[s_id] += spare * weights[s_id] / total
+                    spare=0.0
+                    break
+                for s_id in capped:
+                    spare -= cap - rates[s_id]
+                    rates[s_id]=cap
+                weighted=[s_id for s_id in weighted if rates[s_id] < cap]
+
+            # whatever is left (no history, or every likely stream capped) is shared evenly
+            uncapped=[s_id for s_id in streams if rates[s_id] < cap]
+            if spare > 1e-9 and len(uncapped) > 0:
+                for s_id in uncapped:
+                    rates[s_id]=min(cap, rates[s_id] + spare / len(uncapped))
+
+        self._intervals={s_id: 1 / r for s_id, r in rates.items()}
+        self._budget_used=sum(rates.values())
+        self._allocated=time.monotonic()
+        return self._intervals
+
+    # current interval for s_id; the allocation is refreshed every reallocate_interval
+    def interval(self, s_id):
+        if self._allocated is None or time.monotonic() - self._allocated >= self.reallocate_interval:
+            self.allocate()
+        i=self._intervals.get(s_id)
+        return self.default_interval if i is None else i
+
+    # a poll attempt for s_id is starting
+    def polled(self, s_id):
+        s_id=s_id.lower()
+        last=self._polls.get(s_id)
+        self._polls[s_id]=(None if last is None else last[1], time.monotonic())
+        self.counters['polls'] += 1
+
+    """
+    a poll attempt found s_id online; returns the gap since the poll attempt before it (the
+    upper bound of the detection latency), or None if it was the first
+    """
+    def detected(self, s_id):
+        self.counters['detected_by_poll'] += 1
+        polls=self._polls.get(s_id.lower())
+        if polls is None or polls[0] is None:
+            return None
+        gap=polls[1] - polls[0]
+        self._gaps.append(gap)
+        if len(self._gaps) > 1000:
+            del self._gaps[:len(self._gaps) - 1000]
+        return gap
+
+    # an /online signal arrived for s_id before polling found it
+    def missed(self, s_id):
+        self.counters['missed_by_poll'] += 1
+
+    def stats(self):
+        intervals=sorted(self._intervals.values())
+        gaps=sorted(self._gaps)
+        def pct(values, p):
+            if len(values) == 0:
+                return None
+            return round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+
+        return {
+            'budget_per_sec': round(self._budget, 4),
+            'allocated_per_sec': round(self._budget_used, 4),
+            'streams': len(intervals),
+            'streams_with_history': len(self._history),
+            'interval_sec': {f'p{p}': pct(intervals, p) for p in (0, 10, 50, 90, 100)},
+            # over the last (up to) 1000 detections by polling
+            'detection_gap_sec': {f'p{p}': pct(gaps, p) for p in (50, 90, 99)},
+            'expected_latency_sec': round(sum(gaps) / len(gaps) / 2, 3) if len(gaps) > 0 else None,
+            **self.counters,
+        }
@@ -0,0 +1,159 @@
+import asyncio
+import errno
+import logging
+import os
+
+"""
+wait for processes which are not our children to exit, e.g. download processes which were
+started by a previous instance of the manager and are resumed from state.
+
+download processes are started with start_new_session=True, so the PID recorded in state is also
+the ID of a process group containing the download script and everything it started (streamlink).
+wait_group() waits for the whole group, so a download is still tracked if the script itself has
+exited but streamlink is still running.
+
+- on Linux, processes are watched with pidfds (os.pidfd_open), which become readable when the
+  process exits: no polling at all
+- elsewhere (or if pidfd_open fails), a single shared task checks all watched process groups in
+  one pass every poll_interval seconds
+"""
+class process_watcher():
+
+    def __init__(self, poll_interval=5) -> None:
+        self.poll_interval=poll_interval
+        self.logger=logging.getLogger('stream_manager')
+
+        self._use_pidfd=hasattr(os, 'pidfd_open') and os.path.isdir('/proc')
+
+        # pgid -> futures waiting for it, checked by _poll_task
+        self._polled={}
+        self._poll_task=None
+
+    """
+    wait until no process in process group pgid is left
+    """
+    async def wait_group(self, pgid):
+        while _group_exists(pgid):
+            members=_group_members(pgid) if self._use_pidfd else None
+
+            if members is None or len(members) == 0:
+                await self._wait_polled(pgid)
+                continue
+
+            try:
+                await self._wait_pidfds(members)
+            except OSError as e:
+                # e.g. pidfd_open not permitted in this environment
+                self.logger.warning(f'process_watcher: pidfd unavailable ({e}), falling back to polling')
+                self._use_pidfd=False
+
+    """
+    process group members which are still running, for re-adopting a download after a restart
+    (only available where /proc can be read; None otherwise)
+    """
+    def adopt(self, pgid):
+        if not _group_exists(pgid):
+            return []
+        return _group_members(pgid)
+
+    # wait for all of pids to exit
+    async def _wait_pidfds(self, pids):
+        fds=[]
+        try:
+            for pid in pids:
+                try:
+                    fds.append(os.pidfd_open(pid))
+                except ProcessLookupError:
+                    pass
+        except OSError:
+            for fd in fds:
+                os.close(fd)
+            raise
+
+        loop=asyncio.get_running_loop()
+        fut=loop.create_future()
+        remaining=set(fds)
+        def on_exit(fd):
+            loop.remove_reader(fd)
+            remaining.discard(fd)
+            if len(remaining) == 0 and not fut.done():
+                fut.set_result(None)
+
+        for fd in fds:
+            loop.add_reader(fd, on_exit, fd)
+        try:
+            if len(fds) > 0:
+                await fut
+        finally:
+            for fd in fds:
+                if fd in remaining:
+                    loop.remove_reader(fd)
+                os.close(fd)
+
+    async def _wait_polled(self, pgid):
+        fut=asyncio.get_running_loop().create_future()
+        self._polled.setdefault(pgid, []).append(fut)
+
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task=asyncio.create_task(self._poll())
+
+        try:
+            await fut
+        finally:
+            waiters=self._polled.get(pgid, [])
+            if fut in waiters:
+                waiters.remove(fut)
+            if len(waiters) == 0:
+                self._polled.pop(pgid, None)
+
+    async def _poll(self):
+        while len(self._polled) > 0:
+            await asyncio.sleep(self.poll_interval)
+
+            for pgid in list(self._polled.keys()):
+                if _group_exists(pgid):
+                    continue
+                for fut in self._polled.pop(pgid):
+                    if not fut.done():
+                        fut.set_result(None)
+
+
+def _group_exists(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to someone else
+        return True
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
+
+
+# PIDs of the processes in group pgid, read from /proc/*/stat; None if /proc is not available
+def _group_members(pgid):
+    try:
+        entries=os.listdir('/proc')
+    except OSError:
+        return None
+
+    members=[]
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                stat=f.read()
+        except OSError:
+            continue
+
+        # the command name (2nd field) is in parentheses and may contain spaces
+        fields=stat[stat.rfind(b')')+2:].split()
+        # fields[0] is the state (3rd field), fields[2] is pgrp (5th field)
+        if len(fields) > 2 and fields[0] != b'Z' and int(fields[2]) == pgid:
+            members.append(int(entry))
+
+    return members
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+import httpx
+
+"""
+replicate state snapshots to the HTTP state server (state_url)
+
+a single background task owns one long-lived (pooled) httpx client and always sends only the
+newest snapshot: anything submitted while a request is in flight replaces the waiting snapshot
+instead of queueing behind it. failed requests are retried with exponential backoff, unless a
+newer snapshot arrives in the meantime, in which case the failed one is abandoned.
+
+modes:
+- full: PUT the whole state document
+- delta: PATCH an RFC 6902 JSON patch with one operation per stream which changed since the last
+  acknowledged write ("add" replaces a stream's state, "remove" deletes it). merge patches
+  (RFC 7396) can't be used since stream state contains nulls. the first write, and the first
+  write after a snapshot was dropped, is always a full PUT so the server can't drift out of sync.
+"""
+class replicator():
+
+    def __init__(self, url, timeout=5, mode='full', max_retries=5, backoff_base=0.5, backoff_max=30) -> None:
+        if mode not in ('full', 'delta'):
+            raise ValueError(f'replicator: unknown mode {mode}')
+
+        self.url=url
+        self.timeout=timeout
+        self.mode=mode
+        self.max_retries=max_retries
+        self.backoff_base=backoff_base
+        self.backoff_max=backoff_max
+        self.logger=logging.getLogger('stream_manager')
+
+        self._client=None
+        self._task=None
+        self._wakeup=None
+        self._idle=None
+
+        # newest snapshot which has not been picked up by the sender yet: (state_json, parts)
+        self._pending=None
+
+        # per-stream JSON of the last snapshot the server acknowledged; None means the next
+        # write has to be a full PUT
+        self._acked=None
+
+        self.stats={
+            'submitted': 0,
+            'sent': 0,
+            'sent_full': 0,
+            'sent_delta': 0,
+            # replaced by a newer snapshot before being sent
+            'superseded': 0,
+            # abandoned after at least one failed attempt
+            'dropped': 0,
+            'failed': 0,
+            'last_latency_sec': 0.0,
+            'last_bytes': 0,
+            'bytes_total': 0,
+            'latency_sec_total': 0.0,
+        }
+
+    """
+    queue a snapshot for replication; returns immediately.
+    state_json is the full document, parts maps each stream ID to its own serialized JSON
+    """
+    def submit(self, state_json, parts):
+        self.stats['submitted'] += 1
+        if self._pending is not None:
+            self.stats['superseded'] += 1
+        self._pending=(state_json, parts)
+
+        if self._task is None or self._task.done():
+            self._wakeup=asyncio.Event()
+            self._idle=asyncio.Event()
+            self._client=httpx.AsyncClient(timeout=self.timeout)
+            self._task=asyncio.create_task(self._run())
+
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            item=self._pending
+            self._pending=None
+            if item is not None:
+                await self._send_with_retry(item)
+
+            if self._pending is None:
+                self._idle.set()
+
+    async def _send_with_retry(self, item):
+        attempt=0
+        while True:
+            try:
+                await self._send(*item)
+                return
+            except (httpx.HTTPError, httpx.InvalidURL) as e:
+                self.stats['failed'] += 1
+                self.logger.error(f'replicator: write to {self.url} failed (attempt {attempt}): {e}')
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self.stats['dropped'] += 1
+                # we don't know what the server has now
+                self._acked=None
+                return
+
+            delay=min(self.backoff_max, self.backoff_base * 2 ** (attempt-1))
+            delay*=random.uniform(0.5, 1.0)
+            try:
+                # a newer snapshot ends the backoff early and replaces this one
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+                self.stats['dropped'] += 1
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, state_json, parts):
+        t=time.monotonic()
+
+        if self.mode == 'delta' and self._acked is not None:
+            body=self._patch(parts)
+            if body is None:
+                return
+            r=await self._client.patch(self.url, content=body, headers={
+                'content-type': 'application/json-patch+json'
+            })
+            if r.status_code in (405, 415, 501):
+                self.logger.warning(f'replicator: {self.url} does not support PATCH ({r.status_code}), using full writes')
+                self.mode='full'
+                return await self._send(state_json, parts)
+            if r.status_code in (404, 409):
+                # the server's document is not what we last wrote (e.g. it restarted)
+                self.logger.warning(f'replicator: {self.url} rejected patch ({r.status_code}), resending full state')
+                self._acked=None
+                return await self._send(state_json, parts)
+            r.raise_for_status()
+            self.stats['sent_delta'] += 1
+        else:
+            body=state_json
+            r=await self._client.put(self.url, content=body, headers={
+                'content-type': 'application/json'
+            })
+            r.raise_for_status()
+            self.stats['sent_full'] += 1
+
+        self._acked=parts
+
+        self.stats['sent'] += 1
+        self.stats['last_bytes']=len(body)
+        self.stats['last_latency_sec']=time.monotonic() - t
+        self.stats['bytes_total'] += len(body)
+        self.stats['latency_sec_total'] += self.stats['last_latency_sec']
+
+    # JSON patch from the last acknowledged snapshot to parts, or None if nothing changed
+    def _patch(self, parts):
+        ops=[
+            f'{{"op": "add", "path": {_pointer(k)}, "value": {v}}}' for k, v in parts.items()
+            if self._acked.get(k) != v
+        ]
+        ops+=[
+            f'{{"op": "remove", "path": {_pointer(k)}}}' for k in self._acked.keys()
+            if k not in parts
+        ]
+        if len(ops) == 0:
+            return None
+        return '[' + ', '.join(ops) + ']'
+
+    """
+    wait (up to timeout seconds) for the newest snapshot to be sent, then close the client
+    """
+    async def close(self, timeout=None):
+        if self._task is None:
+            return
+
+        if timeout is None:
+            timeout=self.timeout
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f'replicator.close: gave up waiting for the last write to {self.url}')
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task=None
+
+        await self._client.aclose()
+        self._client=None
+
+
+# JSON pointer (RFC 6901) for a top-level key, as a JSON string
+def _pointer(k):
+    return json.dumps('/' + k.replace('~', '~0').replace('/', '~1'))
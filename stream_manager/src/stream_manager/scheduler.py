@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from contextlib import asynccontextmanager
+
+"""
+global admission for everything which spawns a download process
+
+each kind of work ("download": any download_script process, "probe": speculative poll attempts
+and status probe requests) has its own concurrency limit (None: unlimited). waiters are queued
+per lane and served strictly by lane priority, then FIFO:
+- online: a definitive /online/{stream} signal
+- resume: resuming a stream from saved state
+- poll:   a speculative poll attempt
+
+poll attempts are additionally rate limited to poll_rate starts per second.
+"""
+
+LANES={
+    'online': 0,
+    'resume': 1,
+    'poll': 2,
+}
+
+class _limit():
+
+    def __init__(self, limit):
+        self.limit=limit
+        self.active=0
+        self.waiters=[]
+
+        self.granted=0
+        self.wait_total_sec=0.0
+        self.wait_max_sec=0.0
+
+    def available(self):
+        return self.limit is None or self.active < self.limit
+
+    def stats(self):
+        queued={lane: 0 for lane in LANES}
+        for priority, seq, lane, fut in self.waiters:
+            if not fut.done():
+                queued[lane] += 1
+
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'queued': queued,
+            'granted': self.granted,
+            'wait_avg_sec': self.wait_total_sec / self.granted if self.granted > 0 else 0.0,
+            'wait_max_sec': self.wait_max_sec,
+        }
+
+
+class scheduler():
+
+    def __init__(self, max_downloads=None, max_probes=None, poll_rate=None) -> None:
+        self._limits={
+            'download': _limit(max_downloads),
+            'probe': _limit(max_probes),
+        }
+        self.poll_rate=poll_rate
+        self._next_poll=0.0
+        self._seq=itertools.count()
+
+    """
+    wait for a slot of the given kind. with force=True, the slot is taken immediately even if
+    that exceeds the limit (used for processes which are already running, e.g. on resume)
+    """
+    async def acquire(self, kind, lane, force=False):
+        l=self._limits[kind]
+        t=time.monotonic()
+
+        if force or (l.available() and len(l.waiters) == 0):
+            l.active += 1
+        else:
+            fut=asyncio.get_running_loop().create_future()
+            heapq.heappush(l.waiters, (LANES[lane], next(self._seq), lane, fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # the slot may have been handed over just before we were cancelled
+                if fut.done() and not fut.cancelled():
+                    self.release(kind)
+                else:
+                    fut.cancel()
+                raise
+
+        wait=time.monotonic() - t
+        l.granted += 1
+        l.wait_total_sec += wait
+        l.wait_max_sec=max(l.wait_max_sec, wait)
+
+    def release(self, kind):
+        l=self._limits[kind]
+        l.active -= 1
+
+        while len(l.waiters) > 0 and l.available():
+            priority, seq, lane, fut=heapq.heappop(l.waiters)
+            if fut.done():
+                # cancelled while waiting
+                continue
+            l.active += 1
+            fut.set_result(None)
+
+    # wait until the next poll attempt may start
+    async def poll_ticket(self):
+        if self.poll_rate is None:
+            return
+
+        now=time.monotonic()
+        start=max(now, self._next_poll)
+        self._next_poll=start + 1 / self.poll_rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    @asynccontextmanager
+    async def slot(self, kind, lane, force=False):
+        await self.acquire(kind, lane, force=force)
+        try:
+            yield
+        finally:
+            self.release(kind)
+
+    def stats(self):
+        ret={
+            kind: l.stats() for kind, l in self._limits.items()
+        }
+        ret['poll_rate']=self.poll_rate
+        return ret
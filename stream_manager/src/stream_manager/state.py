@@ -1,60 +1,197 @@
-import json
+import asyncio
+import hashlib
 import httpx
 import logging
+import time
 
-from stream_manager.common import json_encoder, stream_state, stream_config
+from stream_manager.codec import state_codec, join, CodecError
+from stream_manager.common import atomic_write
+from stream_manager.replicator import replicator
 
 """
 handle reading/writing state for the manager, with the following rules/assumptions:
 - always default to loading from HTTP if the state_url we're initalized with is not None
 - if HTTP is not available or not specified, load from local file
 - always write state to both HTTP (if specified during initialization) and file
+  (HTTP writes are handed off to a replicator, see replicator.py)
+
+writes are "write-behind": callers only mark the state as dirty, and a single writer task
+serializes one snapshot per write_interval seconds no matter how many mutations happened in
+between. the file is written off the event loop and atomically replaced, so a crash leaves
+either the previous or the new state on disk, never a truncated one.
+
+each mark_dirty() bumps the state's version. the serialized state is cached per version
+(snapshot()), so the writer, the replicator and the HTTP API share a single serialization per
+change, and listeners (see statefeed.py) are told about every change. encoding and decoding
+are done by codec.py, which only re-encodes the streams which changed.
 """
 class state():
 
-    def __init__(self, state_path, state_url=None, http_timeout=5) -> None:
+    def __init__(self, state_path, state_url=None, http_timeout=5, write_interval=1.0, http_mode='full') -> None:
         self.state_path=state_path
         self.state_url=state_url
         self.http_timeout=http_timeout
+        self.write_interval=write_interval
         self.logger=logging.getLogger('stream_manager')
 
+        self.replicator=None
+        if state_url is not None:
+            self.replicator=replicator(state_url, timeout=http_timeout, mode=http_mode)
+
+        # the dict most recently passed to write(); snapshotted by the writer task
+        self._source=None
+        self._dirty=False
+        self._wakeup=None
+        self._writer=None
+        self._write_lock=None
+
+        self.version=0
+        # (version, id of the source dict, parts, state_json, etag)
+        self._snapshot=None
+        self._listeners=[]
+        self.codec=state_codec()
+
+        self.stats={
+            'marked': 0,
+            'written': 0,
+            'last_write_bytes': 0,
+            'last_write_sec': 0.0,
+            # totals, for averages over time
+            'write_bytes_total': 0,
+            'write_sec_total': 0.0,
+        }
+
     """
-    write the state to the local file and to the HTTP server
-    TODO: for HTTP, use a FIFO queue and cancel any waiting (but not in-process) writes when a new write arrives
+    mark the state as needing to be written; returns immediately.
+    any number of calls within write_interval are coalesced into a single write
     """
-    async def write(self, stream_state, state_path, state_url=None):
-        state_json=json.dumps(stream_state, cls=json_encoder)
-        with open(state_path, 'w', encoding='utf-8') as f:
-            f.write(state_json)
+    def mark_dirty(self, stream_state):
+        self._source=stream_state
+        self._dirty=True
+        self.version += 1
+        self.stats['marked'] += 1
 
-        try: 
-            if self.state_url is not None:
-                # TODO - re-use client object
-                async with httpx.AsyncClient() as client:
-                    r=await client.put(self.state_url, data=state_json, timeout=self.http_timeout)
-                    r.raise_for_status()
-                    return True
-        except (httpx.HTTPError, httpx.InvalidURL) as e:
-            self.logger.error(f'state.write failed over HTTP: {e}')
+        for listener in self._listeners:
+            listener()
 
-    def _load_data(self, struct):
-        try:
-            state={}
-            for k, s_state in struct.items():
+        if self._writer is None or self._writer.done():
+            self._wakeup=asyncio.Event()
+            self._write_lock=asyncio.Lock()
+            self._writer=asyncio.create_task(self._writer_task())
+
+        self._wakeup.set()
 
-                s_config=stream_config(**(s_state['config']))
-                del s_state['config']
+    # listener() is called (on the event loop) whenever the state changes
+    def add_listener(self, listener):
+        self._listeners.append(listener)
 
-                state[k]=stream_state(
-                    **s_state,
-                    config=s_config
-                )
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
 
-            return state
+    """
+    the current state serialized: (version, parts, state_json, etag), where parts maps each
+    stream ID to its own JSON. only re-serialized after a change; stream_state is needed until
+    the first mark_dirty()
+    """
+    def snapshot(self, stream_state=None):
+        if stream_state is not None and stream_state is not self._source:
+            self._source=stream_state
+            self._snapshot=None
+        source=self._source if self._source is not None else {}
+
+        if self._snapshot is None or self._snapshot[0] != self.version or self._snapshot[1] != id(source):
+            parts=self.codec.encode_all(source)
+            state_json=join(parts)
+            etag=hashlib.blake2b(state_json.encode(), digest_size=12).hexdigest()
+            self._snapshot=(self.version, id(source), parts, state_json, etag)
+
+        version, _, parts, state_json, etag=self._snapshot
+        return version, parts, state_json, etag
+
+    # kept for callers which expect the old interface; state_path and state_url are
+    # fixed at initialization
+    async def write(self, stream_state, state_path=None, state_url=None):
+        self.mark_dirty(stream_state)
+
+    async def _writer_task(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            try:
+                await self._write_snapshot()
+            except Exception as e:
+                self.logger.error(f'state._writer_task: write failed: {e}')
+
+            # anything marked during this interval is picked up by the next iteration
+            await asyncio.sleep(self.write_interval)
+
+    async def _write_snapshot(self):
+        async with self._write_lock:
+            if not self._dirty:
+                return
+
+            # serialize on the loop so the snapshot is consistent with respect to mutations.
+            # streams are encoded individually so the replicator can diff them cheaply
+            self._dirty=False
+            _, parts, state_json, _=self.snapshot()
+
+            t=time.monotonic()
+            loop=asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, atomic_write, self.state_path, state_json)
+            except BaseException:
+                # try again on the next write
+                self._dirty=True
+                raise
+
+            self.stats['written'] += 1
+            self.stats['last_write_bytes']=len(state_json)
+            self.stats['last_write_sec']=time.monotonic() - t
+            self.stats['write_bytes_total'] += len(state_json)
+            self.stats['write_sec_total'] += self.stats['last_write_sec']
+
+            if self.replicator is not None:
+                self.replicator.submit(state_json, parts)
+
+    """
+    write any pending state immediately, bypassing write_interval
+    """
+    async def flush(self):
+        if self._writer is None:
+            return
+        await self._write_snapshot()
 
-        except KeyError as e:
-            self._logger.warning(f'_load_data failed: {str(e)}') # TODO
+    """
+    stop the writer task after writing any pending state; used on shutdown
+    """
+    async def close(self):
+        if self._writer is None:
+            return
+
+        # don't cancel the writer in the middle of a write: the executor thread would keep
+        # running and could rename an older snapshot over the one written by flush()
+        async with self._write_lock:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+
+        await self.flush()
+        self._writer=None
+
+        if self.replicator is not None:
+            await self.replicator.close()
+
+    def _load_data(self, text, source):
+        try:
+            state=self.codec.decode(text)
+        except CodecError as e:
+            self.logger.error(f'state.load failed from {source}: {e}')
             return None
+        self.logger.info(f'state.load: loaded {len(state)} streams from {source}')
+        return state
 
     async def load(self):
 
@@ -63,7 +200,7 @@ class state():
                 async with httpx.AsyncClient() as client:
                     r=await client.get(self.state_url, timeout=self.http_timeout)
                     r.raise_for_status()
-                    return self._load_data(r.json())
+                    return self._load_data(r.text, 'HTTP')
         except (httpx.HTTPError, httpx.InvalidURL) as e:
             self.logger.error(f'state.load failed over HTTP: {e}')
 
@@ -71,12 +208,6 @@ class state():
         # if we did not return above, fall back to reading from local file
         try:
             with open(self.state_path, 'r', encoding='utf-8') as f:
-                try:
-                    struct=json.load(f)
-                    return self._load_data(struct)
-                except json.JSONDecodeError as e:
-                    self.logger.error(f'state.load failed from file: {e}')
-
+                return self._load_data(f.read(), 'file')
         except FileNotFoundError:
             return None
-
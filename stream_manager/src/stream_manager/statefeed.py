@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from aiohttp import web
+
+from stream_manager.codec import join
+
+"""
+the /state API, served from the state's cached serialization (see state.snapshot) instead of
+re-encoding the state for every request
+
+- GET /state: the whole state; GET /state?stream=a,b: only the given streams
+- GET /state/{stream}: one stream (404 if it has no state)
+- GET /state/events[?stream=a,b]: server-sent events. a 'snapshot' event with the (filtered)
+  state on connect, then 'update' ({stream: state}) and 'remove' ({stream: null}) events as
+  streams change, so consumers don't have to poll
+
+responses carry an ETag; a request with a matching If-None-Match gets 304 Not Modified.
+
+changes are published by a single task which diffs the per-stream JSON of consecutive
+snapshots, coalescing bursts of mutations. a subscriber whose queue fills up (because it isn't
+reading) is disconnected; it gets a fresh snapshot when it reconnects.
+"""
+
+class state_feed():
+
+    def __init__(self, state, get_source, heartbeat=15, queue_size=100) -> None:
+        self.state=state
+        # returns the manager's current stream_state dict
+        self.get_source=get_source
+        self.heartbeat=heartbeat
+        self.queue_size=queue_size
+        self.logger=logging.getLogger('stream_manager')
+
+        self._subscribers=set()
+        self._wakeup=asyncio.Event()
+        self._task=None
+        # per-stream JSON as last published
+        self._published={}
+
+        self.state.add_listener(self._wakeup.set)
+
+    def snapshot(self):
+        return self.state.snapshot(self.get_source())
+
+    def close(self):
+        self.state.remove_listener(self._wakeup.set)
+        if self._task is not None:
+            self._task.cancel()
+        for q in self._subscribers:
+            while not q.empty():
+                q.get_nowait()
+            q.put_nowait(None)
+
+    @staticmethod
+    def _streams(request):
+        values=request.query.getall('stream', [])
+        streams=[s for v in values for s in v.split(',') if len(s) > 0]
+        return set(streams) if len(streams) > 0 else None
+
+    @staticmethod
+    def _json_response(request, body, etag):
+        etag=f'"{etag}"'
+        headers={'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=body, content_type='application/json', headers=headers)
+
+    async def get(self, request, match):
+        version, parts, state_json, etag=self.snapshot()
+
+        streams=self._streams(request)
+        if streams is None:
+            return self._json_response(request, state_json, etag)
+
+        body=join({k: v for k, v in parts.items() if k in streams})
+        return self._json_response(request, body, _etag(body))
+
+    async def get_stream(self, request, match):
+        version, parts, state_json, etag=self.snapshot()
+        part=parts.get(match['stream'])
+        if part is None:
+            return web.Response(status=404, text='{}', content_type='application/json')
+        return self._json_response(request, part, _etag(part))
+
+    async def _publish_task(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            version, parts, _, _=self.snapshot()
+            changes={}
+            for k, v in parts.items():
+                if self._published.get(k) != v:
+                    changes[k]=v
+            removed=[k for k in self._published if k not in parts]
+            self._published=parts
+
+            for q in list(self._subscribers):
+                try:
+                    q.put_nowait((version, changes, removed))
+                except asyncio.QueueFull:
+                    self.logger.warning('state_feed: subscriber is not keeping up, disconnecting')
+                    self._subscribers.discard(q)
+                    # make room for the end marker
+                    while not q.empty():
+                        q.get_nowait()
+                    q.put_nowait(None)
+
+            # coalesce bursts of changes
+            await asyncio.sleep(0.1)
+
+    async def events(self, request, match):
+        streams=self._streams(request)
+
+        resp=web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await resp.prepare(request)
+
+        if self._task is None or self._task.done():
+            self._published=self.snapshot()[1]
+            self._task=asyncio.create_task(self._publish_task())
+
+        q=asyncio.Queue(self.queue_size)
+        self._subscribers.add(q)
+        try:
+            version, parts, _, _=self.snapshot()
+            parts={k: v for k, v in parts.items() if streams is None or k in streams}
+            await resp.write(_event('snapshot', version, join(parts)))
+
+            while True:
+                try:
+                    item=await asyncio.wait_for(q.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    await resp.write(b': keepalive\n\n')
+                    continue
+                if item is None:
+                    break
+
+                version, changes, removed=item
+                changes={k: v for k, v in changes.items() if streams is None or k in streams}
+                removed=[k for k in removed if streams is None or k in streams]
+                if len(changes) > 0:
+                    await resp.write(_event('update', version, join(changes)))
+                if len(removed) > 0:
+                    await resp.write(_event('remove', version, json.dumps({k: None for k in removed})))
+        except ConnectionResetError:
+            pass
+        finally:
+            self._subscribers.discard(q)
+
+        return resp
+
+
+def _etag(body):
+    return hashlib.blake2b(body.encode(), digest_size=12).hexdigest()
+
+def _event(name, version, data):
+    return f'id: {version}\nevent: {name}\ndata: {data}\n\n'.encode()
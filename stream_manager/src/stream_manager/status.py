@@ -0,0 +1,98 @@
+import abc
+import logging
+
+import httpx
+
+"""
+status probes: decide which streams are live before spawning any download process
+
+probe() takes a list of stream IDs and returns a dict mapping each of them to True (live),
+False (offline) or None (unknown: the probe could not tell, e.g. the request failed)
+"""
+class status_probe(abc.ABC):
+
+    # whether the manager should skip probing and run the per-stream spawn path instead
+    spawns=False
+
+    @abc.abstractmethod
+    async def probe(self, s_ids):
+        pass
+
+    async def close(self):
+        pass
+
+
+"""
+the original behaviour: there is no separate probe, the manager finds out whether a stream is
+live by running download_script for it (try_stream with poll_attempt=True)
+"""
+class script_status_probe(status_probe):
+    spawns=True
+
+    async def probe(self, s_ids):
+        return {s_id: None for s_id in s_ids}
+
+
+"""
+check many streams with a single HTTP request per batch_size streams, e.g. against the Twitch
+Helix API:
+    GET {url}?user_login=a&user_login=b&...
+    -> {"data": [{"user_login": "a", ...}, ...]}    (only live streams are listed)
+
+alternatively, the endpoint may return a plain object mapping stream IDs to booleans
+"""
+class http_status_probe(status_probe):
+
+    def __init__(self, url, headers=None, param='user_login', login_field='user_login',
+        batch_size=100, timeout=10) -> None:
+
+        self.url=url
+        self.param=param
+        self.login_field=login_field
+        self.batch_size=batch_size
+        self.logger=logging.getLogger('stream_manager')
+
+        self._client=httpx.AsyncClient(headers=headers, timeout=timeout)
+
+    async def probe(self, s_ids):
+        ret={}
+        for i in range(0, len(s_ids), self.batch_size):
+            batch=s_ids[i:i+self.batch_size]
+            try:
+                ret.update(await self._probe_batch(batch))
+            except (httpx.HTTPError, httpx.InvalidURL, ValueError) as e:
+                self.logger.error(f'http_status_probe: request for {len(batch)} streams failed: {e}')
+                ret.update({s_id: None for s_id in batch})
+        return ret
+
+    async def _probe_batch(self, batch):
+        r=await self._client.get(self.url, params=[(self.param, s_id) for s_id in batch])
+        r.raise_for_status()
+        data=r.json()
+
+        if isinstance(data, dict) and isinstance(data.get('data'), list):
+            live=set(
+                str(x.get(self.login_field, '')).lower() for x in data['data']
+            )
+            return {s_id: s_id.lower() in live for s_id in batch}
+        elif isinstance(data, dict):
+            return {s_id: bool(data.get(s_id, False)) for s_id in batch}
+
+        raise ValueError(f'unexpected response: {type(data)}')
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def make_status_probe(config):
+    if config is None:
+        return script_status_probe()
+
+    config=dict(config)
+    t=config.pop('type', 'script')
+    if t == 'script':
+        return script_status_probe()
+    elif t == 'http':
+        return http_status_probe(**config)
+
+    raise ValueError(f'unknown status_probe type: {t}')
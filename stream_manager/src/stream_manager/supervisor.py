@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+"""
+owns every task the manager starts, replacing the list of awaitables
+
+- stream tasks (try_stream): at most one active task per stream, plus at most one follow-up
+  which starts when the active one finishes (an /online signal arriving during a poll attempt).
+  further signals for a stream which is already covered are dropped without creating a task
+- service tasks: long-running tasks such as poll tasks, the probe task and pipeline workers
+
+finished tasks are reaped as soon as they finish (from a done callback), and their exceptions
+logged, so the number of tasks held stays bounded by the number of streams.
+
+stop(key) asks a stream's task to finish: try_stream checks stopping(key) between retries
+(see manager.offline_handler and kill_handler); cancel(key) cancels it outright.
+"""
+
+class supervisor():
+
+    def __init__(self) -> None:
+        self.logger=logging.getLogger('stream_manager')
+
+        # key -> active task
+        self._active={}
+        # key -> factory for the task to start when the active one finishes
+        self._next={}
+        self._stopping=set()
+        self._services=set()
+        self._idle=asyncio.Event()
+        self._idle.set()
+
+        self.stats={
+            'started': 0,
+            'queued': 0,
+            'dropped': 0,
+            'failed': 0,
+            'cancelled': 0,
+        }
+
+    def _update_idle(self):
+        if len(self._active) == 0 and len(self._services) == 0:
+            self._idle.set()
+        else:
+            self._idle.clear()
+
+    def _log_result(self, name, task):
+        if task.cancelled():
+            self.stats['cancelled'] += 1
+            return
+        e=task.exception()
+        if e is not None:
+            self.stats['failed'] += 1
+            self.logger.error(f'supervisor({name}): exception: {e}', exc_info=e)
+
+    def active(self, key):
+        return key in self._active
+
+    """
+    start factory() as key's task, unless key already has one. with follow_up, a busy key gets
+    factory as its next task instead (replacing any earlier follow-up). returns True if a task
+    was started or queued
+    """
+    def spawn(self, key, factory, follow_up=False):
+        if key in self._active:
+            if not follow_up or key in self._next:
+                self.stats['dropped'] += 1
+                return False
+            self._next[key]=factory
+            self.stats['queued'] += 1
+            return True
+
+        task=asyncio.create_task(factory())
+        self._active[key]=task
+        self.stats['started'] += 1
+        task.add_done_callback(lambda t: self._stream_done(key, t))
+        self._update_idle()
+        return True
+
+    def _stream_done(self, key, task):
+        if self._active.get(key) is task:
+            del self._active[key]
+        self._stopping.discard(key)
+        self._log_result(key, task)
+
+        factory=self._next.pop(key, None)
+        if factory is not None:
+            self.spawn(key, factory)
+        self._update_idle()
+
+    # start factory() as key's task and wait for it; returns immediately if key is busy
+    async def run(self, key, factory):
+        if not self.spawn(key, factory):
+            return
+        task=self._active[key]
+        await asyncio.wait([task])
+
+    def add_service(self, task, name='service'):
+        self._services.add(task)
+        def done(t):
+            self._services.discard(t)
+            self._log_result(name, t)
+            self._update_idle()
+        task.add_done_callback(done)
+        self._update_idle()
+        return task
+
+    # ask key's task to finish (see stopping()); drops any follow-up
+    def stop(self, key):
+        self._next.pop(key, None)
+        if key in self._active:
+            self._stopping.add(key)
+            return True
+        return False
+
+    def stopping(self, key):
+        return key in self._stopping
+
+    def cancel(self, key):
+        self._next.pop(key, None)
+        task=self._active.get(key)
+        if task is None:
+            return False
+        self._stopping.add(key)
+        task.cancel()
+        return True
+
+    # wait until there are no tasks left
+    async def join(self):
+        while True:
+            await self._idle.wait()
+            # a done callback may have started a follow-up
+            await asyncio.sleep(0)
+            if self._idle.is_set():
+                return
+
+    async def shutdown(self):
+        tasks=list(self._services) + list(self._active.values())
+        self._next.clear()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stream_keys(self):
+        return list(self._active.keys())
+
+    def counts(self):
+        return {
+            'streams': len(self._active),
+            'follow_ups': len(self._next),
+            'services': len(self._services),
+        }
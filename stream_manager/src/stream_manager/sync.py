@@ -0,0 +1,410 @@
+import argparse
+import base64
+import concurrent.futures
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+
+import yaml
+
+from stream_manager.crypt import openssl_enc
+from stream_manager import manifest as mf
+
+"""
+archive sync: a Python replacement for s3-sync.sh
+
+files are uploaded by a bounded pool of workers, each streaming one file at a time (multipart
+for anything larger than part_size). object names are encrypted in-process with the same
+OPENSSL_ARGS as the script, so existing keys stay valid. each upload is verified against the
+ETag S3 returns for it (MD5 of the body, or of the part MD5s for multipart uploads) instead of
+a separate HEAD request, after which the local file is deleted, like `aws s3 mv`.
+
+with a manifest (sync.manifest_path), every upload is recorded there: an interrupted multipart
+upload is resumed from its last finished part on the next run, and a file already archived with
+the same name and content is not uploaded again. since resumed uploads are no longer aborted,
+the bucket should have a lifecycle rule expiring incomplete multipart uploads.
+
+requires boto3 and cryptography (pip install tw-etl[sync]).
+"""
+
+MiB=1024 * 1024
+
+# storage class by file type, as in s3-sync.sh
+STORAGE_CLASSES=[
+    ('.json.gz', 'DEEP_ARCHIVE'),
+    ('.mkv', 'DEEP_ARCHIVE'),
+    ('.pkt', 'DEEP_ARCHIVE'),
+    ('.json', 'STANDARD_IA'),
+]
+
+def storage_class(path):
+    for suffix, c in STORAGE_CLASSES:
+        if path.endswith(suffix):
+            return c
+    return None
+
+
+class VerifyError(Exception):
+    pass
+
+
+class s3_uploader():
+
+    def __init__(self, bucket, encryptor, prefix='tw/', region='us-east-2', profile=None,
+        endpoint_url=None, concurrency=4, part_size=64*MiB, manifest=None) -> None:
+
+        import boto3
+
+        self.bucket=bucket
+        self.encryptor=encryptor
+        self.prefix=prefix
+        self.concurrency=concurrency
+        # S3's minimum part size
+        self.part_size=max(part_size, 5*MiB)
+        self.manifest=manifest
+        self.logger=logging.getLogger('stream_manager')
+
+        session=boto3.session.Session(profile_name=profile, region_name=region)
+        self._s3=session.client('s3', endpoint_url=endpoint_url)
+
+    def key(self, path):
+        return self.prefix + self.encryptor.encrypt(os.path.basename(path))
+
+    """
+    upload one file and delete it once S3 has confirmed the content; returns a dict describing
+    the stored object
+    """
+    def upload(self, path, storage_class, delete=True):
+        size=os.stat(path).st_size
+
+        resume=None
+        if self.manifest is None:
+            key=self.key(path)
+        else:
+            dup=self._archived(path, size)
+            if dup is not None:
+                self.logger.info(f'sync: {path} is already archived as {dup["key"]}, skipping')
+                if delete:
+                    os.unlink(path)
+                return {
+                    'etag': dup['etag'],
+                    'sha256': dup['sha256'],
+                    'path': path,
+                    'key': dup['key'],
+                    'size': size,
+                    'storage_class': dup['storage_class'],
+                    'skipped': True,
+                }
+
+            rec=self.manifest.get(path)
+            if rec is not None and rec['status'] != mf.DONE and rec['size'] == size \
+                and rec['storage_class'] == storage_class:
+                # interrupted earlier: keep the key, and the multipart upload if there is one
+                key=rec['key']
+                if rec['upload_id'] is not None:
+                    resume=(rec['upload_id'], json.loads(rec['parts'] or '[]'))
+            else:
+                if rec is not None and rec['status'] != mf.DONE and rec['upload_id'] is not None:
+                    self._abort(path, rec['key'], rec['upload_id'])
+                key=self.key(path)
+                self.manifest.begin(path, key, size, storage_class)
+
+        self.logger.info(f'sync: uploading {path} ({size} bytes, {storage_class})')
+        try:
+            if size <= self.part_size:
+                result=self._put(path, key, storage_class)
+            else:
+                result=self._multipart(path, key, storage_class, resume)
+        except BaseException as e:
+            if self.manifest is not None:
+                self.manifest.fail(path, repr(e))
+            raise
+
+        if self.manifest is not None:
+            self.manifest.finish(path, result['etag'], result['sha256'])
+
+        result.update({
+            'path': path,
+            'key': key,
+            'size': size,
+            'storage_class': storage_class,
+        })
+        if delete:
+            os.unlink(path)
+        return result
+
+    # the manifest entry of an archived file with the same name and content, if any
+    def _archived(self, path, size):
+        candidates=self.manifest.archived(os.path.basename(path), size)
+        if len(candidates) == 0:
+            return None
+        sha256=_sha256(path)
+        for c in candidates:
+            if c['sha256'] == sha256:
+                return c
+        return None
+
+    def _abort(self, path, key, upload_id):
+        try:
+            self._s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            self.logger.warning(f'sync: could not abort upload of {path}: {e}')
+
+    def _put(self, path, key, storage_class):
+        with open(path, 'rb') as f:
+            body=f.read()
+        md5=hashlib.md5(body)
+
+        r=self._s3.put_object(
+            Bucket=self.bucket, Key=key, Body=body, StorageClass=storage_class,
+            ContentMD5=base64.b64encode(md5.digest()).decode(),
+        )
+        _verify(r['ETag'], md5.hexdigest(), path)
+        return {
+            'etag': r['ETag'].strip('"'),
+            'sha256': hashlib.sha256(body).hexdigest(),
+        }
+
+    """
+    parts of an earlier multipart upload which S3 still has and which match the file, in order
+    from part 1; [] if the upload is gone or the file no longer matches
+    """
+    def _resumable_parts(self, path, key, upload_id, recorded):
+        try:
+            listed=self._s3.list_parts(Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except self._s3.exceptions.NoSuchUpload:
+            return []
+        uploaded={p['PartNumber']: p['ETag'] for p in listed.get('Parts', [])}
+
+        parts=[]
+        with open(path, 'rb') as f:
+            for p in sorted(recorded, key=lambda p: p['PartNumber']):
+                if p['PartNumber'] != len(parts) + 1 or uploaded.get(p['PartNumber']) != p['ETag']:
+                    break
+                if hashlib.md5(f.read(self.part_size)).hexdigest() != p['md5']:
+                    break
+                parts.append(p)
+        return parts
+
+    def _multipart(self, path, key, storage_class, resume=None):
+        done=[]
+        if resume is not None:
+            upload_id, recorded=resume
+            done=self._resumable_parts(path, key, upload_id, recorded)
+            if len(done) == 0:
+                self._abort(path, key, upload_id)
+                resume=None
+            else:
+                self.logger.info(f'sync: resuming upload of {path} after part {len(done)}')
+
+        if resume is None:
+            upload_id=self._s3.create_multipart_upload(
+                Bucket=self.bucket, Key=key, StorageClass=storage_class,
+            )['UploadId']
+            if self.manifest is not None:
+                self.manifest.set_upload_id(path, upload_id)
+
+        try:
+            sha256=hashlib.sha256()
+            part_md5s=[]
+            parts=[]
+            with open(path, 'rb') as f:
+                # already uploaded parts only need to be hashed
+                for p in done:
+                    chunk=f.read(self.part_size)
+                    sha256.update(chunk)
+                    part_md5s.append(bytes.fromhex(p['md5']))
+                    parts.append({'PartNumber': p['PartNumber'], 'ETag': p['ETag']})
+
+                while True:
+                    chunk=f.read(self.part_size)
+                    if len(chunk) == 0:
+                        break
+                    sha256.update(chunk)
+                    md5=hashlib.md5(chunk)
+                    n=len(parts) + 1
+
+                    r=self._s3.upload_part(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=n, Body=chunk,
+                        ContentMD5=base64.b64encode(md5.digest()).decode(),
+                    )
+                    _verify(r['ETag'], md5.hexdigest(), f'{path} part {n}')
+                    part_md5s.append(md5.digest())
+                    parts.append({'PartNumber': n, 'ETag': r['ETag']})
+                    if self.manifest is not None:
+                        self.manifest.add_part(path, {
+                            'PartNumber': n, 'ETag': r['ETag'], 'md5': md5.hexdigest(),
+                        })
+
+            r=self._s3.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException as e:
+            # with a manifest, the upload is resumed on the next run (unless it's corrupt)
+            if self.manifest is None or isinstance(e, VerifyError):
+                self._abort(path, key, upload_id)
+                if self.manifest is not None:
+                    self.manifest.set_upload_id(path, None)
+            raise
+
+        expected=f'{hashlib.md5(b"".join(part_md5s)).hexdigest()}-{len(parts)}'
+        _verify(r['ETag'], expected, path)
+        return {
+            'etag': r['ETag'].strip('"'),
+            'sha256': sha256.hexdigest(),
+        }
+
+    """
+    upload all of paths with up to concurrency uploads at a time; returns (results, errors)
+    """
+    def upload_all(self, paths):
+        results=[]
+        errors=[]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures={
+                pool.submit(self.upload, path, storage_class(path)): path for path in paths
+            }
+            for fut in concurrent.futures.as_completed(futures):
+                path=futures[fut]
+                try:
+                    results.append(fut.result())
+                except Exception as e:
+                    self.logger.error(f'sync: upload of {path} failed: {e}')
+                    errors.append((path, e))
+        return results, errors
+
+
+def _sha256(path):
+    h=hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk=f.read(MiB)
+            if len(chunk) == 0:
+                return h.hexdigest()
+            h.update(chunk)
+
+
+def _verify(etag, expected, what):
+    if etag.strip('"') != expected:
+        raise VerifyError(f'{what}: ETag {etag} does not match {expected}')
+
+
+"""
+files to upload from each ready directory, in the order s3-sync.sh uploads them; a directory is
+only synced if it contains .mkv files
+"""
+def ready_files(readydirs):
+    paths=[]
+    for d in readydirs:
+        mkv=sorted(glob.glob(os.path.join(d, '*.mkv')))
+        if len(mkv) == 0:
+            logging.getLogger('stream_manager').info(f'sync: no mkv files found in {d}')
+            continue
+        paths+=mkv
+        for pattern in ('*.json', '*.json.gz', '*.pkt'):
+            paths+=sorted(glob.glob(os.path.join(d, pattern)))
+    return paths
+
+
+def readydirs(config):
+    if 'readydirs' in config:
+        return config['readydirs']
+
+    # $TW_BASE/sync/readydir-list.txt, with paths relative to $TW_BASE
+    base=config['base']
+    with open(config.get('readydir_list', os.path.join(base, 'sync', 'readydir-list.txt'))) as f:
+        return [os.path.join(base, line.strip()) for line in f if len(line.strip()) > 0]
+
+
+"""
+lock out other sync runs (flock on $base/sync/lock); returns the lock's fd, or None if another
+process holds it
+"""
+def acquire_lock(config):
+    lock_path=config.get('lock_path', os.path.join(config.get('base', '.'), 'sync', 'lock'))
+    lock_fd=os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        logging.getLogger('stream_manager').info(f'{lock_path} is locked')
+        return None
+    return lock_fd
+
+
+def make_manifest(config):
+    path=config.get('manifest_path')
+    if path is None:
+        return None
+    return mf.manifest(path)
+
+
+def make_uploader(config, manifest=None):
+    openssl_args=config.get('openssl_args', os.environ.get('OPENSSL_ARGS'))
+    if openssl_args is None:
+        raise ValueError('sync: openssl_args not configured and OPENSSL_ARGS not set')
+
+    return s3_uploader(
+        bucket=config.get('bucket', os.environ.get('AWS_BUCKET')),
+        encryptor=openssl_enc(openssl_args),
+        prefix=config.get('prefix', 'tw/'),
+        region=config.get('region', 'us-east-2'),
+        profile=config.get('profile', os.environ.get('AWS_PROFILE')),
+        endpoint_url=config.get('endpoint_url'),
+        concurrency=config.get('concurrency', 4),
+        part_size=config.get('part_size_mb', 64) * MiB,
+        manifest=manifest,
+    )
+
+
+def main():
+    prs=argparse.ArgumentParser(
+        prog='stream_manager.sync',
+        description='upload ready files to S3 (see the sync section of the config)',
+    )
+    prs.add_argument('--config', required=True)
+    sub=prs.add_subparsers(dest='command')
+    sub.add_parser('upload', help='upload ready files (default)')
+    find=sub.add_parser('find', help='list archived files of a stream from the manifest')
+    find.add_argument('stream')
+    find.add_argument('--date', help='date or datestr prefix, e.g. 2026-10-18')
+    args=vars(prs.parse_args())
+
+    logger=logging.getLogger('stream_manager')
+    logger.setLevel(logging.INFO)
+    h=logging.StreamHandler(stream=sys.stdout)
+    h.setFormatter(logging.Formatter(fmt='[%(asctime)s] %(message)s'))
+    logger.addHandler(h)
+
+    with open(args['config'], 'rb') as f:
+        config=yaml.safe_load(f)['sync']
+
+    if args['command'] == 'find':
+        manifest=make_manifest(config)
+        if manifest is None:
+            logger.error('sync: manifest_path is not configured')
+            return 1
+        for rec in manifest.find(args['stream'], args['date']):
+            print(f'{rec["datestr"]}\t{rec["name"]}\t{rec["size"]}\t{rec["storage_class"]}\t{rec["key"]}')
+        return 0
+
+    if acquire_lock(config) is None:
+        return 0
+
+    manifest=make_manifest(config)
+    uploader=make_uploader(config, manifest)
+    results, errors=uploader.upload_all(ready_files(readydirs(config)))
+    skipped=len([r for r in results if r.get('skipped')])
+    logger.info(f'sync: uploaded {len(results) - skipped} files, skipped {skipped}, {len(errors)} errors')
+    if manifest is not None:
+        manifest.close()
+    return 1 if len(errors) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# session assembly (assemble.py) on tiny generated recordings (see media.py)
+#
+# one session with:
+#   _0  2s, timestamps from 0
+#   _1  empty                                   -> deleted
+#   _2  2s, timestamps from 5s                  -> gap measured by start_time
+#   _3  not a media file                        -> dropped as unreadable
+#   _4  2s, timestamps from 0 (a restart)       -> gap measured by modification time
+#   _5  0.3s                                    -> dropped as truncated
+#   _6  2s, at a different resolution           -> its own output
+#
+# checks the outputs, what was dropped (and where it went), and the fragment and gap offsets
+# in the session sidecars.
+#
+# usage: assemble_test.py (or pytest test/assemble_test.py); needs ffmpeg and ffprobe on PATH
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager.assemble import assembler
+from stream_manager.mediainfo import probe_cache
+
+import media
+
+
+SESSION='s1_720p_2026-10-18T12:00:00.000000'
+
+
+def close(a, b, tolerance=0.1):
+    return abs(a - b) <= tolerance
+
+
+async def assemble(d):
+    in_dir=os.path.join(d, 'fragments')
+    out_dir=os.path.join(d, 'convert')
+    sidecar_dir=os.path.join(d, 'out')
+    for x in (in_dir, out_dir, sidecar_dir):
+        os.makedirs(x)
+
+    def fragment(retry_id):
+        return os.path.join(in_dir, f'{SESSION}_{retry_id}.mkv')
+
+    media.make_clip(fragment(0), seconds=2)
+    open(fragment(1), 'wb').close()
+    media.make_clip(fragment(2), seconds=2, offset=5)
+    with open(fragment(3), 'wb') as f:
+        f.write(os.urandom(4096))
+    media.make_clip(fragment(4), seconds=2)
+    media.make_clip(fragment(5), seconds=0.3)
+    media.make_clip(fragment(6), seconds=2, size='320x240')
+
+    # each recording is written until its download ends: _2 ends 10s after _0, _4 20s after _2
+    now=time.time() - 3600
+    for retry_id, t in ((0, now), (2, now + 10), (4, now + 30), (6, now + 40)):
+        os.utime(fragment(retry_id), (t, t))
+
+    config={'in_dir': in_dir, 'min_duration_sec': 1.0, 'settle_sec': 0}
+    a=assembler(config, out_dir, sidecar_dir, probe_cache())
+    try:
+        key=a.session_key(fragment(0))
+        assert key == os.path.join(in_dir, SESSION), key
+        assert a.scan() == 1 and a.queue.pending() == [key]
+
+        result=await a.assemble(key)
+    finally:
+        a.queue.close()
+        a.probes.close()
+
+    assert result['outputs'] == [
+        os.path.join(out_dir, f'{SESSION}_0.mkv'), os.path.join(out_dir, f'{SESSION}_6.mkv'),
+    ], result['outputs']
+    assert result['sidecars'] == [
+        os.path.join(sidecar_dir, f'{SESSION}_0.mkv_session.json'),
+        os.path.join(sidecar_dir, f'{SESSION}_6.mkv_session.json'),
+    ], result['sidecars']
+
+    reasons={x['file']: x['reason'] for x in result['dropped']}
+    assert sorted(reasons) == [f'{SESSION}_{i}.mkv' for i in (1, 3, 5)], reasons
+    assert reasons[f'{SESSION}_1.mkv'] == 'empty'
+    assert reasons[f'{SESSION}_3.mkv'].startswith('unreadable'), reasons
+    assert reasons[f'{SESSION}_5.mkv'].startswith('truncated'), reasons
+
+    # fragments are gone from in_dir: merged, deleted, or moved to dropped_dir
+    assert sorted(os.listdir(in_dir)) == ['dropped', 'queue.json', 'queue.json.lock'], os.listdir(in_dir)
+    assert sorted(os.listdir(os.path.join(in_dir, 'dropped'))) == [f'{SESSION}_{i}.mkv' for i in (3, 5)]
+
+    # merged by stream copy: as long as its fragments
+    with open(result['sidecars'][0]) as f:
+        timing=json.load(f)
+    fragments=timing['fragments']
+    assert [x['retry_id'] for x in fragments] == [0, 2, 4], fragments
+    streams={s['codec_type']: s for s in media.probe_streams(result['outputs'][0])}
+    assert (streams['video']['codec_name'], streams['video']['width']) == ('h264', 160), streams
+
+    offset=0.0
+    for x in fragments:
+        assert close(x['offset'], offset), (x, offset)
+        offset += x['duration']
+    assert close(timing['duration'], offset)
+
+    gaps=timing['gaps']
+    assert [(g['after_retry_id'], g['source']) for g in gaps] == [(0, 'start_time'), (2, 'mtime')], gaps
+    # _2 starts 5s into the stream, 2s after _0 ended
+    assert close(gaps[0]['seconds'], 3.0), gaps
+    assert gaps[0]['offset'] == fragments[1]['offset']
+    # _4 restarted its timestamps: it was written for its duration until 20s after _2 ended
+    assert close(gaps[1]['seconds'], 20.0 - fragments[2]['duration']), gaps
+    assert gaps[1]['offset'] == fragments[2]['offset']
+    assert timing['dropped'] == result['dropped']
+
+    # a run of one is moved as it is
+    with open(result['sidecars'][1]) as f:
+        timing=json.load(f)
+    assert [x['retry_id'] for x in timing['fragments']] == [6] and timing['gaps'] == [], timing
+    assert timing['dropped'] == []
+    streams={s['codec_type']: s for s in media.probe_streams(result['outputs'][1])}
+    assert streams['video']['width'] == 320, streams
+
+
+def test_assemble():
+    media.require_ffmpeg()
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(assemble(d))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    try:
+        test_assemble()
+    except unittest.SkipTest as e:
+        print(f'skipped: {e}')
+        sys.exit(0)
+    print('ok')
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# cluster failover against the stand-in state server (state_server.py), run in-process
+#
+# two nodes join through a lease document; node1 holds some streams. then node1 stops renewing
+# its lease, and node2 has to take over node1's streams from node1's state document (as the
+# same sessions) and remove them from it - including when one of them is already gone from the
+# document. forwarding is checked against a stand-in for node1's HTTP API, including a reply
+# which isn't JSON.
+#
+# usage: cluster_test.py (or pytest test/cluster_test.py)
+
+import asyncio
+import logging
+import os
+import sys
+
+import httpx
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager.cluster import cluster, FORWARDED_HEADER
+from stream_manager.codec import state_codec, join
+from stream_manager.common import stream_state, stream_config
+
+import state_server
+
+
+TTL=1.0
+
+
+async def serve(app):
+    runner=web.AppRunner(app)
+    await runner.setup()
+    site=web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port=runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+# cond() returns a bool, or an awaitable of one
+async def wait_for(cond, timeout=10 * TTL):
+    loop=asyncio.get_running_loop()
+    deadline=loop.time() + timeout
+    while not await _result(cond()):
+        if loop.time() > deadline:
+            raise AssertionError('timed out')
+        await asyncio.sleep(0.05)
+
+
+async def _result(x):
+    return await x if asyncio.iscoroutine(x) else x
+
+
+def make_state(s_ids):
+    return {
+        s_id: stream_state(
+            pid=4242,
+            retry_id=3,
+            config=stream_config(stream_id=s_id, qid='720p', qlist='720p,best', retries=50),
+            datestr=f'2026-10-18T12:00:00.{i}',
+            log_path=f'/var/log/tw/{s_id}.log',
+            poll_attempt=False,
+            resumed=False,
+        )
+        for i, s_id in enumerate(s_ids)
+    }
+
+
+def node_config(node_id, url, base):
+    return {
+        'node_id': node_id,
+        'url': url,
+        'lease_url': f'{base}/cluster',
+        'lease_ttl_sec': TTL,
+        'renew_interval_sec': TTL / 4,
+    }
+
+
+async def failover():
+    state_runner, base=await serve(state_server.make_app())
+
+    # node1's HTTP API: /online replies with JSON, /kill with plain text
+    api=web.Application()
+    forwarded=[]
+    async def online(request):
+        forwarded.append(request.headers.get(FORWARDED_HEADER))
+        return web.json_response({})
+    async def kill(request):
+        return web.Response(text='ok')
+    api.router.add_post('/online/{stream}', online)
+    api.router.add_post('/kill/{stream}', kill)
+    api_runner, api_url=await serve(api)
+
+    client=httpx.AsyncClient()
+    n1=n2=None
+    try:
+        state1=make_state([f's{i}' for i in range(8)])
+        state2={}
+        state1_url=f'{base}/state/node1'
+        r=await client.put(state1_url, content=join(state_codec().encode_all(state1)))
+        r.raise_for_status()
+
+        async def adopt1(states):
+            raise AssertionError('node1 should not take over anything')
+
+        gone='s5'
+        async def adopt2(states):
+            state2.update(states)
+            # node1 came back just long enough to finish this one
+            r=await client.patch(state1_url, json=[{'op': 'remove', 'path': f'/{gone}'}])
+            r.raise_for_status()
+            return list(states)
+
+        n1=cluster(node_config('node1', api_url, base), state1_url, lambda: state1, adopt1)
+        n2=cluster(node_config('node2', 'http://127.0.0.1:9', base), f'{base}/state/node2', lambda: state2, adopt2)
+        await n1.start()
+        await n2.start()
+        await wait_for(lambda: n1.live == n2.live == {'node1', 'node2'})
+
+        # every stream has exactly one owner, and node1 keeps the ones it is downloading
+        for i in range(100):
+            s_id=f'x{i}'
+            assert n1.owner(s_id) == n2.owner(s_id), s_id
+            assert n1.owns(s_id) != n2.owns(s_id), s_id
+        for s_id in state1:
+            assert n2.owner(s_id) == 'node1', s_id
+
+        assert await n2.forward('node1', '/online/s1') == {}
+        assert forwarded == ['node2']
+        # not JSON: handled by the caller instead
+        assert await n2.forward('node1', '/kill/s1') is None
+
+        # node1 dies: its lease expires, and node2 owns everything
+        await n1.close()
+        n1=None
+        await wait_for(lambda: n2.live == {'node2'} and len(state2) == len(state1))
+
+        for s_id, s in state1.items():
+            assert state2[s_id].retry_id == s.retry_id, s_id
+            assert state2[s_id].datestr == s.datestr, s_id
+        assert n2.counters['adopted'] == len(state1)
+
+        # the taken-over streams are gone from node1's state, so a restarted node1 doesn't
+        # resume them too (they are removed after adopt() returns)
+        doc=None
+        async def removed():
+            nonlocal doc
+            r=await client.get(state1_url)
+            r.raise_for_status()
+            doc=r.json()
+            return doc == {}
+        try:
+            await wait_for(removed)
+        except AssertionError:
+            raise AssertionError(doc)
+    finally:
+        if n1 is not None:
+            await n1.close()
+        if n2 is not None:
+            await n2.close()
+        await client.aclose()
+        await api_runner.cleanup()
+        await state_runner.cleanup()
+
+
+def test_failover():
+    asyncio.run(failover())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    test_failover()
+    print('ok')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# state codec benchmark: times encoding and decoding a state of N streams with codec.py, and
+# with the encoder it replaced (json.dumps with json_encoder per stream), and reports as JSON
+#
+# - encode_cold: every stream encoded (first snapshot after startup)
+# - encode_one_changed: one stream changed since the last snapshot (the common case)
+# - decode: loading the state document
+#
+# usage: codec_bench.py [--streams 10000] [--repeat 5] [--out result.json]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_manager.codec import state_codec, join
+from stream_manager.common import stream_state, stream_config, json_encoder
+
+
+def make_state(n):
+    configs=[stream_config(stream_id=f'bench{i:06d}', qid='720p', qlist='720p,best', retries=50)
+        for i in range(n)]
+    return {
+        c.stream_id: stream_state(
+            pid=100000 + i if i % 4 == 0 else None,
+            retry_id=i % 7,
+            config=c,
+            datestr='20240101_120000',
+            log_path=f'/var/log/stream_manager/{c.stream_id}_20240101_120000.log',
+            poll_attempt=i % 3 == 0,
+            resumed=False,
+        )
+        for i, c in enumerate(configs)
+    }
+
+
+def best(f, repeat):
+    times=[]
+    for _ in range(repeat):
+        t=time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return round(min(times), 6)
+
+
+def legacy_encode(s):
+    parts={k: json.dumps(v, cls=json_encoder) for k, v in s.items()}
+    return '{' + ', '.join(f'{json.dumps(k)}: {v}' for k, v in parts.items()) + '}'
+
+
+# what state.load did before codec.py
+def legacy_decode(text):
+    state={}
+    for k, d in json.loads(text).items():
+        config=stream_config(**d.pop('config'))
+        state[k]=stream_state(**d, config=config)
+    return state
+
+
+def run(args):
+    s=make_state(args['streams'])
+    keys=list(s.keys())
+
+    def cold():
+        for c in (v.config for v in s.values()):
+            try:
+                del c._json
+            except AttributeError:
+                pass
+        return join(state_codec().encode_all(s))
+
+    codec=state_codec()
+    codec.encode_all(s)
+    changed=[0]
+    def one_changed():
+        st=s[keys[changed[0] % len(keys)]]
+        st.retry_id += 1
+        changed[0] += 1
+        return join(codec.encode_all(s))
+
+    text=cold()
+    legacy_text=legacy_encode(s)
+
+    result={
+        'version': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'streams': args['streams'],
+        'codec': {
+            'encode_cold_sec': best(cold, args['repeat']),
+            'encode_one_changed_sec': best(one_changed, args['repeat']),
+            'decode_sec': best(lambda: state_codec().decode(text), args['repeat']),
+            'bytes': len(text.encode()),
+        },
+        'legacy': {
+            'encode_sec': best(lambda: legacy_encode(s), args['repeat']),
+            'decode_sec': best(lambda: legacy_decode(legacy_text), args['repeat']),
+            'bytes': len(legacy_text.encode()),
+        },
+    }
+
+    out=json.dumps(result, indent=4)
+    if args['out'] is not None:
+        with open(args['out'], 'w') as f:
+            f.write(out + '\n')
+    print(out)
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser(description='state codec benchmark for stream_manager')
+    prs.add_argument('--streams', type=int, default=10000)
+    prs.add_argument('--repeat', type=int, default=5)
+    prs.add_argument('--out', help='also write the result to this file')
+    args=vars(prs.parse_args())
+
+    run(args)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# conversion service (convert.py) on tiny generated recordings (see media.py)
+#
+# a video recording is converted to x265 at the fps from fps_dir/{stream}, an audio_only one
+# (whose stream name contains _) to opus at the default fps; both end up in out_dir with their
+# .json and _packets.pkt sidecars, and in_dir and pending_dir are left empty. a job whose
+# conversion raises something unexpected fails on its own, without stopping the run.
+#
+# usage: convert_test.py (or pytest test/convert_test.py); needs ffmpeg and ffprobe on PATH
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager.convert import converter
+from stream_manager.jobqueue import job_queue
+from stream_manager import packets
+
+import media
+
+
+VIDEO='s1_720p_2026-10-18T12:00:00.000000_0.mkv'
+AUDIO='s_2_audio_only_2026-10-18T12:00:00.000000_0.mkv'
+BROKEN='s3_720p_2026-10-18T12:00:00.000000_0.mkv'
+
+
+def make_config(d):
+    config={
+        'in_dir': os.path.join(d, 'in'),
+        'pending_dir': os.path.join(d, 'pending'),
+        'out_dir': os.path.join(d, 'out'),
+        'fps_dir': os.path.join(d, 'fps'),
+        'default_fps': 30,
+        'queue_path': os.path.join(d, 'queue.json'),
+        'stats_path': os.path.join(d, 'stats.jsonl'),
+        'threads': 1,
+        'workers': 2,
+        'preset': 'ultrafast',
+    }
+    for k in ('in_dir', 'pending_dir', 'out_dir', 'fps_dir'):
+        os.makedirs(config[k])
+    return config
+
+
+async def convert(d):
+    config=make_config(d)
+    media.make_clip(os.path.join(config['in_dir'], VIDEO), seconds=2)
+    media.make_clip(os.path.join(config['in_dir'], AUDIO), seconds=2, video=False)
+    media.make_clip(os.path.join(config['in_dir'], BROKEN), seconds=1)
+    with open(os.path.join(config['fps_dir'], 's1'), 'w') as f:
+        f.write('10\n')
+
+    c=converter(config)
+    fps=c.fps
+    def broken_fps(stream):
+        if stream == 's3':
+            raise KeyError('time_base')
+        return fps(stream)
+    c.fps=broken_fps
+    await c.run(once=True)
+
+    out=config['out_dir']
+    assert sorted(os.listdir(out)) == sorted(
+        f'{name}{suffix}' for name in (VIDEO, AUDIO) for suffix in ('', '.json', '_packets.pkt')
+    ), os.listdir(out)
+    # (only the sidecars of the broken recording are left, and rewritten when it is retried)
+    assert all(f.startswith(BROKEN) for f in os.listdir(config['pending_dir'])), os.listdir(config['pending_dir'])
+    # the broken recording stays where it was
+    assert os.listdir(config['in_dir']) == [BROKEN]
+
+    video={s['codec_type']: s for s in media.probe_streams(os.path.join(out, VIDEO))}
+    assert video['video']['codec_name'] == 'hevc', video
+    assert video['video']['avg_frame_rate'] == '10/1', video
+    assert (video['video']['width'], video['video']['height']) == (160, 120), video
+    assert video['audio']['codec_name'] == 'opus', video
+
+    audio=media.probe_streams(os.path.join(out, AUDIO))
+    assert [(s['codec_type'], s['codec_name']) for s in audio] == [('audio', 'opus')], audio
+
+    # sidecars describe the original recordings
+    with open(os.path.join(out, f'{VIDEO}.json'), 'rb') as f:
+        info=json.load(f)
+    assert {s['codec_name'] for s in info['streams']} == {'h264', 'aac'}, info
+    for name in (VIDEO, AUDIO):
+        p=packets.open_packets(os.path.join(out, f'{name}_packets.pkt'))
+        try:
+            assert len(p) > 50, len(p)
+            assert p.time_to_pos(1.0) is not None
+        finally:
+            p.close()
+
+    with open(config['stats_path']) as f:
+        stats={r['file']: r for r in map(json.loads, f)}
+    assert stats[VIDEO]['codec'] == 'x265' and stats[VIDEO]['fps'] == '10', stats[VIDEO]
+    assert stats[AUDIO]['codec'] == 'opus' and stats[AUDIO]['stream'] == 's_2', stats[AUDIO]
+
+    assert c.errors == 3, c.errors
+    q=job_queue(config['queue_path'])
+    try:
+        assert q.stats() == {'pending': 0, 'running': 0, 'done': 2, 'failed': 1}, q.stats()
+        assert q.jobs[os.path.join(config['in_dir'], BROKEN)]['error'] == "'time_base'"
+    finally:
+        q.close()
+
+
+def test_convert():
+    media.require_ffmpeg()
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(convert(d))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    try:
+        test_convert()
+    except unittest.SkipTest as e:
+        print(f'skipped: {e}')
+        sys.exit(0)
+    print('ok')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# filename encryption (crypt.py) against fixed vectors from the openssl command line (3.0):
+#
+#     echo $name | openssl enc $OPENSSL_ARGS | xxd -p | tr -d \\n
+#
+# with an explicit salt (-S), key (-K) or no salt, encryption has to give the same output; with
+# a random salt, openssl's output (with its Salted__ header) has to decrypt to the name.
+#
+# usage: crypt_test.py (or pytest test/crypt_test.py)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_manager.crypt import openssl_enc
+
+
+NAME='s1_720p_2026-10-18T12:00:00.000000_0.mkv'
+
+# OPENSSL_ARGS -> xxd -p output
+VECTORS={
+    '-aes-256-cbc -pbkdf2 -iter 1000 -k secret -S 0102030405060708':
+        '6aa592312f57295a4b5f93c6c0bcfdc9f9a7653b71b642e94447f04a3feade6c'
+        '26ef32e6b71f24194f404f5cfdfea982',
+    '-aes-256-cbc -md md5 -k secret -S 0102030405060708':
+        'a4fbf208eac8dab80429dc0505ff963a07e3bd778b86982319983a1be0ec432a'
+        '224e3a6858282ccb55091b7a4bfc52b6',
+    '-aes-128-ctr -K 000102030405060708090a0b0c0d0e0f -iv 0f0e0d0c0b0a09080706050403020100':
+        '5398a6a5867c2bb7362fceea419fa947769ef094476450745482a1c27909316f'
+        '8befa78cc0ae02ccdb',
+}
+
+# random salt: only decryption can be checked
+SALTED=(
+    '-aes-256-cbc -pbkdf2 -k secret',
+    '53616c7465645f5faabaf86eefd5f70bba98aef6e675ca182967cde286a9f8a9'
+    'c4473e99235187b616c33e08890229823e90c525a4df493588a99ded95d94171',
+)
+
+# -a -A: base64 on one line, as openssl prints it
+BASE64=(
+    '-aes-192-cfb -nosalt -pass pass:secret -a -A',
+    b'FmrakVF2s1ISPnOuGvTyUtxJYIm8SWDhKWaFpZ0Nd3HMFJrge6SRzwE=',
+)
+
+
+def test_vectors():
+    for args, expected in VECTORS.items():
+        e=openssl_enc(args)
+        assert e.encrypt(NAME) == expected, args
+        assert e.decrypt(expected) == NAME, args
+
+
+def test_salted():
+    args, encrypted=SALTED
+    e=openssl_enc(args)
+    assert e.decrypt(encrypted) == NAME
+    # a random salt every time, with the header openssl expects
+    a, b=e.encrypt(NAME), e.encrypt(NAME)
+    assert a != b and a.startswith(b'Salted__'.hex())
+    assert e.decrypt(a) == NAME
+
+
+def test_base64():
+    args, encrypted=BASE64
+    e=openssl_enc(args)
+    assert e.encrypt_bytes(NAME.encode() + b'\n') == encrypted
+    assert e.decrypt_bytes(encrypted) == NAME.encode() + b'\n'
+
+
+def test_unsupported():
+    for args in ('-aes-256-gcm -k secret', '-aes-256-cbc', '-aes-256-cbc -k'):
+        try:
+            openssl_enc(args)
+        except ValueError:
+            continue
+        raise AssertionError(f'{args} was accepted')
+
+
+if __name__ == '__main__':
+    test_vectors()
+    test_salted()
+    test_base64()
+    test_unsupported()
+    print('ok')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# streamlink_args for the download engine (engine.parse_args): a representative line is mapped
+# to session and plugin options which a streamlink session accepts, and arguments which can't be
+# mapped are rejected
+#
+# usage: engine_test.py (or pytest test/engine_test.py); needs streamlink (tw-etl[engine])
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_manager.engine import UnsupportedArgument, parse_args
+
+
+URL='https://www.twitch.tv/stream1'
+
+ARGS=[
+    '--http-proxy', 'socks5h://127.0.0.1:8080',
+    '--hls-live-edge', '2',
+    '--http-header', 'User-Agent=tw-etl',
+    '--http-header=Accept-Language=en',
+    '--http-no-ssl-verify',
+    '--stream-segment-timeout=20',
+    '--ringbuffer-size', '32M',
+    '--hls-segment-stream-data',
+    '--twitch-disable-ads',
+    '--twitch-api-header', 'Authorization=OAuth token',
+]
+
+
+def session():
+    try:
+        from streamlink import Streamlink
+    except ImportError:
+        raise unittest.SkipTest('streamlink is not installed')
+    return Streamlink
+
+
+def test_parse_args():
+    Streamlink=session()
+    session_options, plugin_options=parse_args(Streamlink(), URL, ARGS)
+    assert session_options == {
+        'http-proxy': 'socks5h://127.0.0.1:8080',
+        'hls-live-edge': 2,
+        'http-headers': {'User-Agent': 'tw-etl', 'Accept-Language': 'en'},
+        'http-ssl-verify': False,
+        'stream-segment-timeout': 20.0,
+        'ringbuffer-size': 32 << 20,
+        'hls-segment-stream-data': True,
+    }, session_options
+    assert plugin_options == {
+        'disable_ads': True,
+        'api_header': [('Authorization', 'OAuth token')],
+    }, plugin_options
+
+    # and the session takes them
+    s=Streamlink(session_options)
+    assert s.get_option('hls-live-edge') == 2
+    assert s.http.proxies['https'] == 'socks5h://127.0.0.1:8080'
+    assert s.http.headers['User-Agent'] == 'tw-etl'
+    assert s.http.verify is False
+
+
+def test_unsupported():
+    Streamlink=session()
+    probe=Streamlink()
+    for args, error in (
+        (['--player', 'vlc'], UnsupportedArgument),
+        (['--hls-live-edge', '2', 'best'], UnsupportedArgument),
+        (['--youtube-disable-ads'], UnsupportedArgument),
+        (['--hls-live-edge', 'two'], ValueError),
+        (['--http-proxy'], ValueError),
+        (['--http-header', 'User-Agent'], ValueError),
+    ):
+        try:
+            parse_args(probe, URL, args)
+        except error:
+            continue
+        raise AssertionError(f'{args} was accepted')
+
+
+if __name__ == '__main__':
+    try:
+        test_parse_args()
+        test_unsupported()
+    except unittest.SkipTest as e:
+        print(f'skipped: {e}')
+        sys.exit(0)
+    print('ok')
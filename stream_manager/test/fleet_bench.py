@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+#
+# synthetic fleet benchmark: runs a manager with N streams against an in-process fake
+# downloader, drives online/offline transitions from a schedule, and reports how the manager
+# held up as JSON (so results can be compared between versions)
+#
+# the fake downloader replaces manager.spawn_download: while its stream is online it writes
+# --rate bytes/sec to the download file, and it exits when the stream goes offline (like
+# streamlink at the end of a stream); started while the stream is offline, it exits right away
+# with an empty file, like a failed poll attempt. no processes are spawned, so the numbers are
+# the manager's own overhead.
+#
+# the schedule is generated from --seed (each stream is online for random periods), or read
+# from --schedule: a JSON list of [seconds, stream, "online"|"offline"]. online transitions
+# are signalled with POST /online/{stream} for --signal-fraction of streams (the rest have to
+# be found by polling), offline transitions with POST /offline/{stream}.
+#
+# reported: event loop lag (sampled every 10ms), state writes and bytes written, time from an
+# online signal (or transition, for polled streams) to the download starting, RSS and CPU time
+#
+# usage: fleet_bench.py [--streams 1000] [--duration 60] [--out result.json] ...
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_manager.manager import manager
+
+
+# well above any real pid_max, so a fake download's "process group" can never be killed by
+# accident (killpg fails with ESRCH)
+FAKE_PID_BASE=1 << 30
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values, ps=(50, 90, 99, 100)):
+    if len(values) == 0:
+        return {f'p{p}': None for p in ps}
+    values=sorted(values)
+    return {
+        f'p{p}': round(values[min(len(values) - 1, int(len(values) * p / 100))], 6)
+        for p in ps
+    }
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss_bytes():
+    r=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return r if sys.platform == 'darwin' else r * 1024
+
+
+def make_schedule(streams, duration, seed, online_fraction, mean_online, mean_offline):
+    rnd=random.Random(seed)
+    events=[]
+    for s in streams:
+        if rnd.random() >= online_fraction:
+            continue
+        t=rnd.uniform(0, mean_offline)
+        while t < duration:
+            events.append([round(t, 3), s, 'online'])
+            t+=rnd.expovariate(1 / mean_online)
+            if t >= duration:
+                break
+            events.append([round(t, 3), s, 'offline'])
+            t+=rnd.expovariate(1 / mean_offline)
+    return sorted(events, key=lambda e: e[0])
+
+
+def write_config(d, args, streams):
+    ext_dir=os.path.join(d, 'ext')
+    for sub in ('ext', 'download', 'logs', 'completed'):
+        os.makedirs(os.path.join(d, sub), exist_ok=True)
+
+    # half of the streams configured directly, half from ext-streamlist files
+    n=len(streams) // 2
+    configured, ext=streams[:n], streams[n:]
+    for i in range(0, len(ext), 500):
+        with open(os.path.join(ext_dir, f'list{i // 500}.json'), 'w') as f:
+            json.dump(ext[i:i+500], f)
+
+    config={
+        'listen_addr': '127.0.0.1',
+        'listen_port': free_port(),
+        'poll': True,
+        'poll_interval': args['poll_interval'],
+        'ext_streamlist_dir': ext_dir,
+        'download_script': '/bin/false',
+        'download_dir': os.path.join(d, 'download'),
+        'download_log_dir': os.path.join(d, 'logs'),
+        'completed_dir': os.path.join(d, 'completed'),
+        'state_path': os.path.join(d, 'state.json'),
+        'retry_count': args['retries'],
+        'blocklist': [],
+        'streams': {
+            '720p': {'format': '720p,best', 'streams': configured},
+        },
+        'stall_timeout_sec': 3600,
+        'healthcheck_interval_sec': 5,
+    }
+    for k in ('max_downloads', 'max_probes', 'poll_rate'):
+        if args[k] is not None:
+            config[k]=args[k]
+
+    path=os.path.join(d, 'config.yml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path, config
+
+
+class fake_fleet():
+
+    def __init__(self, rate, chunk_interval=0.5) -> None:
+        self.rate=rate
+        self.chunk_interval=chunk_interval
+        self.online=set()
+        # stream -> time of the online signal/transition, until a download starts
+        self.waiting={}
+        self.latencies=[]
+        self.spawned=0
+        self.bytes=0
+        self._next_pid=FAKE_PID_BASE
+        self._events={}
+        self._tasks=set()
+
+    def set_online(self, s_id, online):
+        if online:
+            self.online.add(s_id)
+            self.waiting.setdefault(s_id, time.monotonic())
+        else:
+            self.online.discard(s_id)
+            self.waiting.pop(s_id, None)
+            ev=self._events.get(s_id)
+            if ev is not None:
+                ev.set()
+
+    async def spawn(self, s_id, args):
+        self.spawned += 1
+        t=self.waiting.pop(s_id, None)
+        if t is not None and s_id in self.online:
+            self.latencies.append(time.monotonic() - t)
+
+        self._next_pid += 1
+        return fake_download(self, s_id, args[2], self._next_pid)
+
+    async def _write(self, s_id, path):
+        ev=self._events.setdefault(s_id, asyncio.Event())
+        ev.clear()
+        chunk=b'\0' * int(self.rate * self.chunk_interval)
+        with open(path, 'ab') as f:
+            while s_id in self.online:
+                f.write(chunk)
+                self.bytes += len(chunk)
+                try:
+                    await asyncio.wait_for(ev.wait(), self.chunk_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+
+class fake_download():
+
+    def __init__(self, fleet, s_id, path, pid) -> None:
+        self.pid=pid
+        self.returncode=None
+        self._task=asyncio.create_task(fleet._write(s_id, path))
+
+    async def wait(self):
+        try:
+            await asyncio.shield(self._task)
+        except asyncio.CancelledError:
+            self._task.cancel()
+            raise
+        self.returncode=1
+        return self.returncode
+
+
+async def lag_sampler(samples, interval=0.01):
+    while True:
+        t=time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - t - interval))
+
+
+async def drive(schedule, fleet, port, signal_fraction, seed):
+    rnd=random.Random(seed)
+    signalled={s for _, s, _ in schedule if rnd.random() < signal_fraction}
+    start=time.monotonic()
+
+    async with aiohttp.ClientSession() as session:
+        async def post(path):
+            try:
+                async with session.post(f'http://127.0.0.1:{port}{path}') as r:
+                    await r.read()
+            except aiohttp.ClientError as e:
+                logging.getLogger('stream_manager').error(f'fleet_bench: {path}: {e}')
+
+        for t, s_id, event in schedule:
+            delay=start + t - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            fleet.set_online(s_id, event == 'online')
+            if s_id in signalled:
+                asyncio.create_task(post(f'/{event}/{s_id}'))
+
+
+async def run(args):
+    logger=logging.getLogger('stream_manager')
+    logger.setLevel(getattr(logging, args['log_level']))
+    logger.addHandler(logging.StreamHandler(stream=sys.stderr))
+
+    streams=[f'bench{i:06d}' for i in range(args['streams'])]
+    if args['schedule'] is not None:
+        with open(args['schedule']) as f:
+            schedule=json.load(f)
+    else:
+        schedule=make_schedule(streams, args['duration'], args['seed'], args['online_fraction'],
+            args['mean_online'], args['mean_offline'])
+
+    with tempfile.TemporaryDirectory(prefix='fleet_bench.') as d:
+        config_path, config=write_config(d, args, streams)
+
+        t=time.monotonic()
+        m=manager(config_path, logger)
+        load_sec=time.monotonic() - t
+
+        fleet=fake_fleet(args['rate'])
+        m.spawn_download=fleet.spawn
+
+        lag=[]
+        cpu0=os.times()
+        sampler=asyncio.create_task(lag_sampler(lag))
+        mgr=asyncio.create_task(m.start())
+
+        # let the HTTP server come up
+        await asyncio.sleep(0.5)
+        t0=time.monotonic()
+        await drive(schedule, fleet, config['listen_port'], args['signal_fraction'], args['seed'])
+        remaining=args['duration'] - (time.monotonic() - t0)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        elapsed=time.monotonic() - t0
+
+        cpu1=os.times()
+        rss=rss_bytes()
+        sampler.cancel()
+        mgr.cancel()
+        try:
+            await mgr
+        except asyncio.CancelledError:
+            pass
+        for s_id in list(fleet.online):
+            fleet.set_online(s_id, False)
+
+        st=m.state.stats
+        sup=m.supervisor.stats
+        result={
+            'version': 1,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in args.items() if k not in ('out', 'log_level')},
+            'transitions': len(schedule),
+            'elapsed_sec': round(elapsed, 3),
+            'config_load_sec': round(load_sec, 6),
+            'loop_lag_sec': percentiles(lag),
+            'loop_lag_samples': len(lag),
+            'online_to_spawn_sec': percentiles(fleet.latencies),
+            'online_to_spawn_samples': len(fleet.latencies),
+            'spawns': fleet.spawned,
+            'bytes_written': fleet.bytes,
+            'state': {
+                'marked': st['marked'],
+                'written': st['written'],
+                'writes_per_sec': round(st['written'] / elapsed, 3),
+                'bytes': st['write_bytes_total'],
+                'bytes_per_sec': round(st['write_bytes_total'] / elapsed, 1),
+                'write_sec_total': round(st['write_sec_total'], 6),
+                'last_write_bytes': st['last_write_bytes'],
+            },
+            'supervisor': dict(sup),
+            'cpu_sec': {
+                'user': round(cpu1.user - cpu0.user, 3),
+                'system': round(cpu1.system - cpu0.system, 3),
+                'utilization': round((cpu1.user - cpu0.user + cpu1.system - cpu0.system) / elapsed, 4),
+            },
+            'rss_bytes': rss,
+            'max_rss_bytes': max_rss_bytes(),
+        }
+
+    out=json.dumps(result, indent=4)
+    if args['out'] is not None:
+        with open(args['out'], 'w') as f:
+            f.write(out + '\n')
+    print(out)
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser(description='synthetic fleet benchmark for stream_manager')
+    prs.add_argument('--streams', type=int, default=1000)
+    prs.add_argument('--duration', type=float, default=60, help='seconds')
+    prs.add_argument('--schedule', help='JSON list of [seconds, stream, "online"|"offline"]')
+    prs.add_argument('--seed', type=int, default=1)
+    prs.add_argument('--online-fraction', type=float, default=0.2,
+        help='fraction of streams which go online at some point (generated schedule)')
+    prs.add_argument('--mean-online', type=float, default=30, help='seconds (generated schedule)')
+    prs.add_argument('--mean-offline', type=float, default=30, help='seconds (generated schedule)')
+    prs.add_argument('--signal-fraction', type=float, default=0.5,
+        help='fraction of streams whose transitions are signalled over HTTP')
+    prs.add_argument('--rate', type=int, default=16384, help='bytes/sec per online download')
+    prs.add_argument('--poll-interval', type=int, default=30)
+    prs.add_argument('--retries', type=int, default=3)
+    prs.add_argument('--max-downloads', type=int)
+    prs.add_argument('--max-probes', type=int)
+    prs.add_argument('--poll-rate', type=float)
+    prs.add_argument('--out', help='also write the result to this file')
+    prs.add_argument('--log-level', default='WARNING')
+    args=vars(prs.parse_args())
+
+    asyncio.run(run(args))
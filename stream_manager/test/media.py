@@ -0,0 +1,45 @@
+#
+# tiny sample recordings for the tests, generated with ffmpeg's lavfi test sources
+#
+# tests which need them are skipped if ffmpeg and ffprobe are not on PATH
+
+import json
+import shutil
+import subprocess
+import unittest
+
+
+def require_ffmpeg():
+    for tool in ('ffmpeg', 'ffprobe'):
+        if shutil.which(tool) is None:
+            raise unittest.SkipTest(f'{tool} not found')
+
+
+"""
+write a seconds long mkv to path: a test pattern (size, at rate fps) with a tone, or only the
+tone with video=False. with offset, timestamps start at offset seconds (like a recording which
+starts in the middle of a stream)
+"""
+def make_clip(path, seconds=1.0, video=True, audio=True, size='160x120', rate=25, offset=None):
+    args=['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+    if video:
+        args+=['-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size={size}:rate={rate}']
+    if audio:
+        args+=['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}']
+    if video:
+        args+=['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+    if audio:
+        args+=['-c:a', 'aac']
+    if offset is not None:
+        args+=['-output_ts_offset', str(offset)]
+    subprocess.run(args + [path], check=True)
+    return path
+
+
+def probe_streams(path):
+    out=subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name,avg_frame_rate,width,height',
+         '-of', 'json', path],
+        check=True, capture_output=True,
+    ).stdout
+    return json.loads(out)['streams']
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# stand-in for an S3-compatible endpoint (sync.endpoint_url) used for local testing
+#
+# path-style requests only, no authentication, objects kept in memory. supports what sync.py
+# uses: put_object, create_multipart_upload, upload_part, list_parts,
+# complete_multipart_upload, abort_multipart_upload, plus get_object/head_object to inspect the
+# result. ETags are computed like S3's (MD5 of the body, or of the part MD5s followed by
+# -{number of parts} for multipart uploads), and Content-MD5 is checked.
+#
+# faults, set on the app's 's3' state (see make_app):
+#   reject_parts   part numbers whose next upload is rejected with 400 (not retried by clients)
+#   bad_etag       reply with a wrong ETag to put_object and upload_part
+#
+# usage: s3_server.py [--port 5000]
+# then set e.g. endpoint_url: 'http://127.0.0.1:5000' in the sync section of the config
+
+import argparse
+import base64
+import hashlib
+import uuid
+
+from aiohttp import web
+
+
+class s3_state():
+
+    def __init__(self) -> None:
+        # (bucket, key) -> {'body': bytes, 'etag': str, 'storage_class': str}
+        self.objects={}
+        # upload ID -> {'bucket', 'key', 'storage_class', 'parts': {n: (etag, body)}}
+        self.uploads={}
+        self.reject_parts=set()
+        self.bad_etag=False
+        # operation (e.g. upload_part) -> count
+        self.requests={}
+
+    def count(self, op):
+        self.requests[op]=self.requests.get(op, 0) + 1
+
+
+def _error(status, code, message=''):
+    return web.Response(status=status, content_type='application/xml', text=(
+        f'<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Error><Code>{code}</Code><Message>{message}</Message></Error>'
+    ))
+
+
+def _xml(body):
+    return web.Response(content_type='application/xml',
+        text=f'<?xml version="1.0" encoding="UTF-8"?>\n{body}')
+
+
+# body of an aws-chunked request (streaming uploads with trailing checksums)
+def _dechunk(data):
+    out=[]
+    i=0
+    while True:
+        j=data.index(b'\r\n', i)
+        size=int(data[i:j].split(b';')[0], 16)
+        if size == 0:
+            return b''.join(out)
+        out.append(data[j+2:j+2+size])
+        i=j + 2 + size + 2
+
+
+async def _body(request):
+    data=await request.read()
+    if 'aws-chunked' in request.headers.get('Content-Encoding', ''):
+        data=_dechunk(data)
+    md5=hashlib.md5(data)
+    expected=request.headers.get('Content-MD5')
+    if expected is not None and base64.b64decode(expected) != md5.digest():
+        raise web.HTTPBadRequest()
+    return data, md5
+
+
+def make_app():
+    s3=s3_state()
+
+    async def handler(request):
+        bucket=request.match_info['bucket']
+        key=request.match_info['key']
+        q=request.query
+        m=request.method
+
+        try:
+            if m == 'PUT' and 'uploadId' in q:
+                s3.count('upload_part')
+                upload=s3.uploads.get(q['uploadId'])
+                if upload is None:
+                    return _error(404, 'NoSuchUpload')
+                n=int(q['partNumber'])
+                data, md5=await _body(request)
+                if n in s3.reject_parts:
+                    s3.reject_parts.discard(n)
+                    return _error(400, 'InvalidRequest', 'rejected for testing')
+                etag=md5.hexdigest()
+                upload['parts'][n]=(etag, data)
+                if s3.bad_etag:
+                    etag=hashlib.md5(etag.encode()).hexdigest()
+                return web.Response(headers={'ETag': f'"{etag}"'})
+
+            elif m == 'PUT':
+                s3.count('put_object')
+                data, md5=await _body(request)
+                etag=md5.hexdigest()
+                s3.objects[(bucket, key)]={
+                    'body': data,
+                    'etag': etag,
+                    'storage_class': request.headers.get('x-amz-storage-class', 'STANDARD'),
+                }
+                if s3.bad_etag:
+                    etag=hashlib.md5(etag.encode()).hexdigest()
+                return web.Response(headers={'ETag': f'"{etag}"'})
+
+            elif m == 'POST' and 'uploads' in q:
+                s3.count('create_multipart_upload')
+                upload_id=uuid.uuid4().hex
+                s3.uploads[upload_id]={
+                    'bucket': bucket,
+                    'key': key,
+                    'storage_class': request.headers.get('x-amz-storage-class', 'STANDARD'),
+                    'parts': {},
+                }
+                return _xml(
+                    f'<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>'
+                )
+
+            elif m == 'POST' and 'uploadId' in q:
+                s3.count('complete_multipart_upload')
+                upload=s3.uploads.pop(q['uploadId'], None)
+                if upload is None:
+                    return _error(404, 'NoSuchUpload')
+                body=(await request.read()).decode()
+                numbers=[
+                    int(p.split('</PartNumber>')[0]) for p in body.split('<PartNumber>')[1:]
+                ]
+                if numbers != list(range(1, len(numbers) + 1)) or any(n not in upload['parts'] for n in numbers):
+                    return _error(400, 'InvalidPart')
+                parts=[upload['parts'][n] for n in numbers]
+                etag=hashlib.md5(b''.join(bytes.fromhex(e) for e, _ in parts)).hexdigest() + f'-{len(parts)}'
+                s3.objects[(bucket, key)]={
+                    'body': b''.join(data for _, data in parts),
+                    'etag': etag,
+                    'storage_class': upload['storage_class'],
+                }
+                return _xml(
+                    f'<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                    f'<ETag>"{etag}"</ETag></CompleteMultipartUploadResult>'
+                )
+
+            elif m == 'GET' and 'uploadId' in q:
+                s3.count('list_parts')
+                upload=s3.uploads.get(q['uploadId'])
+                if upload is None:
+                    return _error(404, 'NoSuchUpload')
+                parts=''.join(
+                    f'<Part><PartNumber>{n}</PartNumber><ETag>"{etag}"</ETag><Size>{len(data)}</Size></Part>'
+                    for n, (etag, data) in sorted(upload['parts'].items())
+                )
+                return _xml(
+                    f'<ListPartsResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                    f'<UploadId>{q["uploadId"]}</UploadId><IsTruncated>false</IsTruncated>{parts}</ListPartsResult>'
+                )
+
+            elif m == 'DELETE' and 'uploadId' in q:
+                s3.count('abort_multipart_upload')
+                if s3.uploads.pop(q['uploadId'], None) is None:
+                    return _error(404, 'NoSuchUpload')
+                return web.Response(status=204)
+
+            elif m in ('GET', 'HEAD'):
+                s3.count('get_object')
+                obj=s3.objects.get((bucket, key))
+                if obj is None:
+                    return _error(404, 'NoSuchKey')
+                return web.Response(body=obj['body'] if m == 'GET' else None, headers={
+                    'ETag': f'"{obj["etag"]}"',
+                    'x-amz-storage-class': obj['storage_class'],
+                })
+        except web.HTTPBadRequest:
+            return _error(400, 'BadDigest')
+
+        return _error(405, 'MethodNotAllowed')
+
+    app=web.Application(client_max_size=1 << 30)
+    app['s3']=s3
+    app.router.add_route('*', '/{bucket}/{key:.+}', handler)
+    return app
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser()
+    prs.add_argument('--addr', default='127.0.0.1')
+    prs.add_argument('--port', type=int, default=5000)
+    args=prs.parse_args()
+
+    web.run_app(make_app(), host=args.addr, port=args.port)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# stand-in for the HTTP state server (state_url) used for local testing
+#
+# every path holds one JSON document, kept in memory:
+#   GET    returns it (404 if never written)
+#   PUT    replaces it (with If-None-Match: *, only if it doesn't exist yet, else 412)
+#   PATCH  applies an RFC 6902 JSON patch to it (add/replace/remove only)
+#
+# --delay and --fail-rate simulate a slow or unreliable server. per-path request counters are
+# available at GET /_stats
+#
+# usage: state_server.py [--port 8081] [--delay 0.5] [--fail-rate 0.2]
+# then set e.g. state_url: 'http://127.0.0.1:8081/state' in the manager config. for a cluster
+# (see cluster.py), give each node its own state_url (e.g. .../state/node1) and the same
+# cluster.lease_url (e.g. .../cluster)
+
+import argparse
+import asyncio
+import copy
+import json
+import random
+
+from aiohttp import web
+
+
+def json_patch(doc, ops):
+    for op in ops:
+        path=[
+            p.replace('~1', '/').replace('~0', '~') for p in op['path'].split('/')[1:]
+        ]
+        if len(path) == 0:
+            if op['op'] == 'remove':
+                raise ValueError('cannot remove the root')
+            doc=op['value']
+            continue
+
+        parent=doc
+        for p in path[:-1]:
+            parent=parent[p]
+
+        if op['op'] in ('add', 'replace'):
+            if op['op'] == 'replace' and path[-1] not in parent:
+                raise KeyError(op['path'])
+            parent[path[-1]]=op['value']
+        elif op['op'] == 'remove':
+            del parent[path[-1]]
+        else:
+            raise ValueError(f'unsupported op {op["op"]}')
+    return doc
+
+
+def make_app(delay=0.0, fail_rate=0.0):
+    docs={}
+    stats={}
+
+    async def handler(request):
+        path=request.path
+        if path == '/_stats':
+            return web.json_response(stats)
+
+        counters=stats.setdefault(path, {})
+        counters[request.method]=counters.get(request.method, 0) + 1
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if random.random() < fail_rate:
+            return web.Response(status=503)
+
+        if request.method == 'GET':
+            if path not in docs:
+                return web.Response(status=404)
+            return web.json_response(docs[path])
+        elif request.method == 'PUT':
+            if request.headers.get('If-None-Match') == '*' and path in docs:
+                return web.Response(status=412)
+            docs[path]=await request.json()
+            return web.Response(status=204)
+        elif request.method == 'PATCH':
+            if path not in docs:
+                return web.Response(status=404)
+            try:
+                # applied to a copy, so a patch which fails half-way leaves the document unchanged
+                docs[path]=json_patch(copy.deepcopy(docs[path]), await request.json())
+            except (KeyError, ValueError, TypeError) as e:
+                return web.Response(status=409, text=str(e))
+            return web.Response(status=204)
+
+        return web.Response(status=405)
+
+    app=web.Application()
+    app.router.add_route('*', '/{tail:.*}', handler)
+    return app
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser()
+    prs.add_argument('--addr', default='127.0.0.1')
+    prs.add_argument('--port', type=int, default=8081)
+    prs.add_argument('--delay', type=float, default=0.0)
+    prs.add_argument('--fail-rate', type=float, default=0.0)
+    args=prs.parse_args()
+
+    web.run_app(make_app(args.delay, args.fail_rate), host=args.addr, port=args.port)
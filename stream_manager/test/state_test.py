@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# state replication against the stand-in state server (state_server.py), run in-process
+#
+# drives state (write-behind file writes and the replicator) through a series of changes, in
+# full and delta mode, and checks that the server ends up with the same document as the local
+# file. covers a patch the server rejects (409, a stream removed from the server's document
+# behind the replicator's back), which has to fall back to a full PUT, and a server which
+# fails a share of requests, which have to be retried.
+#
+# usage: state_test.py (or pytest test/state_test.py)
+
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+
+import httpx
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager.state import state
+from stream_manager.common import stream_state, stream_config
+
+import state_server
+
+
+async def serve(app):
+    runner=web.AppRunner(app)
+    await runner.setup()
+    site=web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port=runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+def make_stream(s_id, retry_id=0):
+    return stream_state(
+        pid=4000 + retry_id,
+        retry_id=retry_id,
+        config=stream_config(stream_id=s_id, qid='best', qlist='best', retries=50),
+        datestr='2026-10-18T12:00:00',
+        log_path=f'/var/log/tw/{s_id}.log',
+        poll_attempt=False,
+        resumed=False,
+    )
+
+
+async def changes(s, streams, n):
+    rng=random.Random(n)
+    for i in range(n):
+        s_id=f's{rng.randrange(20)}'
+        if s_id in streams and rng.random() < 0.2:
+            del streams[s_id]
+        else:
+            retry_id=streams[s_id].retry_id + 1 if s_id in streams else 0
+            streams[s_id]=make_stream(s_id, retry_id)
+        s.mark_dirty(streams)
+        await asyncio.sleep(rng.uniform(0, 0.01))
+
+
+# close s (writing out everything), then compare the server's document with the local file
+async def check(s, client, url):
+    await s.close()
+    with open(s.state_path, 'r', encoding='utf-8') as f:
+        local=json.load(f)
+    r=await client.get(url)
+    r.raise_for_status()
+    assert r.json() == local
+    return local
+
+
+async def replicate(mode):
+    runner, base=await serve(state_server.make_app())
+    client=httpx.AsyncClient()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            url=f'{base}/state'
+            s=state(os.path.join(d, 'state.json'), url, write_interval=0.01, http_mode=mode)
+            streams={}
+            await changes(s, streams, 200)
+            local=await check(s, client, url)
+            assert sorted(local) == sorted(streams)
+
+            stats=s.replicator.stats
+            assert stats['dropped'] == 0 and stats['failed'] == 0, stats
+            if mode == 'full':
+                assert stats['sent_delta'] == 0 and stats['sent_full'] == stats['sent'], stats
+            else:
+                # only the first write is a full PUT
+                assert stats['sent_full'] == 1 and stats['sent_delta'] > 0, stats
+
+            # a restarted manager loads the same state from the server
+            loaded=await state(os.path.join(d, 'other.json'), url).load()
+            assert sorted(loaded) == sorted(streams)
+            for s_id, x in streams.items():
+                assert loaded[s_id].retry_id == x.retry_id, s_id
+    finally:
+        await client.aclose()
+        await runner.cleanup()
+
+
+async def patch_rejected():
+    runner, base=await serve(state_server.make_app())
+    client=httpx.AsyncClient()
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            url=f'{base}/state'
+            s=state(os.path.join(d, 'state.json'), url, write_interval=0.01, http_mode='delta')
+            streams={s_id: make_stream(s_id) for s_id in ('a', 'b', 'c')}
+            s.mark_dirty(streams)
+            await s.flush()
+            await asyncio.wait_for(s.replicator._idle.wait(), 5)
+            assert s.replicator.stats['sent_full'] == 1
+
+            # the server loses 'b': removing it from the state is a patch the server rejects
+            r=await client.patch(url, json=[{'op': 'remove', 'path': '/b'}])
+            r.raise_for_status()
+            del streams['b']
+            streams['c']=make_stream('c', 1)
+            s.mark_dirty(streams)
+
+            local=await check(s, client, url)
+            assert sorted(local) == ['a', 'c'] and local['c']['retry_id'] == 1, local
+            stats=s.replicator.stats
+            assert stats['sent_full'] == 2 and stats['sent_delta'] == 0, stats
+            assert stats['failed'] == 0, stats
+
+            r=await client.get(f'{base}/_stats')
+            assert r.json()['/state'] == {'PUT': 2, 'PATCH': 2, 'GET': 1}, r.json()
+    finally:
+        await client.aclose()
+        await runner.cleanup()
+
+
+async def unreliable(mode):
+    random.seed(2)
+    runner, base=await serve(state_server.make_app(fail_rate=0.3))
+    client=httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(retries=0))
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            url=f'{base}/state'
+            s=state(os.path.join(d, 'state.json'), url, write_interval=0.01, http_mode=mode)
+            s.replicator.backoff_base=0.01
+            s.replicator.backoff_max=0.05
+            streams={}
+            await changes(s, streams, 100)
+
+            # the check's own GET can fail too
+            await s.close()
+            stats=s.replicator.stats
+            assert stats['failed'] > 0, stats
+            for i in range(20):
+                r=await client.get(url)
+                if r.status_code != 503:
+                    break
+            r.raise_for_status()
+            with open(s.state_path, 'r', encoding='utf-8') as f:
+                assert r.json() == json.load(f)
+    finally:
+        await client.aclose()
+        await runner.cleanup()
+
+
+def test_full():
+    asyncio.run(replicate('full'))
+
+
+def test_delta():
+    asyncio.run(replicate('delta'))
+
+
+def test_patch_rejected():
+    asyncio.run(patch_rejected())
+
+
+def test_unreliable():
+    for mode in ('full', 'delta'):
+        asyncio.run(unreliable(mode))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    test_full()
+    test_delta()
+    test_patch_rejected()
+    test_unreliable()
+    print('ok')
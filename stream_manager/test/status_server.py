@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# stand-in for a batched stream status API (status_probe type 'http'), for local testing
+#
+# as with video-download.sh, a stream is "live" if a file named after it exists in the online
+# directory, so testing is carried out by `touch`ing or `rm`ing files there
+#
+#   GET /helix/streams?user_login=a&user_login=b
+#   -> {"data": [{"user_login": "a", "type": "live"}]}
+#
+# usage: status_server.py [--port 8082] [--online-dir test/online]
+# then configure status_probe: {type: http, url: 'http://127.0.0.1:8082/helix/streams'}
+
+import argparse
+import os
+
+from aiohttp import web
+
+
+def make_app(online_dir):
+    stats={'requests': 0, 'streams': 0}
+
+    async def streams_handler(request):
+        s_ids=request.query.getall('user_login', [])
+        stats['requests'] += 1
+        stats['streams'] += len(s_ids)
+
+        live=[
+            s_id for s_id in s_ids
+            if os.path.exists(os.path.join(online_dir, s_id))
+        ]
+        return web.json_response({
+            'data': [{'user_login': s_id, 'type': 'live'} for s_id in live],
+        })
+
+    async def stats_handler(request):
+        return web.json_response(stats)
+
+    app=web.Application()
+    app['stats']=stats
+    app.router.add_get('/helix/streams', streams_handler)
+    app.router.add_get('/_stats', stats_handler)
+    return app
+
+
+if __name__ == '__main__':
+    prs=argparse.ArgumentParser()
+    prs.add_argument('--addr', default='127.0.0.1')
+    prs.add_argument('--port', type=int, default=8082)
+    prs.add_argument('--online-dir', default=os.path.join(os.path.dirname(__file__), 'online'))
+    args=prs.parse_args()
+
+    web.run_app(make_app(args.online_dir), host=args.addr, port=args.port)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# status probes (status.py) against the stand-in status API (status_server.py), run in-process
+#
+# - http_status_probe reports the streams which are live in the online directory, one request
+#   per batch_size streams, and also reads a plain {stream: bool} object
+# - a batch whose request fails (an error status, a reply which isn't JSON or isn't an object,
+#   or no server at all) is unknown (None), without affecting the other batches
+# - the manager's probe_task only starts the live streams, as poll attempts, and skips the
+#   blocklisted ones and the ones which already have state; with the script probe, the manager
+#   falls back to a poll_task per stream, which runs the download for every stream
+#
+# usage: status_test.py (or pytest test/status_test.py)
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+import yaml
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager.common import stream_state
+from stream_manager.manager import manager
+from stream_manager.status import http_status_probe, make_status_probe, script_status_probe
+
+import status_server
+
+
+S_IDS=[f's{i}' for i in range(7)]
+LIVE=['s1', 's4', 's5']
+
+
+async def serve(app):
+    runner=web.AppRunner(app)
+    await runner.setup()
+    site=web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port=runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+async def wait_for(cond, timeout=10):
+    loop=asyncio.get_running_loop()
+    deadline=loop.time() + timeout
+    while not cond():
+        if loop.time() > deadline:
+            raise AssertionError('timed out')
+        await asyncio.sleep(0.05)
+
+
+def online_dir(d, live):
+    path=os.path.join(d, 'online')
+    os.makedirs(path)
+    for s_id in live:
+        open(os.path.join(path, s_id), 'w').close()
+    return path
+
+
+async def batched():
+    with tempfile.TemporaryDirectory() as d:
+        app=status_server.make_app(online_dir(d, LIVE))
+        runner, base=await serve(app)
+        probe=http_status_probe(f'{base}/helix/streams', batch_size=3)
+        try:
+            status=await probe.probe(S_IDS)
+            assert status == {s_id: s_id in LIVE for s_id in S_IDS}, status
+
+            # logins are matched regardless of case
+            status=await probe.probe(['S1', 's2'])
+            assert status == {'S1': False, 's2': False}, status
+            assert app['stats'] == {'requests': 4, 'streams': 9}, app['stats']
+        finally:
+            await probe.close()
+            await runner.cleanup()
+
+
+async def errors():
+    # a status API which answers each batch by its first stream
+    async def handler(request):
+        s_ids=request.query.getall('user_login')
+        first=s_ids[0]
+        if first == 's0':
+            return web.json_response({'s0': True, 's1': False})
+        elif first == 's2':
+            return web.Response(status=500, text='internal error')
+        elif first == 's4':
+            return web.Response(text='<html>maintenance</html>', content_type='text/html')
+        elif first == 's6':
+            return web.json_response(['s6'])
+        return web.json_response({'data': [{'user_login': s_id} for s_id in s_ids]})
+
+    app=web.Application()
+    app.router.add_get('/streams', handler)
+    runner, base=await serve(app)
+    probe=http_status_probe(f'{base}/streams', batch_size=2)
+    try:
+        status=await probe.probe(S_IDS + ['s7', 's8'])
+        assert status == {
+            's0': True, 's1': False,
+            's2': None, 's3': None,
+            's4': None, 's5': None,
+            's6': None, 's7': None,
+            's8': True,
+        }, status
+    finally:
+        await probe.close()
+        await runner.cleanup()
+
+    # nothing listening any more
+    probe=http_status_probe(f'{base}/streams', timeout=2)
+    try:
+        assert await probe.probe(['s0', 's1']) == {'s0': None, 's1': None}
+    finally:
+        await probe.close()
+
+
+def make_manager(d, status_probe):
+    ext_dir=os.path.join(d, 'ext')
+    os.makedirs(ext_dir)
+    config={
+        'download_script': '/bin/false',
+        'download_dir': d,
+        'download_log_dir': d,
+        'completed_dir': d,
+        'state_path': os.path.join(d, 'state.json'),
+        'ext_streamlist_dir': ext_dir,
+        'poll_interval': 1,
+        'status_probe': status_probe,
+        'blocklist': ['s5'],
+        'streams': {'best': {'format': 'best', 'streams': S_IDS}},
+    }
+    config_path=os.path.join(d, 'config.yml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    m=manager(config_path, logging.getLogger('stream_manager'))
+    # record what would be downloaded, instead of running download_script
+    m.attempts=[]
+    async def try_stream(s_config, poll_attempt):
+        m.attempts.append((s_config.stream_id, poll_attempt))
+    m.try_stream=try_stream
+    return m
+
+
+async def probe_task():
+    with tempfile.TemporaryDirectory() as d:
+        app=status_server.make_app(online_dir(d, LIVE))
+        runner, base=await serve(app)
+        m=make_manager(d, {'type': 'http', 'url': f'{base}/helix/streams', 'batch_size': 2})
+        # s4 is already being downloaded
+        m.stream_state['s4']=stream_state(
+            pid=4242,
+            retry_id=0,
+            config=m.stream_config['s4'],
+            datestr='2026-10-18T12:00:00',
+            log_path=os.path.join(d, 's4.log'),
+            poll_attempt=False,
+            resumed=False,
+        )
+        try:
+            await m.spawn_poll_tasks(1)
+            assert not m.status_probe.spawns and m.poll_tasks == {}
+            await wait_for(lambda: len(m.attempts) > 0)
+            # the next round (after interval) starts s1 again: there's no state, as try_stream
+            # doesn't run here
+            await wait_for(lambda: len(m.attempts) > 1)
+            assert set(m.attempts) == {('s1', True)}, m.attempts
+            # s4 and s5 aren't probed: 5 streams per round, in batches of 2
+            stats=app['stats']
+            assert stats['streams'] == 5 * stats['requests'] / 3, stats
+        finally:
+            await m.supervisor.shutdown()
+            await m.status_probe.close()
+            await runner.cleanup()
+
+
+async def fallback():
+    with tempfile.TemporaryDirectory() as d:
+        m=make_manager(d, None)
+        try:
+            await m.spawn_poll_tasks(1)
+            assert isinstance(m.status_probe, script_status_probe)
+            assert sorted(m.poll_tasks) == [s_id for s_id in S_IDS if s_id != 's5']
+            await wait_for(lambda: set(s_id for s_id, _ in m.attempts) == set(m.poll_tasks))
+            assert all(poll_attempt for _, poll_attempt in m.attempts), m.attempts
+        finally:
+            await m.supervisor.shutdown()
+
+
+def test_batched():
+    asyncio.run(batched())
+
+
+def test_errors():
+    asyncio.run(errors())
+
+
+def test_probe_task():
+    asyncio.run(probe_task())
+
+
+def test_fallback():
+    asyncio.run(fallback())
+
+
+def test_make_status_probe():
+    assert isinstance(make_status_probe(None), script_status_probe)
+    assert isinstance(make_status_probe({'type': 'script'}), script_status_probe)
+    try:
+        make_status_probe({'type': 'carrier-pigeon'})
+    except ValueError:
+        return
+    raise AssertionError('unknown type was accepted')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    test_batched()
+    test_errors()
+    test_probe_task()
+    test_fallback()
+    test_make_status_probe()
+    print('ok')
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# archive sync (sync.py) against the stand-in S3 endpoint (s3_server.py), run in-process
+#
+# - a single PUT: the object matches the file and its storage class, its key decrypts to the
+#   file name, the file is deleted and the manifest has it as done; uploading the same file
+#   again is skipped
+# - a multipart upload which is interrupted by a rejected part, then resumed from the manifest
+#   without uploading the finished parts again
+# - an ETag which doesn't match what was sent fails the upload (for a PUT and for a part), keeps
+#   the file, and aborts the multipart upload
+# - upload_all picks the storage class by file type
+#
+# usage: sync_test.py (or pytest test/sync_test.py)
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stream_manager import manifest as mf
+from stream_manager import sync
+from stream_manager.crypt import openssl_enc
+
+import s3_server
+
+
+BUCKET='archive'
+OPENSSL_ARGS='-aes-256-cbc -pbkdf2 -iter 1000 -k secret'
+MiB=sync.MiB
+
+# the stand-in doesn't check credentials, but boto3 wants some
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+
+async def serve(app):
+    runner=web.AppRunner(app)
+    await runner.setup()
+    site=web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port=runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}'
+
+
+def write(path, size, seed=0):
+    # not compressible, not repetitive across parts
+    data=b''.join(
+        i.to_bytes(4, 'little') * 4 for i in range(seed << 24, (seed << 24) + size // 16)
+    )[:size]
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+class fixture():
+
+    def __init__(self, d, base) -> None:
+        self.d=d
+        self.manifest=mf.manifest(os.path.join(d, 'manifest.db'))
+        self.uploader=sync.s3_uploader(BUCKET, openssl_enc(OPENSSL_ARGS), region='us-east-1',
+            endpoint_url=base, part_size=5*MiB, manifest=self.manifest)
+
+    async def upload(self, path, **kwargs):
+        loop=asyncio.get_running_loop()
+        return await loop.run_in_executor(None,
+            lambda: self.uploader.upload(path, sync.storage_class(path), **kwargs))
+
+    def close(self):
+        self.manifest.close()
+
+
+async def run(test):
+    runner, base=await serve(s3_server.make_app())
+    s3=runner.app['s3']
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            f=fixture(d, base)
+            try:
+                await test(f, s3)
+            finally:
+                f.close()
+    finally:
+        await runner.cleanup()
+
+
+async def single_put(f, s3):
+    path=os.path.join(f.d, 's1_720p_2026-10-18T12:00:00.000000_0.mkv.json')
+    data=write(path, 1000)
+
+    r=await f.upload(path)
+    obj=s3.objects[(BUCKET, r['key'])]
+    assert obj['body'] == data
+    assert obj['storage_class'] == 'STANDARD_IA' == r['storage_class']
+    assert r['etag'] == obj['etag']
+    assert openssl_enc(OPENSSL_ARGS).decrypt(r['key'][len('tw/'):]) == os.path.basename(path)
+    assert not os.path.exists(path)
+
+    rec=f.manifest.get(path)
+    assert rec['status'] == mf.DONE and rec['sha256'] == r['sha256'], dict(rec)
+    assert rec['stream'] == 's1', dict(rec)
+
+    # the same file again: already archived
+    write(path, 1000)
+    r2=await f.upload(path)
+    assert r2.get('skipped') and r2['key'] == r['key'], r2
+    assert s3.requests['put_object'] == 1, s3.requests
+    assert not os.path.exists(path)
+
+
+async def multipart_resume(f, s3):
+    path=os.path.join(f.d, 's1_720p_2026-10-18T12:00:00.000000_1.mkv')
+    data=write(path, 12 * MiB, seed=1)
+
+    # part 2 is rejected: the upload is interrupted after part 1
+    s3.reject_parts.add(2)
+    try:
+        await f.upload(path)
+        raise AssertionError('upload should have failed')
+    except sync.VerifyError:
+        raise
+    except Exception:
+        pass
+    assert os.path.exists(path)
+    rec=f.manifest.get(path)
+    assert rec['status'] == mf.FAILED and rec['upload_id'] in s3.uploads, dict(rec)
+    assert [p['PartNumber'] for p in json.loads(rec['parts'])] == [1]
+
+    # resumed: only parts 2 and 3 are uploaded
+    r=await f.upload(path)
+    assert s3.requests['create_multipart_upload'] == 1, s3.requests
+    assert s3.requests['upload_part'] == 4, s3.requests
+    assert s3.requests['list_parts'] == 1, s3.requests
+    obj=s3.objects[(BUCKET, r['key'])]
+    assert obj['body'] == data
+    assert obj['etag'].endswith('-3') and r['etag'] == obj['etag'], obj['etag']
+    assert obj['storage_class'] == 'DEEP_ARCHIVE'
+    assert len(s3.uploads) == 0
+    assert f.manifest.get(path)['status'] == mf.DONE
+    assert not os.path.exists(path)
+
+
+async def etag_mismatch(f, s3):
+    s3.bad_etag=True
+
+    small=os.path.join(f.d, 's1_720p_2026-10-18T12:00:00.000000_2.mkv')
+    large=os.path.join(f.d, 's1_720p_2026-10-18T12:00:00.000000_3.mkv')
+    write(small, 1000)
+    write(large, 6 * MiB)
+
+    for path in (small, large):
+        try:
+            await f.upload(path)
+            raise AssertionError(f'{path}: mismatch not detected')
+        except sync.VerifyError:
+            pass
+        assert os.path.exists(path)
+        rec=f.manifest.get(path)
+        assert rec['status'] == mf.FAILED and rec['upload_id'] is None, dict(rec)
+    # the corrupt multipart upload is aborted, not left to be resumed
+    assert s3.requests['abort_multipart_upload'] == 1, s3.requests
+    assert len(s3.uploads) == 0
+
+
+async def upload_all(f, s3):
+    name='s2_audio_only_2026-10-18T12:00:00.000000_0.mkv'
+    paths=[os.path.join(f.d, f'{name}{suffix}') for suffix in ('', '.json', '_packets.json.gz', '_packets.pkt')]
+    for i, path in enumerate(paths):
+        write(path, 1000, seed=i)
+
+    loop=asyncio.get_running_loop()
+    results, errors=await loop.run_in_executor(None, f.uploader.upload_all, paths)
+    assert errors == [], errors
+    classes={os.path.basename(r['path'])[len(name):]: s3.objects[(BUCKET, r['key'])]['storage_class'] for r in results}
+    assert classes == {
+        '': 'DEEP_ARCHIVE',
+        '.json': 'STANDARD_IA',
+        '_packets.json.gz': 'DEEP_ARCHIVE',
+        '_packets.pkt': 'DEEP_ARCHIVE',
+    }, classes
+    assert sync.storage_class('notes.txt') is None
+
+
+def test_single_put():
+    asyncio.run(run(single_put))
+
+
+def test_multipart_resume():
+    asyncio.run(run(multipart_resume))
+
+
+def test_etag_mismatch():
+    asyncio.run(run(etag_mismatch))
+
+
+def test_upload_all():
+    asyncio.run(run(upload_all))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    test_single_put()
+    test_multipart_resume()
+    test_etag_mismatch()
+    test_upload_all()
+    print('ok')